@@ -0,0 +1,693 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from data_di4370_ethernet import decode_adc_payload, DataQDI4370Ethernet, PACKET_LATENCY_MS, choose_packet_size, \
+                                 packet_duration_ms
+from dataq_acquisition import AcquisitionThread
+from dataq_receive import DatagramReceiver
+from dataq_storage import ColumnarLogWriter
+from dataq_trigger import TriggerEngine, trigger_sink
+from dataq_writer import BlockWriter, text_log_sink, columnar_log_sink
+
+
+# Packet sizes (in bytes of samples) that the 'ps' command in send_setup_commands supports
+PACKET_SIZES = [16, 32, 64, 128, 256, 512, 1024, 2048]
+
+# One unit with all 8 channels in its scan list, the same shape as the demo config in data_di4370_ethernet.py
+BENCH_HARDWARE = {'Strip_Chart_1': {'ip_address': '192.168.0.80',}}
+BENCH_STRIPCHARTS = {'Bench_Channel_%02d' % ch: {'channel': ch, 'strip_chart': 'Strip_Chart_1',
+                                                 'daq_scale': [1000, 100, 10, 1, 0.1][ch % 5], 'value_scale': 1}
+                     for ch in range(0, 8)}
+
+
+# Build a DQAdcData datagram the way the unit sends it
+def make_adc_packet(sample_count, cumulative_count=0, groupid=1, order=0):
+    header = struct.pack("@IIIII", 0x14142135, groupid, order, cumulative_count, sample_count)
+    samples = np.random.randint(-32768, 32767, sample_count).astype('<i2')
+    return header + samples.tobytes()
+
+
+# The per-sample decode read_messages did before the vectorized path, kept here as the baseline
+def legacy_decode(data, ip_address, scales, hardware_dict, stripchart_setup_dict):
+    PayLoadSamples = [x for ind, x in enumerate(data) if ind >= 20]
+
+    payload = []
+    for i in range(0, len(PayLoadSamples), 2):
+        lower_byte = PayLoadSamples[i]
+        upper_byte = PayLoadSamples[i+1]
+        upper_byte_shift = upper_byte << 8
+        big_boy_byte = lower_byte + upper_byte_shift
+        payload.append(big_boy_byte)
+
+    def twos(val, bytes=2):
+        b = val.to_bytes(bytes, byteorder=sys.byteorder, signed=False)
+        return int.from_bytes(b, byteorder=sys.byteorder, signed=True)
+
+    device_name = [item for item in hardware_dict if hardware_dict[item]['ip_address'] == ip_address][0]
+
+    sequence = []
+    i = -1
+    for reading in payload:
+        i = i + 1
+        ch = i % 8
+
+        daq_conv_scale = scales[ip_address]['daq_scale'][str(ch)]
+        daq_valu_scale = scales[ip_address]['value_scale'][str(ch)]
+        conv_reading = (daq_conv_scale * float(twos(reading) / 32768)) * daq_valu_scale
+
+        channel_name = [item for item in stripchart_setup_dict if \
+        stripchart_setup_dict[item]['channel'] == ch and \
+        stripchart_setup_dict[item]['strip_chart'] == device_name][0]
+
+        sequence.append("%s value=%f" % (channel_name, conv_reading))
+    return sequence
+
+
+# Run func repeatedly for about duration seconds and return calls per second
+def time_calls(func, duration):
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < duration:
+        for _ in range(0, 10):
+            func()
+        calls = calls + 10
+        elapsed = time.perf_counter() - start
+    return calls / elapsed
+
+
+# Run func repeatedly for about duration seconds, timing every call. Returns calls/s and the p50/p99 call
+#  time in microseconds.
+def measure_calls(func, duration):
+    latencies = []
+    start = time.perf_counter()
+    end = start
+    while end - start < duration:
+        call_start = time.perf_counter()
+        func()
+        end = time.perf_counter()
+        latencies.append(end - call_start)
+    latencies = np.array(latencies)
+    return {'calls_per_s': len(latencies) / (end - start),
+            'p50_us': float(np.percentile(latencies, 50) * 1e6),
+            'p99_us': float(np.percentile(latencies, 99) * 1e6)}
+
+
+def bench_adc_decode(duration, results):
+    ip_address = BENCH_HARDWARE['Strip_Chart_1']['ip_address']
+    scales = {ip_address: {'daq_scale': {}, 'value_scale': {}}}
+    for info in BENCH_STRIPCHARTS.values():
+        scales[ip_address]['daq_scale'][str(info['channel'])] = info['daq_scale']
+        scales[ip_address]['value_scale'][str(info['channel'])] = info['value_scale']
+    scale_vector = np.array([scales[ip_address]['daq_scale'][str(ch)] * scales[ip_address]['value_scale'][str(ch)] \
+                             / 32768 for ch in range(0, 8)])
+
+    print("DQAdcData decode, samples/s")
+    print("%8s %16s %16s %10s" % ("ps bytes", "legacy", "vectorized", "speedup"))
+    for packet_size in PACKET_SIZES:
+        sample_count = packet_size // 2
+        packet = make_adc_packet(sample_count)
+        packet_scale = np.resize(scale_vector, sample_count)
+
+        # Both paths have to agree before their speed means anything
+        legacy = [float(line.split('=')[1]) for line in \
+                  legacy_decode(packet, ip_address, scales, BENCH_HARDWARE, BENCH_STRIPCHARTS)]
+        if not np.allclose(legacy, decode_adc_payload(packet, packet_scale)[1], atol=1e-5):
+            raise Exception("Vectorized decode does not match legacy decode at %d bytes!" % packet_size)
+
+        legacy_rate = time_calls(lambda: legacy_decode(packet, ip_address, scales, BENCH_HARDWARE,
+                                                       BENCH_STRIPCHARTS), duration) * sample_count
+        vector_rate = time_calls(lambda: decode_adc_payload(packet, packet_scale), duration) * sample_count
+        print("%8d %16.0f %16.0f %9.1fx" % (packet_size, legacy_rate, vector_rate, vector_rate / legacy_rate))
+        results.append({'name': 'adc_payload_decode', 'params': {'ps_bytes': packet_size},
+                        'legacy_samples_per_s': legacy_rate, 'samples_per_s': vector_rate})
+
+
+# Sends the same datagram to address as fast as it can until duration runs out, run in its own process
+def udp_blaster(address, packet, duration):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stop_time = time.perf_counter() + duration
+    while time.perf_counter() < stop_time:
+        for _ in range(0, 100):
+            try:
+                sock.sendto(packet, address)
+            except OSError:
+                pass    # Receiver queue is full, keep going
+    sock.close()
+
+
+# One receive loop the way read_messages used to do it, a new bytes object per datagram
+def receive_recvfrom(sock, count, timeout):
+    sock.settimeout(timeout)
+    messages = []
+    while len(messages) < count:
+        try:
+            data, addr = sock.recvfrom(2048)
+        except socket.timeout:
+            break
+        messages.append([addr, data])
+    return len(messages)
+
+
+# The same loop through DatagramReceiver, recvfrom_into a buffer pool and drained in batches
+def receive_pooled(receiver, count, timeout):
+    received = 0
+    while received < count:
+        batch = receiver.receive(timeout, max_count=count - received)
+        if not batch:
+            break
+        received = received + len(batch)
+    return received
+
+
+def bench_udp_receive(duration, results):
+    print("Loopback UDP receive, recvfrom vs. pooled recvfrom_into")
+    print("%8s %10s %14s %16s %12s" % ("ps bytes", "method", "packets/s", "bytes alloc/pkt", "pkts/wakeup"))
+    for packet_size in [16, 2048]:
+        packet = make_adc_packet(packet_size // 2)
+        for method in ["recvfrom", "pooled"]:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            sock.bind(('127.0.0.1', 0))
+            receiver = DatagramReceiver(sock, buffer_size=len(packet) + 64, buffer_count=1024, max_batch=256)
+
+            blaster = multiprocessing.Process(target=udp_blaster, args=(sock.getsockname(), packet, duration + 0.5))
+            blaster.start()
+            time.sleep(0.2)     # Let the queue fill up so we measure the receiver, not the sender
+
+            # Go once round the buffer pool first, it only settles into steady state after that
+            receive_pooled(receiver, 2 * receiver.pool.count, 1)
+
+            # Allocation is measured over a fixed batch of 1000 datagrams, with the batch kept as
+            #  read_messages keeps it until it is decoded
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            if method == "recvfrom":
+                sock.settimeout(1)
+                kept = []
+                for _ in range(0, 1000):
+                    kept.append(sock.recvfrom(2048))
+            else:
+                kept = []
+                while len(kept) < 1000:
+                    kept.extend(receiver.receive(1, max_count=1000 - len(kept)))
+            allocated = (tracemalloc.get_traced_memory()[0] - before) / len(kept)
+            tracemalloc.stop()
+            del kept
+
+            receiver.wakeups = 0
+            receiver.datagrams = 0
+            start = time.perf_counter()
+            received = 0
+            while time.perf_counter() - start < duration:
+                if method == "recvfrom":
+                    received = received + receive_recvfrom(sock, 1000, 1)
+                else:
+                    received = received + receive_pooled(receiver, 1000, 1)
+            rate = received / (time.perf_counter() - start)
+
+            per_wakeup = receiver.datagrams / receiver.wakeups if receiver.wakeups else 1
+            print("%8d %10s %14.0f %16.1f %12.1f" % (packet_size, method, rate, allocated, per_wakeup))
+            results.append({'name': 'udp_receive', 'params': {'ps_bytes': packet_size, 'method': method},
+                            'packets_per_s': rate, 'bytes_alloc_per_packet': allocated,
+                            'packets_per_wakeup': per_wakeup})
+
+            blaster.join()
+            sock.close()
+
+
+# Hardware and scan lists for units simulated on 127.0.0.80 onwards, each with all channels in its scan list
+def simulated_config(units, channels=8):
+    hardware = {}
+    stripcharts = {}
+    for unit in range(0, units):
+        device = 'Sim_Unit_%02d' % unit
+        hardware[device] = {'ip_address': '127.0.0.%d' % (80 + unit)}
+        for ch in range(0, channels):
+            stripcharts['%s_Channel_%02d' % (device, ch)] = {'channel': ch, 'strip_chart': device,
+                                                             'daq_scale': [1000, 100, 10, 1, 0.1][ch % 5],
+                                                             'value_scale': 1}
+    return hardware, stripcharts
+
+
+# A DataQDI4370Ethernet set up for decoding without talking to any units
+def bench_dataq(hardware, stripcharts, sample_rate=1000):
+    with contextlib.redirect_stdout(io.StringIO()):
+        dataq = DataQDI4370Ethernet(hardware_dict=hardware, stripchart_setup_dict=stripcharts,
+                                    broadcast_address='127.255.255.255')
+        dataq.sample_rate = sample_rate
+        dataq.compile_scan_lists()
+        dataq.configure_sample_clock(dataq.compute_srate(sample_rate))
+    dataq.sample_clock.anchor(time.time_ns())
+    return dataq
+
+
+# Command packing, response and discovery parsing, full DQAdcData message decode at every packet size and
+#  the log sinks, all through the same code the acquisition uses
+def bench_components(duration, results):
+    hardware, stripcharts = simulated_config(1)
+    dataq = bench_dataq(hardware, stripcharts)
+    ip_address = hardware['Sim_Unit_00']['ip_address']
+    addr = (ip_address, 51235)
+
+    print("%-28s %14s %14s %10s %10s" % ("component", "calls/s", "samples/s", "p50 us", "p99 us"))
+    def report(name, params, measured, samples_per_call=None):
+        if samples_per_call:
+            measured['samples_per_s'] = measured['calls_per_s'] * samples_per_call
+        label = name + (" %s" % params['ps_bytes'] if 'ps_bytes' in params else "")
+        print("%-28s %14.0f %14s %10.2f %10.2f" % (label, measured['calls_per_s'],
+              "%.0f" % measured['samples_per_s'] if samples_per_call else "-", measured['p50_us'], measured['p99_us']))
+        results.append(dict({'name': name, 'params': params}, **measured))
+
+    report('pack_command', {}, measure_calls(lambda: dataq.pack_command(groupid=1, command='Shared',
+                                                                        payload="srate 60000"), duration))
+
+    # Command heavy flows, packed the way stop_devices, setup and the keepalive loop pack them
+    stop_flow = [(groupid, command) for groupid in range(1, 10) for command in ['SyncStop', 'Disconnect']]
+    setup_flow = [('Connect', ip_address), ('Shared', "keepalive 0"), ('Shared', "info 1"), ('Shared', "eol 1"),
+                  ('Shared', "encode 0"), ('Shared', "dec 1"), ('Shared', "deca 1"), ('Shared', "srate 60000"),
+                  ('Shared', "ps 6")] + [('Shared', "slist %d %d" % (i, i)) for i in range(8)]
+    def pack_flow(flow):
+        for groupid, command in flow:
+            dataq.pack_command(groupid=groupid, command=command)
+    def pack_setup():
+        for command, payload in setup_flow:
+            dataq.pack_command(groupid=1, command=command, payload=payload)
+    report('command_flow stop_devices', {'commands': len(stop_flow)}, measure_calls(lambda: pack_flow(stop_flow),
+                                                                                    duration))
+    report('command_flow setup', {'commands': len(setup_flow)}, measure_calls(pack_setup, duration))
+    report('command_flow keepalive', {}, measure_calls(lambda: dataq.pack_command(groupid=1, command='KeepAlive'),
+                                                       duration))
+
+    payload = b'srate 60000\r\0'
+    response = struct.pack("@IIII", 0x21712818, 1, 0, len(payload)) + payload
+    report('decode_response_message', {}, measure_calls(lambda: dataq.decode_response_message(addr, response),
+                                                        duration))
+
+    reply = "%s 00:80:64:00:00:50 1100 4370 0 0 9 Simulated 60012345 0 0 0" % ip_address
+    report('parse_discovery_reply', {}, measure_calls(lambda: dataq.parse_discovery_reply(reply), duration))
+
+    for packet_size in PACKET_SIZES:
+        sample_count = packet_size // 2
+        packet = bytearray(make_adc_packet(sample_count))
+        count = [0]
+
+        # CumulativeCount has to keep going up or every packet is a gap
+        def decode():
+            struct.pack_into("@I", packet, 12, count[0] % (1 << 32))
+            count[0] = count[0] + sample_count
+            dataq.decode_adc_message(addr, packet)
+
+        dataq.sample_clock.anchor(time.time_ns())
+        measured = measure_calls(decode, duration)
+        measured['packets_per_s'] = measured['calls_per_s']
+        report('decode_adc_message', {'ps_bytes': packet_size}, measured, sample_count)
+
+    # Sinks get a batch of 32 blocks of 0.1 s each, the BlockWriter default
+    acquisition = AcquisitionThread(dataq)
+    ring = acquisition.rings[ip_address]
+    blocks = []
+    for i in range(0, 32):
+        counts = np.random.randint(-32768, 32768, ring.block_size).astype(np.int16)
+        ring.write(counts * (10 / 32768), counts, i * ring.block_size)
+        blocks.append(acquisition.read_block(ip_address))
+    samples_per_batch = 32 * ring.block_size
+
+    log_dir = tempfile.mkdtemp(prefix='dataq_bench_')
+    try:
+        logger = logging.getLogger("Benchmark log")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        handler = logging.FileHandler(os.path.join(log_dir, 'bench.log'))
+        logger.addHandler(handler)
+        sink = text_log_sink(dataq, logger)
+        report('text_log_sink', {'blocks': 32}, measure_calls(lambda: sink(blocks), duration), samples_per_batch)
+        logger.removeHandler(handler)
+        handler.close()
+
+        columnar_logs = {ip_address: ColumnarLogWriter(os.path.join(log_dir, 'columnar'),
+                                                       dataq.routes[ip_address]['channel_names'])}
+        sink = columnar_log_sink(dataq, columnar_logs)
+        report('columnar_log_sink', {'blocks': 32}, measure_calls(lambda: sink(blocks), duration), samples_per_batch)
+
+        # Triggers on every channel in front of the same log, decimated 100:1, none of them firing
+        channel_names = dataq.routes[ip_address]['channel_names']
+        triggers = [{'channel': channel_names[i], 'type': ['level', 'edge', 'window', 'slope'][i % 4],
+                     'level': 1e9, 'low': -1e9, 'high': 1e9, 'rate': 1e12} for i in range(len(channel_names))]
+        engines = {ip_address: TriggerEngine(os.path.join(log_dir, 'events'), channel_names, triggers, 1000,
+                                             decimate=100)}
+        sink = trigger_sink(dataq, engines, columnar_log_sink(dataq, columnar_logs))
+        report('trigger_sink', {'blocks': 32, 'triggers': len(triggers)}, measure_calls(lambda: sink(blocks), duration),
+               samples_per_batch)
+        columnar_logs[ip_address].close()
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+        dataq.close()
+
+
+# Runs DataQSimulator in its own process until stop_event is set
+def run_simulator(ip_addresses, stop_event, loss_rate):
+    from dataq_simulator import DataQSimulator
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulator = DataQSimulator(ip_addresses, loss_rate=loss_rate)
+        simulator.start()
+    stop_event.wait()
+    simulator.stop()
+
+
+# units simulated units stream over loopback into the acquisition thread, the writer logs to a columnar log
+#  in a temporary directory. Measured over duration seconds after a second of warm up.
+#  units_per_shard > 0 receives through ShardedAcquisition worker processes instead of one AcquisitionThread.
+def bench_end_to_end(duration, results, units=2, channels=8, sample_rate=1000, packet_size=512, loss_rate=0.0,
+                     sink_type='columnar', units_per_shard=0):
+    from dataq_async import bring_up
+    from dataq_sharded import ShardedAcquisition
+
+    hardware, stripcharts = simulated_config(units, channels)
+    ip_addresses = [chart['ip_address'] for chart in hardware.values()]
+    stop_event = multiprocessing.Event()
+    simulator = multiprocessing.Process(target=run_simulator, args=(ip_addresses, stop_event, loss_rate), daemon=True)
+    simulator.start()
+    time.sleep(0.5)
+
+    log_dir = tempfile.mkdtemp(prefix='dataq_bench_')
+    with contextlib.redirect_stdout(io.StringIO()):
+        dataq = DataQDI4370Ethernet(hardware_dict=hardware, stripchart_setup_dict=stripcharts,
+                                    broadcast_address='127.255.255.255')
+        try:
+            bring_up(dataq, sample_rate=sample_rate, packet_size=packet_size)
+        except Exception:
+            dataq.close()
+            stop_event.set()
+            raise
+
+    columnar_logs = {}
+    if sink_type == 'columnar':
+        for ip_address in dataq.routes:
+            columnar_logs[ip_address] = ColumnarLogWriter(os.path.join(log_dir, dataq.routes[ip_address]['device']),
+                                                          dataq.routes[ip_address]['channel_names'])
+        sink = columnar_log_sink(dataq, columnar_logs)
+    else:
+        sink = lambda batch: None
+
+    if units_per_shard:
+        receiver = ShardedAcquisition(dataq, units_per_shard=units_per_shard)
+    else:
+        receiver = AcquisitionThread(dataq)
+    with contextlib.redirect_stdout(io.StringIO()):
+        receiver.start()
+    dataq.start()
+    writer = BlockWriter(sink, telemetry=dataq.telemetry)
+
+    # Returns the number of samples handed to the writer
+    def pump(seconds):
+        delivered = 0
+        end_time = time.perf_counter() + seconds
+        while time.perf_counter() < end_time:
+            got_block = False
+            for ip_address in receiver.rings:
+                block = receiver.read_block(ip_address)
+                if block is not None:
+                    writer.put(block)
+                    delivered = delivered + len(block['Values'])
+                    got_block = True
+            if not got_block:
+                time.sleep(0.01)
+        return delivered
+
+    # Measure from here on, past start up. Counters are differences, sharded workers report running totals.
+    pump(1.0)
+    before = dataq.stats()
+    start_time = time.perf_counter()
+    delivered = pump(duration)
+    elapsed = time.perf_counter() - start_time
+    stats = dataq.stats()
+
+    writer.close()
+    for columnar_log in columnar_logs.values():
+        columnar_log.close()
+    with contextlib.redirect_stdout(io.StringIO()):
+        receiver.stop()
+        dataq.stop_devices()
+    dataq.close()
+    stop_event.set()
+    simulator.join(5)
+    shutil.rmtree(log_dir, ignore_errors=True)
+
+    def difference(counter):
+        return sum(device[counter] - before['devices'].get(ip_address, {}).get(counter, 0)
+                   for ip_address, device in stats['devices'].items())
+    samples = difference('samples')
+    packets = difference('packets')
+    lost = difference('lost_samples')
+    overrun_lost = sum(counters['lost_samples'] for counters in receiver.overruns().values())
+    result = {'name': 'end_to_end',
+              'params': {'units': units, 'channels': channels, 'sample_rate': sample_rate,
+                         'ps_bytes': packet_size, 'injected_loss_rate': loss_rate, 'sink': sink_type,
+                         'units_per_shard': units_per_shard},
+              'offered_samples_per_s': units * channels * sample_rate,
+              'samples_per_s': delivered / elapsed,
+              'packets_per_s': packets / elapsed,
+              'loss_rate': lost / (samples + lost) if samples + lost else 0.0,
+              'overrun_lost_samples': overrun_lost,
+              'writer_dropped_blocks': writer.metrics()['dropped_blocks'],
+              'decode_p50_us': stats['histograms']['decode']['p50'] * 1e6,
+              'decode_p99_us': stats['histograms']['decode']['p99'] * 1e6,
+              'p50_us': stats['histograms']['recv_to_write']['p50'] * 1e6,
+              'p99_us': stats['histograms']['recv_to_write']['p99'] * 1e6}
+    print("%d units x %d channels at %d Hz, ps %d bytes%s: %0.0f of %d S/s, %0.0f packets/s, loss %0.4f%%, "
+          "receive to write p50 %0.1f ms / p99 %0.1f ms" % \
+          (units, channels, sample_rate, packet_size,
+           ", %d units per shard" % units_per_shard if units_per_shard else "", result['samples_per_s'], result['offered_samples_per_s'],
+           result['packets_per_s'], result['loss_rate'] * 100, result['p50_us'] / 1000, result['p99_us'] / 1000))
+    results.append(result)
+
+
+# Packets/s against latency for every packet size at one sample rate and scan list length, end to end over
+#  loopback. A sample waits for its packet to fill before the unit sends it and is in the receiver's ring once
+#  the packet is decoded, the fill time is what packet_size='auto' trades against packets/s and the decode time
+#  spent per second. Receive to write latency is left out here, it is dominated by the writer's block size.
+def bench_packet_sizes(duration, results, units=1, channels=8, sample_rate=1000, latency_ms=PACKET_LATENCY_MS):
+    curve = []
+    for packet_size in PACKET_SIZES:
+        bench_end_to_end(duration, curve, units=units, channels=channels, sample_rate=sample_rate,
+                         packet_size=packet_size)
+    chosen = choose_packet_size(sample_rate, channels, latency_ms)
+
+    print("%d units x %d channels at %d Hz, 'auto' with a %g ms budget picks %d bytes" % \
+          (units, channels, sample_rate, latency_ms, chosen))
+    print("%10s %12s %10s %12s %14s %16s" % ("ps bytes", "packets/s", "fill ms", "latency ms", "decode p50 us",
+                                              "decode ms per s"))
+    for result in curve:
+        packet_size = result['params']['ps_bytes']
+        fill_ms = packet_duration_ms(packet_size, sample_rate, channels)
+        result = dict(result, name='packet_size', fill_ms=fill_ms, auto=packet_size == chosen,
+                      latency_ms=fill_ms + result['decode_p50_us'] / 1000,
+                      decode_ms_per_s=result['packets_per_s'] * result['decode_p50_us'] / 1000)
+        print("%10d %12.0f %10.1f %12.2f %14.1f %16.2f %s" % \
+              (packet_size, result['packets_per_s'], fill_ms, result['latency_ms'], result['decode_p50_us'],
+               result['decode_ms_per_s'], "<- auto" if result['auto'] else ""))
+        results.append(result)
+
+
+# Raw count archive with every codec that is installed: compression ratio against raw int16 counts (plus
+#  int64 timestamps) and against the text log, and MB/s of raw data in and out. The counts are the
+#  simulator's sine waves plus a few counts of noise, like a real input.
+def bench_archive(results, scans=500000, channels=8, workers=(1, 2)):
+    from dataq_archive import ARCHIVE_CODECS, RawArchiveWriter, RawArchiveReader, archive_codec
+
+    rng = np.random.default_rng(0)
+    phases = np.arange(scans)[:, None] / 1000 + np.arange(channels) / channels
+    counts = (np.sin(2 * np.pi * phases) * 16000 + rng.normal(0, 4, (scans, channels))).astype('<i2')
+    timestamps = 1700000000 * 10 ** 9 + np.arange(scans, dtype=np.int64) * 10 ** 6     # 1 kHz
+    scale = np.full(channels, 1000 / 32768)
+    channel_names = ["ch%d" % i for i in range(channels)]
+    raw_mb = scans * (8 + 2 * channels) / 1e6
+    text_bytes = sum(len("%s value=%f time_ns=%d\n" % (channel_names[i % channels], counts[0, i % channels] * scale[0],
+                                                       timestamps[0])) for i in range(channels)) * scans
+
+    print("%d scans x %d channels, %0.1f MB raw, %0.1f MB as text log" % (scans, channels, raw_mb, text_bytes / 1e6))
+    print("%-6s %8s %10s %10s %12s %12s" % ("codec", "workers", "vs raw", "vs text", "write MB/s", "read MB/s"))
+    for codec in ARCHIVE_CODECS:
+        try:
+            archive_codec(codec)
+        except Exception as e:
+            print("%-6s skipped: %s" % (codec, e))
+            continue
+        for worker_count in workers:
+            archive_dir = tempfile.mkdtemp(prefix='dataq_bench_')
+            try:
+                archive = RawArchiveWriter(archive_dir, channel_names, scale, codec=codec, workers=worker_count)
+                start_time = time.perf_counter()
+                for i in range(0, scans, 100):     # 0.1 s blocks, as the writer gets them
+                    archive.append(timestamps[i:i + 100], counts[i:i + 100])
+                archive.close()
+                write_seconds = time.perf_counter() - start_time
+
+                reader = RawArchiveReader(archive_dir, cache_columns=0)
+                start_time = time.perf_counter()
+                for channel in channel_names:
+                    reader.read(channel)
+                read_seconds = time.perf_counter() - start_time
+
+                ratio = archive.raw_bytes / archive.compressed_bytes
+                result = {'name': 'archive', 'params': {'codec': codec, 'workers': worker_count},
+                          'ratio': ratio, 'text_ratio': text_bytes / archive.compressed_bytes,
+                          'write_mb_per_s': raw_mb / write_seconds, 'read_mb_per_s': raw_mb / read_seconds}
+                print("%-6s %8d %9.1fx %9.1fx %12.1f %12.1f" % (codec, worker_count, ratio, result['text_ratio'],
+                                                              result['write_mb_per_s'], result['read_mb_per_s']))
+                results.append(result)
+            finally:
+                shutil.rmtree(archive_dir, ignore_errors=True)
+
+
+# Start up budgets in milliseconds of wall time on top of a bare interpreter ('python -c pass'). Discovery is
+#  run from cron as a health check so it has to stay cheap, acquisition is allowed numpy.
+STARTUP_BUDGETS_MS = {'import dataq_discovery': 40,
+                      'dataq_discovery.py cold start': 80,
+                      'import data_di4370_ethernet': 250}
+
+# Median wall time in ms of running a fresh interpreter with args
+def time_interpreter(args, runs):
+    times = []
+    for run in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append((time.perf_counter() - start_time) * 1000)
+    return float(np.median(times))
+
+
+# Import and cold start times of the entry points, each against its budget in STARTUP_BUDGETS_MS
+def bench_startup(runs, results):
+    baseline = time_interpreter(['-c', 'pass'], runs)
+    print("Bare interpreter start up %0.1f ms" % baseline)
+    print("%-32s %10s %10s %10s" % ("entry point", "total ms", "over ms", "budget ms"))
+    commands = {'import dataq_discovery': ['-c', 'import dataq_discovery'],
+                'dataq_discovery.py cold start': ['dataq_discovery.py', '-t', '0', '-b', '127.255.255.255'],
+                'import data_di4370_ethernet': ['-c', 'import data_di4370_ethernet']}
+    for name, args in commands.items():
+        total = time_interpreter(args, runs)
+        budget = STARTUP_BUDGETS_MS[name]
+        print("%-32s %10.1f %10.1f %10d %s" % (name, total, total - baseline, budget,
+                                               "ok" if total - baseline <= budget else "OVER BUDGET"))
+        results.append({'name': 'startup', 'params': {'entry_point': name}, 'total_ms': total,
+                        'over_baseline_ms': total - baseline, 'budget_ms': budget})
+
+    # Discovery must not drag in numpy or the acquisition modules
+    check = "import sys, dataq_discovery; print(','.join(m for m in ['numpy', 'data_di4370_ethernet'] if m in sys.modules))"
+    heavy = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True,
+                           cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    if heavy:
+        print("dataq_discovery imports %s!" % heavy)
+
+
+# Prints how each result moved against the same benchmark in an earlier run's JSON
+def compare_results(results, previous_path):
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)['results']
+
+    def key(result):
+        return result['name'] + json.dumps(result['params'], sort_keys=True)
+    previous = {key(result): result for result in previous}
+
+    print("Compared to %s:" % previous_path)
+    for result in results:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        # The headline rate, tail latency and loss, where the benchmark has them
+        rate = [metric for metric in ['samples_per_s', 'packets_per_s', 'calls_per_s'] if metric in result][:1]
+        for metric in rate + ['p99_us', 'loss_rate', 'over_baseline_ms']:
+            if metric in result and before.get(metric):
+                change = (result[metric] - before[metric]) / before[metric] * 100
+                print("  %-28s %-40s %-14s %+7.1f%%" % (result['name'], json.dumps(result['params'], sort_keys=True),
+                                                         metric, change))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-d", "--duration", required=False, default=0.5, type=float,
+                    help="seconds to run each measurement for")
+    ap.add_argument("-s", "--suite", required=False, nargs='+', default=['components', 'decode', 'receive', 'e2e'],
+                    choices=['components', 'decode', 'receive', 'e2e', 'startup', 'packets', 'archive'],
+                    help="benchmarks to run, 'startup' and 'packets' only when asked for")
+    ap.add_argument("-u", "--units", required=False, nargs='+', default=[1, 2, 4], type=int,
+                    help="numbers of simulated units for the end to end benchmark")
+    ap.add_argument("-r", "--sample-rate", required=False, default=1000, type=int,
+                    help="end to end sample rate per channel, Hz")
+    ap.add_argument("-p", "--packet-size", required=False, default=512, type=int, choices=PACKET_SIZES,
+                    help="end to end packet size, bytes")
+    ap.add_argument("--loss-rate", required=False, default=0.0, type=float,
+                    help="packet loss the simulated units inject in the end to end benchmark")
+    ap.add_argument("--shards", required=False, default=0, type=int,
+                    help="units per receiving worker process in the end to end benchmark, 0 for a single process")
+    ap.add_argument("--e2e-duration", required=False, default=5, type=float,
+                    help="seconds each end to end run is measured for")
+    ap.add_argument("--packet-latency", required=False, default=PACKET_LATENCY_MS, type=float,
+                    help="latency budget the packets benchmark marks the 'auto' choice for, ms")
+    ap.add_argument("--startup-runs", required=False, default=9, type=int,
+                    help="interpreter starts each startup measurement takes the median of")
+    ap.add_argument("-o", "--output", required=False, default=None, type=str,
+                    help="write the results to this JSON file")
+    ap.add_argument("-c", "--compare", required=False, default=None, type=str,
+                    help="JSON file of an earlier run to compare against")
+    args = vars(ap.parse_args())
+
+    results = []
+    if 'components' in args['suite']:
+        bench_components(args['duration'], results)
+        print()
+    if 'decode' in args['suite']:
+        bench_adc_decode(args['duration'], results)
+        print()
+    if 'receive' in args['suite']:
+        bench_udp_receive(args['duration'], results)
+        print()
+    if 'e2e' in args['suite']:
+        print("End to end over loopback with simulated units")
+        for units in args['units']:
+            bench_end_to_end(args['e2e_duration'], results, units=units, sample_rate=args['sample_rate'],
+                             packet_size=args['packet_size'], loss_rate=args['loss_rate'],
+                             units_per_shard=args['shards'])
+        print()
+    if 'packets' in args['suite']:
+        print("Packet size against latency over loopback with simulated units")
+        bench_packet_sizes(args['e2e_duration'], results, units=args['units'][0], sample_rate=args['sample_rate'],
+                           latency_ms=args['packet_latency'])
+        print()
+    if 'archive' in args['suite']:
+        print("Raw count archive")
+        bench_archive(results)
+        print()
+    if 'startup' in args['suite']:
+        bench_startup(args['startup_runs'], results)
+        print()
+
+    if args['output']:
+        with open(args['output'], 'w') as output_file:
+            json.dump({'time': time.time(),
+                       'host': platform.node(),
+                       'platform': platform.platform(),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'args': args,
+                       'results': results}, output_file, indent=1)
+        print("Results written to %s" % args['output'])
+    if args['compare']:
+        compare_results(results, args['compare'])
@@ -1,16 +1,68 @@
 import socket
+import os
 import re
 import time
-import signal
-from pathlib import Path
-import argparse
-import struct
 import random
-import sys
-from ping3 import ping
 import datetime
 import numpy as np
-import keyboard
+
+from dataq_codec import encode_command, decode_response, decode_adc_header, RESPONSE_HEADER
+from dataq_discovery import DISCOVERY_MESSAGE, discover, parse_discovery_reply, select_interfaces
+from dataq_receive import DatagramBufferPool, DatagramReceiver, receive_buffer_size, size_receive_buffer
+from dataq_telemetry import Telemetry
+from dataq_timestamps import SampleClock
+
+
+# Map packet size to commandable parameter for Data-Q units
+DATAQ_PACKET_SIZES = {16: 0,     # ps 0 - Make packet size 16 bytes (DEFAULT)
+                      32: 1,     # ps 1 - Make packet size 32 bytes
+                      64: 2,     # ps 2 - Make packet size 64 bytes
+                      128: 3,    # ps 3 - Make packet size 128 bytes
+                      256: 4,    # ps 4 - Make packet size 256 bytes
+                      512: 5,    # ps 5 - Make packet size 512 bytes
+                      1024: 6,   # ps 6 - Make packet size 1024 bytes
+                      2048: 7}   # ps 7 - Make packet size 2048 bytes
+
+# DQAdcData header is five unsigned ints (type, GroupID, Order, CumulativeCount, PayLoadSamples), 
+#  the signed 16-bit samples follow it
+ADC_HEADER_SIZE = 20
+
+# Seconds of every unit's data the kernel's receive buffer is sized to hold, so the receiver can stall (GC,
+#  disk) for that long before the kernel drops datagrams
+RECEIVE_HEADROOM_SECONDS = 2
+
+# Receive buffers never get smaller than this, command responses come in through them too
+MIN_RECEIVE_BUFFER_SIZE = 512
+
+# packet_size='auto' picks, for every unit, the largest packet that fills with data within this many
+#  milliseconds. Larger packets mean fewer datagrams (and less per packet overhead) per second, but each
+#  sample waits longer before the unit sends it.
+PACKET_LATENCY_MS = 50
+
+# Milliseconds of data in a packet of packet_size bytes, for a unit scanning scan_length channels scan_rate
+#  times a second
+def packet_duration_ms(packet_size, scan_rate, scan_length):
+    return packet_size / 2 / scan_length / scan_rate * 1000
+
+# Largest packet size in DATAQ_PACKET_SIZES that holds at most latency_ms of data, the smallest one if even
+#  that holds more
+def choose_packet_size(scan_rate, scan_length, latency_ms=PACKET_LATENCY_MS):
+    fits = [size for size in DATAQ_PACKET_SIZES if packet_duration_ms(size, scan_rate, scan_length) <= latency_ms]
+    return max(fits) if fits else min(DATAQ_PACKET_SIZES)
+
+# Pings a unit, ping3 is only imported the first time a unit that didn't answer discovery needs checking
+def _ping(ip_address):
+    from ping3 import ping
+    return ping(ip_address)
+
+# Turns a DQAdcData datagram into an int16 array of raw counts and a float array of scaled readings.
+# scale_vector holds one fused scale (daq_scale * value_scale / 32768) per scan list slot, pass it
+#  already repeated out to the packet length to skip the tiling on every packet.
+def decode_adc_payload(data, scale_vector, offset=ADC_HEADER_SIZE):
+    counts = np.frombuffer(data, dtype='<i2', offset=offset)    # Two's complement, little endian
+    if len(scale_vector) != len(counts):
+        scale_vector = np.resize(scale_vector, len(counts))
+    return counts, counts * scale_vector
 
 
 class DataQDI4370Ethernet:
@@ -20,9 +72,16 @@ class DataQDI4370Ethernet:
     # 51235 (fixed)        Device's command receiving port
     # 1234 (programmable)  PC's default status/data receiving port. Programmable via the PORT command.
 
-    def __init__(self, hardware_dict=None, stripchart_setup_dict=None, ip_address='0.0.0.0'):
+    def __init__(self, hardware_dict=None, stripchart_setup_dict=None, ip_address='0.0.0.0',
+                 broadcast_address='255.255.255.255'):
         self.ip_address = ip_address
-        self.socket_buffer_size = 2048
+        self.broadcast_address = broadcast_address  # '127.255.255.255' to talk to dataq_simulator.py on loopback
+        self.socket_buffer_size = ADC_HEADER_SIZE + max(DATAQ_PACKET_SIZES)     # Largest DQAdcData packet
+        self.packet_latency_ms = PACKET_LATENCY_MS     # Budget for packet_size='auto'
+        self.packet_sizes = {}  # IP -> packet size in bytes, once set up
+        self.packet_rates = {}  # IP -> packets/s, once set up
+        self.receive_headroom_seconds = RECEIVE_HEADROOM_SECONDS
+        self.requested_receive_buffer = None
 
         self.hardware_dict = hardware_dict
         self.stripchart_setup_dict = stripchart_setup_dict
@@ -50,237 +109,226 @@ class DataQDI4370Ethernet:
         self.rec_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         #self.rec_sock.bind((self.ip_address,1234))  # Have to make sure this port is open --> 'sudo ufw allow 1234/udp'
         self.rec_sock.bind((IPAddr,1234))  # Have to make sure this port is open --> 'sudo ufw allow 1234/udp'
+        self.receiver = DatagramReceiver(self.rec_sock, buffer_size=self.socket_buffer_size)
+        self.receiver.enable_kernel_stats()     # Kernel drop counts and arrival times, on Linux
+        self.gap_kernel_drops = 0   # receiver.kernel_drops when the last gap was counted
+
+        # Turns each unit's CumulativeCount into sample numbers and timestamps, and keeps track of gaps
+        self.sample_clock = SampleClock()
 
-        # Cumulative counts for messages received from units
-        self.cumulative_count = {}
-        for hardware in hardware_dict:
-            self.cumulative_count[hardware_dict[hardware]['ip_address']] = 0
+        # Packet, gap, timeout and exception counters plus latency histograms, see stats()
+        self.telemetry = Telemetry()
 
     # GroupID = 0 indicates and idle (available) device
     # The only command the DataQ will respond to when GroupID is 0 is the "connect" command (GroupID = 10)?
     # Create packed command per the Protocol Document, page # 9
+    # Commands are packed by dataq_codec, which caches them: stop, setup and keepalive repeat the same ones
     def pack_command(self, groupid=1,command='Connect',arg0=0,arg1=0,arg2=0,payload=''):
-        ethernet_commands = {'SyncStart': 1,        # HAVE to use this to 'start' with Ethernet devices
-                             'SlaveIp': 5,
-                             'SyncStop': 6,
-                             'Connect': 10,         # These are 'Ethernet-specific' command values
-                             'Disconnect': 11,      
-                             'KeepAlive': 12,
-                             'SetWdqHeader': 21,    # For shared commands , the command goes in the 'Payload'
-                             'Shared': 13,}   # All Shared (both USB and Ethernet) protocol commands have a value of 13
-        # '@' means 'native' Byte Order, Size, and Alignment, 'I' is 'unsigned int', 'c' is 'char'
-        # 0x31415926 is 'DQCommand' --> This is fixed for all commands to DataQ unit
-        # 'DQCommand' is fixed length, so we can use pack directly
-        payload = payload + '\0' # A null-terminated ASCII string or binary image as needed by the specific command
-        payload = bytes(payload.encode('ascii'))
-        pack_format = "@IIIIII%ds"%len(payload)
-        packed = struct.pack(pack_format,0x31415926,groupid,ethernet_commands[command],arg0,arg1,arg2,payload)
-        return packed
+        return encode_command(groupid, command, arg0, arg1, arg2, payload)
 
     # IF ADC is running, attempt to stop here
     def stop_devices(self):
         for id_id in range (1,10):      # This includes 1, but excludes 10, matches our numbers used in init
             msg = self.pack_command(groupid=id_id,command='SyncStop')
-            self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
+            self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
             msg = self.pack_command(groupid=id_id,command='Disconnect')
-            self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
+            self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+
+    # Scale vector for one unit repeated out to a whole packet that starts at scan list position first_slot.
+    # Packet size and scan list length are fixed after setup so this is only built a handful of times.
+    def packet_scale_vector(self, ip_address, sample_count, first_slot=0):
+        key = (ip_address, sample_count, first_slot)
+        if key not in self.packet_scales:
+            self.packet_scales[key] = \
+                np.resize(self.routes[ip_address]['scale'], first_slot + sample_count)[first_slot:].copy()
+        return self.packet_scales[key]
+
+    # Decodes a single DQAdcData datagram received from addr into a message dictionary. data can be a view
+    #  into a receive buffer, pass copy=True if the raw counts have to outlive that buffer. arrival_ns is when
+    #  the kernel received it, if the receiver knows (receiver.arrival_ns).
+    def decode_adc_message(self, addr, data, print_data=False, copy=False, arrival_ns=None):
+        start_time = time.perf_counter()
+        decoded_message = {}
+        decoded_message['IPAddress'] = addr[0]
+        decoded_message['Port'] = addr[1]
+
+        unpacked = decode_adc_header(data)
+        decoded_message['GroupID'] = unpacked[0]
+        decoded_message['Order'] = unpacked[1]
+        decoded_message['CumulativeCount'] = unpacked[2]
+        decoded_message['PayLoadSamples'] = unpacked[3]
+
+        # Have to use Cumulative Count to stay synchronized here, the sample clock unwraps it into a sample number
+        #  and records a gap if packets went missing. If our socket dropped datagrams since the last gap, a gap
+        #  now was lost here and not on the way.
+        kernel_drops = self.receiver.kernel_drops
+        decoded_message['SampleNumber'], gap = \
+            self.sample_clock.observe(decoded_message["IPAddress"], decoded_message['CumulativeCount'],
+                                      decoded_message['PayLoadSamples'], host_ns=arrival_ns or time.time_ns(),
+                                      kernel_drops=kernel_drops - self.gap_kernel_drops)
+        if gap is not None:
+            self.gap_kernel_drops = kernel_drops
+            self.telemetry.count_gap(decoded_message["IPAddress"], gap['LostSamples'], kernel=gap['KernelDrops'] > 0)
+            if gap['LostSamples'] < 0:
+                print("Cumulative count on %s went back %d samples! Resyncronizing!" % \
+                      (decoded_message["IPAddress"], -gap['LostSamples']))
+            else:
+                print("Error in cumulative count on %s, %d samples lost%s! Resyncronizing!" % \
+                      (decoded_message["IPAddress"], gap['LostSamples'],
+                       " (receive buffer overflowed)" if gap['KernelDrops'] else ""))
+
+        # Samples are interleaved in scan list order, the sample number tells us where in the scan
+        #  list this packet starts, so packets don't have to hold whole scans
+        route = self.routes[decoded_message["IPAddress"]]
+        decoded_message['Device'] = route['device']
+        decoded_message['FirstSlot'] = decoded_message['SampleNumber'] % len(route['slots'])
+
+        # All instruments transmit a 16-bit binary number for every analog channel conversion in 
+        #  the form of a signed, 16-bit Two's complement value. Decode the whole payload at once.
+        counts, values = decode_adc_payload(data, self.packet_scale_vector(
+            decoded_message["IPAddress"], decoded_message['PayLoadSamples'], decoded_message['FirstSlot']))
+
+        if len(counts) != decoded_message['PayLoadSamples']:
+            raise Exception("Decoded char length does not match expected PayLoadSamples!") 
+
+        # Raw counts and scaled readings, one entry per sample
+        decoded_message['PayLoadSamples'] = counts.copy() if copy else counts
+        decoded_message['Values'] = values
+        self.telemetry.count_packet(decoded_message["IPAddress"], route['device'], len(values), len(data),
+                                    time.perf_counter() - start_time)
+
+        if print_data:
+            for i in range(0, len(values)):
+                slot = (decoded_message['FirstSlot'] + i) % len(route['slots'])
+                print("Device %s, Reading %03d, Channel %s: %0.2f" % \
+                     (str(decoded_message["IPAddress"]), i, route['channel_names'][slot], values[i]))
+
+        return decoded_message
+
+    # Decodes a single DQResponse datagram received from addr into a message dictionary
+    def decode_response_message(self, addr, data):
+        # data: b'\x18(q!\x05\x00\x00\x00\x00\x00\x00\x00\x0c\x00\x00\x00srate 1000\r\x00'
+        decoded_message = {}
+        decoded_message['IPAddress'] = addr[0]
+        decoded_message['Port'] = addr[1]
+
+        # Straight from the receive buffer, only the payload is copied out
+        groupid, order, payload = decode_response(data)
+        decoded_message['GroupID'] = groupid
+        decoded_message['Order'] = order
+        decoded_message['PayLoadLength'] = len(data) - RESPONSE_HEADER.size
+        decoded_message['PayLoad'] = payload
+        return decoded_message
 
     # Reads messages from unit based on response type and decoces into a list of messages
     def read_messages(self, print_data=False, data_type="DQResponse", timeout=3, expected_count=None,decode=True):
-        self.rec_sock.settimeout(timeout)          # Set timeout, will break out of our try below
-
-        # Read messages here
+        # Read messages here. Datagrams land in the receiver's reusable buffers, so each batch is decoded
+        #  (or copied out when not decoding) before the next one is received.
         messages = []
         while True:
-            try:
-                data, addr = self.rec_sock.recvfrom(self.socket_buffer_size)
-                messages.append([addr,data])
+            max_count = expected_count - len(messages) if expected_count else None
+            batch = self.receiver.receive(timeout, max_count=max_count)
+            if not batch:
                 if expected_count:
-                    if len(messages) >= expected_count:
-                        break 
-            except:
+                    self.telemetry.count_timeout('read_messages')    # Not everyone answered
                 break   # Tiemout has occurred
 
-        # Decode messages here
-        if decode:
-            decoded_messages = []
-            for message in messages:
-
-                decoded_message = {}
-                decoded_message['IPAddress'] = message[0][0]
-                decoded_message['Port'] = message[0][1]
-
-                if data_type == "DQAdcData":
-
-                    unpacked = struct.unpack_from("@IIIIIs", message[1])
-                    if unpacked[0] != 0x14142135:
-                        raise Exception("Response TYPE does not match expected for DQAdcData!")
-                        #print("Response TYPE does not match expected for DQAdcData!")
-                        #return None
-
-                    decoded_message['GroupID'] = unpacked[1]
-                    decoded_message['Order'] = unpacked[2]
-                    decoded_message['CumulativeCount'] = unpacked[3]
-                    decoded_message['PayLoadSamples'] = unpacked[4]
-
-                    # Get PayloadSamples from end of our structure
-                    PayLoadSamples = [x for ind, x in enumerate(message[1]) if ind >= 20]
-
-                    # Have to use Cumulative Count to stay synchronized here
-                    if self.cumulative_count[decoded_message["IPAddress"]] != decoded_message['CumulativeCount']:
-                        # raise Exception("Error in cumulative count! Exiting!")
-                        print("Error in cumulative count! Resyncronizing!")
-                        self.cumulative_count[decoded_message["IPAddress"]] = decoded_message['CumulativeCount']
-
-                    # Each sample is two bytes
-                    payload = []
-                    for i in range(0, len(PayLoadSamples), 2):
-                        lower_byte = PayLoadSamples[i]
-                        upper_byte = PayLoadSamples[i+1]
-                        upper_byte_shift = upper_byte << 8
-                        big_boy_byte = lower_byte + upper_byte_shift
-                        payload.append(big_boy_byte)
-
-                    if len(payload) != decoded_message['PayLoadSamples']:
-                        raise Exception("Decoded char length does not match expected PayLoadSamples!") 
-
-                    # Add the bytes we receive to our cumulative count
-                    self.cumulative_count[decoded_message["IPAddress"]] = \
-                    self.cumulative_count[decoded_message["IPAddress"]] + len(payload)
-
-                    # Put our payload list into our thing
-                    decoded_message['PayLoadSamples'] = payload
-
-                    # All instruments transmit a 16-bit binary number for every analog channel conversion in 
-                    #  the form of a signed, 16-bit Two's complement value
-
-                    # Get twos complement value from bytes
-                    def twos(val, bytes=2):
-                        b = val.to_bytes(bytes, byteorder=sys.byteorder, signed=False)
-                        return int.from_bytes(b, byteorder=sys.byteorder, signed=True)
-
-                    # Get device name to use below
-                    device_name = [item for item in self.hardware_dict if \
-                    self.hardware_dict[item]['ip_address'] == decoded_message["IPAddress"]][0]
-
-                    # Decoded our PayloadSamples message and create list of sequences
-                    sequence = []
-                    i = -1
-                    for reading in decoded_message['PayLoadSamples']:
-                        i = i + 1
-                        ch = i % 8
-
-                        daq_conv_scale = self.scales[str(decoded_message["IPAddress"])]['daq_scale'][str(ch)]
-                        daq_valu_scale = self.scales[str(decoded_message["IPAddress"])]['value_scale'][str(ch)]
-                        conv_reading = (daq_conv_scale * float(twos(reading) / 32768)) * daq_valu_scale
-
-                        channel_name = [item for item in self.stripchart_setup_dict if \
-                        self.stripchart_setup_dict[item]['channel'] == ch and \
-                        self.stripchart_setup_dict[item]['strip_chart'] == device_name][0]
-
-                        line = "%s value=%f" % (channel_name,conv_reading)
-                        sequence.append(line)
-
-                        if print_data:
-                            print("Device %s, Reading %03d, Channel %s: %0.2f" % \
-                                 (str(decoded_message["IPAddress"]),i, ch,conv_reading))
-
-                    decoded_messages = sequence
-
+            for data, addr in batch:
+                if not decode:
+                    messages.append([addr,bytes(data)])
+                elif data_type == "DQAdcData":
+                    messages.append(self.decode_adc_message(addr, data, print_data=print_data, copy=True))
                 elif data_type == "DQResponse":
-                    # data: b'\x18(q!\x05\x00\x00\x00\x00\x00\x00\x00\x0c\x00\x00\x00srate 1000\r\x00'
-
-                    unpacked = struct.unpack_from("@IIIIs", message[1])
-                    # print(unpacked)
-                    if unpacked[0] != 0x21712818:
-                        raise Exception("Response TYPE does not match expected for DQResponse!") 
-                    decoded_message['GroupID'] = unpacked[1]
-                    decoded_message['Order'] = unpacked[2]
-                    decoded_message['PayLoadLength'] = unpacked[3]
-                    payload_char = [x for ind, x in enumerate(message[1]) if ind >= 16]
-                    if len(payload_char) != decoded_message['PayLoadLength']:
-                        raise Exception("Decoded char length does not match expected PayLoadLength!") 
-                    payload = "".join(map(chr,payload_char))
-                    decoded_message['PayLoad'] = payload.rstrip('\x00').rstrip('\n').rstrip('\r')
-                    decoded_messages.append(decoded_message)
-
-            return decoded_messages
-
+                    messages.append(self.decode_response_message(addr, data))
+
+            if expected_count:
+                if len(messages) >= expected_count:
+                    break 
+
+        return messages
+
+    # Formats a decoded DQAdcData message as "<channel> value=<reading>" lines for the text log, with
+    #  " time_ns=<timestamp>" added when the message carries sample timestamps
+    def format_adc_lines(self, decoded_message):
+        channel_names = self.routes[decoded_message["IPAddress"]]['channel_names']
+        slots = len(channel_names)
+        first_slot = decoded_message['FirstSlot']
+        if 'Timestamps' in decoded_message:
+            return ["%s value=%f time_ns=%d" % (channel_names[(first_slot + i) % slots], value, timestamp) \
+                    for i, (value, timestamp) in enumerate(zip(decoded_message['Values'].tolist(),
+                                                               decoded_message['Timestamps'].tolist()))]
+        return ["%s value=%f" % (channel_names[(first_slot + i) % slots], value) \
+                for i, value in enumerate(decoded_message['Values'].tolist())]
+
+    # Parses the text of a discovery reply into a dictionary
+    def parse_discovery_reply(self, data):
+        # https://www.dataq.com/resources/pdfs/misc/Dataq-Instruments-Protocol.pdf, page 12
+        decoded_message = parse_discovery_reply(data)
+        if decoded_message is None:
+            raise Exception("Not a DataQ discovery reply: %s" % data)
+        return decoded_message
+
+    # Do a UDP broadcast to our local network to see what networked DataQ devices we have. Returns as soon as
+    #  every unit in hardware_dict has answered (by IP, and by serial_number where one is given), or after
+    #  timeout seconds. interfaces adds more networks to broadcast on, 'all' or a list of names or IPs, see
+    #  dataq_discovery.select_interfaces. With a DiscoveryCache, a recent enough answer from every unit saves
+    #  broadcasting at all. Returns the replies keyed by IP, also kept in self.discovered.
+    def do_udp_discovery(self, timeout=3, interfaces=None, cache=None):
+        expected_ips = [chart[1]['ip_address'] for chart in self.strip_charts]
+        expected_serials = [chart[1]['serial_number'] for chart in self.strip_charts if 'serial_number' in chart[1]]
+
+        discovered = cache.get(expected_ips, expected_serials) if cache is not None else None
+        if discovered is not None:
+            print("Using cached discovery of %s" % ", ".join(sorted(discovered)))
         else:
-            return messages
-
-
-    # Do a UDP broadcast to our local network to see what networked DataQ devices we have
-    def do_udp_discovery(self):
-        msg = b'dataq_instruments'
-        print("Sending UDP Broadcast '%s' on IP %s" % (msg.decode(), self.ip_address))
-        self.disc_sock.sendto(msg, ("255.255.255.255", 1235))     # Device's discovery receiving port
-
-        # This may be a good candidate for python multiprocessing for receiving UDP on a socket in the future
-        messages = []
-        while True:
-            self.rec_sock.settimeout(3)          # Set timeout to 0.5 second, will break out of our try below
+            # Our own interface through the usual sockets, replies come back to rec_sock. Any other interface
+            #  gets a socket of its own on port 1234 for the time being.
+            host_ip = self.disc_sock.getsockname()[0]
+            channels = [(self.disc_sock, self.rec_sock, self.broadcast_address, host_ip)]
+            for name, ip_address, broadcast_address in select_interfaces(interfaces) if interfaces else []:
+                if ip_address == host_ip:
+                    continue
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                sock.bind((ip_address, 1234))
+                channels.append((sock, sock, broadcast_address, name))
+
+            print("Sending UDP Broadcast '%s' on %s" % (DISCOVERY_MESSAGE.decode(),
+                                                        ", ".join("%s (%s)" % (c[3], c[2]) for c in channels)))
             try:
-                data, addr = self.rec_sock.recvfrom(self.socket_buffer_size)
-                messages.append([addr,data])
-            except:
-                break
-
-        # Go through the responses we received in response to our broadcast and parse
-        decoded_messages = []
-        self.connected_count = 0
-
-        print (messages)
-
-        for message in messages:
-            data = message[1].decode()
-
-            # https://www.dataq.com/resources/pdfs/misc/Dataq-Instruments-Protocol.pdf, page 12
-            re_string = "(\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3}) " + \
-                        "(\w{2}:\w{2}:\w{2}:\w{2}:\w{2}:\w{2}) " + \
-                        "(\w*) (\w*) (\w*) (\w*) (\w*) (\w*) (\w*) (\w*) (\w*) (\w*)"
-            result = re.search(re_string, data)
-            message_contents = ['IP', 'MAC', 'SoftwareRev', 'DeviceModel', 'ADCRunning', 'Reserved', 
-                                'LengthOfDescription', 'Description', 'SerialNumber', 'GroupID', 'OrderInGroup', 'Master/Slave']
-
-            decoded_message = {}
-            i = 0
-            for content in message_contents:
-                i = i + 1
-                decoded_message[content] = result.group(i)
-
-            decoded_messages.append(decoded_message)
-
-            self.connected_count = self.connected_count + 1
-
+                discovered = discover(channels, timeout, expected_ips, expected_serials)
+            finally:
+                for channel in channels[1:]:
+                    channel[0].close()
+            if cache is not None:
+                cache.update(discovered)
+
+        self.discovered = discovered    # Discovery reply of every unit that answered, keyed by IP
+        self.connected_count = len(discovered)
+        for decoded_message in discovered.values():
             print("Found DataQ device %s on IP %s" % (decoded_message['DeviceModel'], decoded_message['IP']))
-            for message in decoded_message:
-                print("   " + message + ": " + decoded_message[message])
+            for field in decoded_message:
+                print("   %s: %s" % (field, decoded_message[field]))
 
         # Verify we find all expected DataQ devices on the local network
-        all_found = True
         for chart in self.strip_charts:
-            ip_found = False
-            for message in decoded_messages:
-                if chart[1]['ip_address'] == message['IP']:
-                    ip_found = True
-            if not ip_found:
-                all_found = False
+            if chart[1]['ip_address'] not in discovered:
+                print("DataQ device %s expected on IP %s did not answer!" % (chart[0], chart[1]['ip_address']))
+        return discovered
 
     # Connect all DataQ devices to this computer
     def connect_devices(self):
         # broadcast new GroupID and connect command to all devices
         msg = self.pack_command(groupid=self.new_group_id,command='Connect',payload=self.ip_address)
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
+        self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
 
-        for message in self.read_messages(expected_count=2):
+        for message in self.read_messages(expected_count=len(self.strip_charts)):
             if message['GroupID'] == self.new_group_id and message['PayLoad'] == 'connected':
                 print("DataQ device on %s has been set to group %s: %s" % \
                       (message['IPAddress'],message['GroupID'],message['PayLoad']))
             else:
                 raise Exception("DataQ unit on %s has not connected as expected" % message['IPAddress'])
                 # Unit will not connect if it is connected to some other unit
-        time.sleep(2)
 
         # If any enabled device is not issued a KeepAlive command for more than 8 seconds it will drop its session 
         # and GroupID, and fall back to an idle state. This command does not generate a response. 
@@ -288,8 +336,8 @@ class DataQDI4370Ethernet:
 
         # Ok so this works but the "ethernet-specific" command does not
         msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="keepalive 0")
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
-        got = self.read_messages(expected_count=2)
+        self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+        got = self.read_messages(expected_count=len(self.strip_charts))
         # print(str(got))
         if not got:
             msg = "Connect to DATAQ units has failed. If the units have previously been connected " + \
@@ -302,8 +350,8 @@ class DataQDI4370Ethernet:
     def get_info(self):
         # Send a basic Info command and verify it works
         msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="info 1")
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
-        for message in self.read_messages(expected_count=2):
+        self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+        for message in self.read_messages(expected_count=len(self.strip_charts)):
             print(str(message))
 
     # Sets and verifies time on units
@@ -314,13 +362,13 @@ class DataQDI4370Ethernet:
         hms_string = "hms %02d:%02d:%02d" % (current_utc_time.hour,current_utc_time.minute,current_utc_time.second)
 
         msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload=hms_string)
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
-        for message in self.read_messages(expected_count=2):
+        self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+        for message in self.read_messages(expected_count=len(self.strip_charts)):
             print(str(message))
 
         msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload=ymd_string)
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
-        for message in self.read_messages(expected_count=2):
+        self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+        for message in self.read_messages(expected_count=len(self.strip_charts)):
             print(str(message))
 
         for message in self.read_messages():
@@ -346,88 +394,35 @@ class DataQDI4370Ethernet:
     # Set EOL for ASCII if used
     def set_ascii_eol(self):
         # Set EOL character if we use ASCII mode
-        msg = self.pack_command(groupid=self.new_group_id,command=ethernet_commands['Shared'],payload="eol 1")
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
+        msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="eol 1")
+        self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
         for message in self.read_messages():
             print(str(message))
 
-    # Sequence for doing bulk of setup for units
-    def send_setup_commands(self, dec=1, deca=1, sample_rate=1000, packet_size=16, encoding='binary'):
-        # Hertz, how often to sample each channel (Samples/second/channel - 'S/s/channel')
-        self.sample_rate = sample_rate
-        self.packet_size = packet_size
-
-        # Map packet size to commandable parameter for Data-Q units
-        dataq_packet_dict = {16: 0,     # ps 0 - Make packet size 16 bytes (DEFAULT)
-                             32: 1,     # ps 1 - Make packet size 32 bytes
-                             64: 2,     # ps 2 - Make packet size 64 bytes
-                             128: 3,    # ps 3 - Make packet size 128 bytes
-                             256: 4,    # ps 4 - Make packet size 256 bytes
-                             512: 5,    # ps 5 - Make packet size 512 bytes
-                             1024: 6,   # ps 6 - Make packet size 1024 bytes
-                             2048: 7}   # ps 7 - Make packet size 2048 bytes
-
-
-        # Set the encoded to 0 (binary), could also be 1 (for ASCII)
-        if 'ascii' in encoding:
-            msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="encode 1")
-            self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
-            for message in self.read_messages(expected_count=2):
-                print(str(message))
-            self.set_ascii_eol()
-        else:
-            msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="encode 0")
-            self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
-            for message in self.read_messages(expected_count=2):
-                print(str(message))
-
-        # Set rate stuff
-        msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="dec %s" % dec)
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
-        for message in self.read_messages(expected_count=2, timeout=5):
-            print(str(message))
-
-        msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="deca %s" % deca)
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
-        for message in self.read_messages(expected_count=2, timeout=5):
-            print(str(message))
-
-        self.read_messages()  # Clear out any messages
-
-        # Command srate defines the value of a sample rate divisor used to determine scan rate
-        srate = int(60000000 / self.sample_rate / dec / deca)
-        print("Computed srate: %s" % srate)
-
-        if srate > 65535:
-            msg = "Srate is too large for DI-4730 unit!"
-            raise Exception(msg)
-        elif srate < 375:
-            msg = "Srate is too small for DI-4730 unit!"
-            raise Exception(msg) 
-
-        # Set calculated srate
-        msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="srate %s" % srate)
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
-        for message in self.read_messages(expected_count=2):
-            print(str(message))
-
-        # Create list of slist commands to send
+    # Builds the slist commands for every unit, keyed by device name
+    def compile_scan_lists(self):
+        # Create list of slist commands to send. At the same time compile the routing table the decoder
+        #  uses for each unit: IP -> device, scan list position -> (channel name, fused scale)
         self.scales = {}
+        self.routes = {}
+        self.packet_scales = {}
         slist_config = {}
         for chart in self.strip_charts:
             slists = []
+            slots = []
             slist_i = -1
 
             daq_scale = {}
             conversion_scales = {}
             for ch in range(0,8):
-                for info in stripcharts_info:
-                    if stripcharts_info[info]['strip_chart'] == chart[0] and stripcharts_info[info]['channel'] == ch:
+                for info in self.stripchart_setup_dict:
+                    if self.stripchart_setup_dict[info]['strip_chart'] == chart[0] and \
+                       self.stripchart_setup_dict[info]['channel'] == ch:
                         slist_i = slist_i + 1
 
-                        daq_scale[str(ch)] = stripcharts_info[info]['daq_scale']
-                        conversion_scales[str(ch)] = stripcharts_info[info]['value_scale']
-                        scale = stripcharts_info[info]['daq_scale']
+                        daq_scale[str(ch)] = self.stripchart_setup_dict[info]['daq_scale']
+                        conversion_scales[str(ch)] = self.stripchart_setup_dict[info]['value_scale']
+                        scale = self.stripchart_setup_dict[info]['daq_scale']
 
                         if scale == 1000:
                             range_table = 0b0000
@@ -443,14 +438,123 @@ class DataQDI4370Ethernet:
                         scan_list_definition = ch + (range_table << 8)
                         slist = "slist %s %s" % (slist_i, scan_list_definition)
                         slists.append(slist)
+                        slots.append((info, daq_scale[str(ch)] * conversion_scales[str(ch)] / 32768))
 
-            self.scales[self.hardware_dict[chart[0]]['ip_address']] = {'daq_scale': daq_scale,
+            self.scales[chart[1]['ip_address']] = {'daq_scale': daq_scale,
                                 'value_scale': conversion_scales,}
+            self.routes[chart[1]['ip_address']] = {'device': chart[0],
+                                                   'slots': slots,
+                                                   'channel_names': [slot[0] for slot in slots],
+                                                   'scale': np.array([slot[1] for slot in slots], dtype=np.float64)}
             slist_config[str(chart[0])] = slists
 
+        return slist_config
+
+    # Sets up the sample clock of every unit for the scan rate and scan lists just configured
+    def configure_sample_clock(self, srate, dec=1, deca=1):
+        for ip_address in self.routes:
+            self.sample_clock.configure(ip_address, srate, dec=dec, deca=deca,
+                                        scan_length=len(self.routes[ip_address]['slots']),
+                                        device=self.routes[ip_address]['device'])
+
+    # Packet size of every unit, keyed by IP. packet_size is one of DATAQ_PACKET_SIZES for all units, or
+    #  'auto' to fit each unit's packets to packet_latency_ms at the scan rate srate gives and its scan list
+    #  length. Needs the routes from compile_scan_lists. Also sizes the receive buffers for the largest packet.
+    def choose_packet_sizes(self, packet_size, srate, dec=1, deca=1):
+        scan_rate = 60000000 / (srate * dec * deca)
+        if packet_size == 'auto':
+            packet_sizes = {ip_address: choose_packet_size(scan_rate, len(self.routes[ip_address]['slots']),
+                                                           self.packet_latency_ms)
+                            for ip_address in self.routes}
+        elif packet_size in DATAQ_PACKET_SIZES:
+            packet_sizes = {ip_address: packet_size for ip_address in self.routes}
+        else:
+            raise Exception("Packet size %s is not 'auto' or one of %s!" % (packet_size, list(DATAQ_PACKET_SIZES)))
+
+        self.packet_rates = {}
+        for ip_address, size in packet_sizes.items():
+            duration = packet_duration_ms(size, scan_rate, len(self.routes[ip_address]['slots']))
+            self.packet_rates[ip_address] = 1000 / duration
+            print("Packet size for %s: %d bytes, %0.1f ms of data, %0.0f packets/s" % \
+                  (ip_address, size, duration, 1000 / duration))
+
+        self.packet_sizes = packet_sizes
+        self.packet_size = max(packet_sizes.values())
+        self.socket_buffer_size = max(ADC_HEADER_SIZE + self.packet_size, MIN_RECEIVE_BUFFER_SIZE)
+        if self.receiver.pool.size != self.socket_buffer_size:
+            self.receiver.pool = DatagramBufferPool(count=self.receiver.pool.count, size=self.socket_buffer_size)
+
+        # Room in the kernel for receive_headroom_seconds of every unit's packets
+        requested, granted = size_receive_buffer(self.rec_sock, sum(self.packet_rates.values()),
+                                                 ADC_HEADER_SIZE + self.packet_size, self.receive_headroom_seconds)
+        self.requested_receive_buffer = requested
+        print("Receive buffer %d KB for %0.1f s of data%s" % \
+              (granted // 1024, self.receive_headroom_seconds,
+               "" if granted >= requested else ", asked for %d KB, raise net.core.rmem_max" % (requested // 1024)))
+        return packet_sizes
+
+    # Command srate defines the value of a sample rate divisor used to determine scan rate
+    def compute_srate(self, sample_rate, dec=1, deca=1):
+        srate = int(60000000 / sample_rate / dec / deca)
+        print("Computed srate: %s" % srate)
+
+        if srate > 65535:
+            msg = "Srate is too large for DI-4730 unit!"
+            raise Exception(msg)
+        elif srate < 375:
+            msg = "Srate is too small for DI-4730 unit!"
+            raise Exception(msg) 
+        return srate
+
+    # Sequence for doing bulk of setup for units
+    # packet_size is in bytes, or 'auto', see choose_packet_sizes
+    def send_setup_commands(self, dec=1, deca=1, sample_rate=1000, packet_size='auto', encoding='binary'):
+        # Hertz, how often to sample each channel (Samples/second/channel - 'S/s/channel')
+        self.sample_rate = sample_rate
+        self.dec = dec
+        self.deca = deca
+
+        # Set the encoded to 0 (binary), could also be 1 (for ASCII)
+        if 'ascii' in encoding:
+            msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="encode 1")
+            self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+            for message in self.read_messages(expected_count=len(self.strip_charts)):
+                print(str(message))
+            self.set_ascii_eol()
+        else:
+            msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="encode 0")
+            self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+            for message in self.read_messages(expected_count=len(self.strip_charts)):
+                print(str(message))
+
+        # Set rate stuff
+        msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="dec %s" % dec)
+        self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+        for message in self.read_messages(expected_count=len(self.strip_charts), timeout=5):
+            print(str(message))
+
+        msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="deca %s" % deca)
+        self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+        for message in self.read_messages(expected_count=len(self.strip_charts), timeout=5):
+            print(str(message))
+
+        self.read_messages(timeout=0)  # Clear out any messages already here
+
+        srate = self.compute_srate(self.sample_rate, dec, deca)
+
+        # Set calculated srate
+        msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="srate %s" % srate)
+        self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+        for message in self.read_messages(expected_count=len(self.strip_charts)):
+            print(str(message))
+
+        slist_config = self.compile_scan_lists()
+        self.configure_sample_clock(srate, dec, deca)
+
         # Send slist commands to units
+        # A unit that answered discovery is reachable, only ping the ones we haven't heard from
         for chart in self.strip_charts:
-            if ping(chart[1]['ip_address']):
+            if chart[1]['ip_address'] in getattr(self, 'discovered', {}) or _ping(chart[1]['ip_address']):
                 for slist in slist_config[chart[0]]:
                     msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload=slist)
 
@@ -460,154 +564,154 @@ class DataQDI4370Ethernet:
                     for message in self.read_messages(expected_count=1):
                         print(str(message))
 
-        # Set packet size
-        msg = self.pack_command(groupid=self.new_group_id,command='Shared', \
-                                payload="ps %s" % dataq_packet_dict[packet_size])
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
-        for message in self.read_messages(expected_count=2):
-            print(str(message))
+        # Set packet size, one broadcast if every unit gets the same one
+        packet_sizes = self.choose_packet_sizes(packet_size, srate, dec, deca)
+        if len(set(packet_sizes.values())) == 1:
+            msg = self.pack_command(groupid=self.new_group_id,command='Shared', \
+                                    payload="ps %s" % DATAQ_PACKET_SIZES[self.packet_size])
+            self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+            for message in self.read_messages(expected_count=len(self.strip_charts)):
+                print(str(message))
+        else:
+            for ip_address, size in packet_sizes.items():
+                msg = self.pack_command(groupid=self.new_group_id,command='Shared', \
+                                        payload="ps %s" % DATAQ_PACKET_SIZES[size])
+                self.disc_sock.sendto(msg, (ip_address, 51235))     # Device's command receiving port
+                for message in self.read_messages(expected_count=1):
+                    print(str(message))
+
+    # Points a unit's status/data stream at another port on this computer (the PORT command), so units can be
+    #  received on separate sockets. Returns the unit's response, None if it sent it to the new port instead.
+    #  Don't wait for the response (confirm=False) while the unit may still be streaming to us.
+    def set_data_port(self, ip_address, port=1234, confirm=True):
+        msg = self.pack_command(groupid=self.new_group_id,command='Shared',payload="port %d" % port)
+        self.disc_sock.sendto(msg, (ip_address, 51235))     # Device's command receiving port
+        if not confirm:
+            return None
+        messages = self.read_messages(expected_count=1, timeout=1)
+        return messages[0] if messages else None
 
     # Send syncstart and keepalive commands to actualy start DAQ running
     def start(self):
 
         # SyncStart is necessary to start DAQ running on ethernet, also Keep Alive
         msg = self.pack_command(groupid=self.new_group_id,command='SyncStart')
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
+        self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+        self.sample_clock.anchor(time.time_ns())  # Sample 0 of every unit is scanned now
 
         msg = self.pack_command(groupid=self.new_group_id,command='KeepAlive')
-        self.disc_sock.sendto(msg, ("255.255.255.255", 51235))     # Device's command receiving port
-
-
-
-# Demonstration of how to use this class if it is run as main
+        self.disc_sock.sendto(msg, (self.broadcast_address, 51235))     # Device's command receiving port
+
+    # Close our sockets, e.g. to set up a new instance in the same process
+    def close(self):
+        self.disc_sock.close()
+        self.rec_sock.close()
+
+    # Snapshot of the data path's health: per unit packets, samples, gaps and samples lost, decode and
+    #  receive-to-write latency, timeouts and exceptions, kernel drops, plus how well receives are batching
+    def stats(self):
+        if self.rec_sock.fileno() != -1:
+            self.telemetry.update_socket('rec_sock', self.receiver.kernel_drops, receive_buffer_size(self.rec_sock),
+                                         self.requested_receive_buffer)
+        stats = self.telemetry.stats()
+        stats['receiver'] = {'wakeups': self.receiver.wakeups,
+                             'datagrams': self.receiver.datagrams}
+        return stats
+
+
+# Demonstration of how to use this class if it is run as main. dataq_runner.AcquisitionRunner does the work,
+#  this adds command line options on top of the config file and 'x' to quit.
 if __name__ == "__main__":
-    import logging
-    from logging.handlers import TimedRotatingFileHandler
+    import argparse
+    import threading
+
+    from dataq_runner import AcquisitionRunner, RUNNER_SETTINGS, load_config
 
     # Add command line arguments
     ap = argparse.ArgumentParser()
+    ap.add_argument("--config", required=False,
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataq_example_config.json'),
+                    type=str, help="JSON (or YAML) file with the hardware and strip chart channels, see dataq_runner.py")
+    ap.add_argument("-r", "--sample-rate", required=False, default=None, type=int,
+                    help="samples/s per channel, instead of the config's")
+    ap.add_argument("-d", "--duration", required=False, default=None, type=float,
+                    help="stop after this many seconds")
     ap.add_argument("-log", "--log-name", required=False, default='example_log/example.log', type=str, 
                     help="log file to log to")
+    ap.add_argument("-a", "--async-setup", required=False, action='store_true',
+                    help="connect and set up all units concurrently with the asyncio command client")
+    ap.add_argument("-c", "--config-cache", required=False, default='dataq_config_cache.json', type=str,
+                    help="with --async-setup, file remembering each unit's applied settings between runs")
+    ap.add_argument("-p", "--packet-size", required=False, default='auto',
+                    choices=['auto'] + [str(size) for size in DATAQ_PACKET_SIZES],
+                    help="bytes of samples per packet, 'auto' to fit each unit's packets to --packet-latency")
+    ap.add_argument("--packet-latency", required=False, default=PACKET_LATENCY_MS, type=float,
+                    help="with --packet-size auto, milliseconds of data a packet may hold at most")
+    ap.add_argument("--discovery-timeout", required=False, default=3, type=float,
+                    help="longest to wait for discovery replies, it ends early once every unit has answered")
+    ap.add_argument("--discovery-cache", required=False, default=None, type=str,
+                    help="file remembering discovery replies, skip the broadcast if every unit was seen recently")
+    ap.add_argument("--discovery-ttl", required=False, default=60, type=float,
+                    help="seconds a cached discovery reply is good for")
+    ap.add_argument("-i", "--interfaces", required=False, default=None, type=str,
+                    help="also broadcast discovery on these interfaces, 'all' or comma separated names or IPs")
+    ap.add_argument("-s", "--store", required=False, default='text', choices=['text', 'columnar', 'raw'],
+                    help="text log, binary columnar log, or compressed raw count archive, with one directory per "
+                         "unit under --store-dir")
+    ap.add_argument("--store-dir", required=False, default='example_log/columnar', type=str,
+                    help="directory for the columnar log or raw archive")
+    ap.add_argument("--archive-codec", required=False, default='zlib', choices=['zlib', 'lzma', 'zstd'],
+                    help="compression of the raw archive, zstd needs the zstandard package")
+    ap.add_argument("--retention-days", required=False, default=30, type=int,
+                    help="days of columnar log to keep")
+    ap.add_argument("--aggregate", required=False, action='store_true',
+                    help="also keep min/max/mean per 10 ms, 1 s and 1 min for plotting, next to the columnar log")
+    ap.add_argument("-w", "--writer-policy", required=False, default='block', choices=['block', 'drop', 'spill'],
+                    help="what to do with new data while the log can't keep up")
+    ap.add_argument("--spill-dir", required=False, default='example_log/spill', type=str,
+                    help="where the 'spill' writer policy parks data until the log catches up")
+    ap.add_argument("-e", "--export-url", required=False, default=None, type=str,
+                    help="also export to a line protocol endpoint, e.g. http://localhost:8086/api/v2/write?org=o&bucket=b")
+    ap.add_argument("--export-token", required=False, default=None, type=str,
+                    help="token sent as 'Authorization: Token <token>' to the export endpoint")
+    ap.add_argument("--export-gzip", required=False, action='store_true', help="gzip exported batches")
+    ap.add_argument("--simulate", required=False, action='store_true',
+                    help="run against simulated units on loopback (127.0.0.80/81) instead of the hardware")
+    ap.add_argument("--capture", required=False, default=None, type=str,
+                    help="also record every datagram received to this file, see dataq_simulator.py replay")
+    ap.add_argument("--shards", required=False, default=0, type=int,
+                    help="receive in worker processes, this many units per process on its own data port")
+    ap.add_argument("--live-ring", required=False, action='store_true',
+                    help="publish the latest samples to shared memory for local readers, see dataq_shm.py")
+    ap.add_argument("-t", "--stats-port", required=False, default=None, type=int,
+                    help="serve telemetry on http://127.0.0.1:<port>/ (summary), /stats (JSON) and /metrics")
     args = vars(ap.parse_args())
 
-    # This maps the IP address of the units to a name used below to configure individual channels
-    hardware_info = {'Strip_Chart_1': {'ip_address': '192.168.0.80',}, 
-                     'Strip_Chart_2': {'ip_address': '192.168.0.81',},}
-
-    # This specifies which channels to setup and how to set them up
-    stripcharts_info = {'Example_Channel_Name_01': {'channel': 6, 'strip_chart': 'Strip_Chart_2', 
-                                                    'daq_scale': 1, 'value_scale': 1000}, 
-                        'Example_Channel_Name_02': {'channel': 7, 'strip_chart': 'Strip_Chart_2', 
-                                                    'daq_scale': 1000, 'value_scale': 1}, 
-                        'Example_Channel_Name_03': {'channel': 5, 'strip_chart': 'Strip_Chart_1', 
-                                                    'daq_scale': 1, 'value_scale': 1000}, 
-                        'Example_Channel_Name_04': {'channel': 4, 'strip_chart': 'Strip_Chart_1', 
-                                                    'daq_scale': 1000, 'value_scale': 1}, 
-                        'Example_Channel_Name_05': {'channel': 7, 'strip_chart': 'Strip_Chart_1', 
-                                                    'daq_scale': 1, 'value_scale': 1000}, 
-                        'Example_Channel_Name_06': {'channel': 6, 'strip_chart': 'Strip_Chart_1', 
-                                                    'daq_scale': 1000, 'value_scale': 1}, 
-                        'Example_Channel_Name_07': {'channel': 1, 'strip_chart': 'Strip_Chart_2', 
-                                                    'daq_scale': 0.1, 'value_scale': 1000}, 
-                        'Example_Channel_Name_08': {'channel': 0, 'strip_chart': 'Strip_Chart_2', 
-                                                    'daq_scale': 1000, 'value_scale': 1}, 
-                        'Example_Channel_Name_09': {'channel': 3, 'strip_chart': 'Strip_Chart_2', 
-                                                    'daq_scale': 1, 'value_scale': 1000}, 
-                        'Example_Channel_Name_10': {'channel': 2, 'strip_chart': 'Strip_Chart_2', 
-                                                    'daq_scale': 1000, 'value_scale': 1}, 
-                        'Example_Channel_Name_11': {'channel': 4, 'strip_chart': 'Strip_Chart_2', 
-                                                    'daq_scale': 1, 'value_scale': 1000}, 
-                        'Example_Channel_Name_12': {'channel': 5, 'strip_chart': 'Strip_Chart_2', 
-                                                    'daq_scale': 100, 'value_scale': 1}, 
-                        'Example_Channel_Name_13': {'channel': 1, 'strip_chart': 'Strip_Chart_1', 
-                                                    'daq_scale': 0.1, 'value_scale': 10000}, 
-                        'Example_Channel_Name_14': {'channel': 0, 'strip_chart': 'Strip_Chart_1', 
-                                                    'daq_scale': 100, 'value_scale': 1}, 
-                        'Example_Channel_Name_15': {'channel': 3, 'strip_chart': 'Strip_Chart_1', 
-                                                    'daq_scale': 1, 'value_scale': 1000}, 
-                        'Example_Channel_Name_16': {'channel': 2, 'strip_chart': 'Strip_Chart_1', 
-                                                    'daq_scale': 100, 'value_scale': 1}}
-
-    # Initialize the class
-    #print ("stripcharts_info=", stripcharts_info)
-    dataq = DataQDI4370Ethernet(hardware_dict=hardware_info,
-                                 stripchart_setup_dict=stripcharts_info)
-
-    # Add an event handler to run stop_devices function if script is killed
-    def handler(signum, frame):
-        try:
-            dataq.stop_devices()
-        except:
-            pass     # Want to continue to exit if this logic fails
-        exit(1)
-    
-    # Setup a handler for all signals
-    for i in [x for x in dir(signal) if x.startswith("SIG")]:
-      try:
-        signum = getattr(signal,i)
-        signal.signal(signum,handler)
-      except:
-        pass
-
-    def create_timed_rotating_log(path):
-        """"""
-        logger = logging.getLogger("Rotating Log")
-        logger.setLevel(logging.INFO)
-        
-        # Will log to a rotating file for 1 minute, then pinch off up to 5 logs
-        handler = logging.handlers.TimedRotatingFileHandler(path, when="m", interval=1, backupCount=5)
-        logger.addHandler(handler)
-        return logger
-        
-    log = create_timed_rotating_log(args['log_name'])
-
-    # Writes to log, creates appropriate nanosecond timestamp
-    def write_to_log(sequence, duration, logger):
-        stop_time = time.time_ns()
-        start_time = time.time_ns()-(duration * (10**9))
-
-        time_sequence = np.linspace(start_time, stop_time, len(sequence))
-        time_sequence = time_sequence.astype(np.int64)
-        time_sequence = time_sequence.tolist()
-
-        send_sequence = []
-        for i in range(0,len(sequence)):
-            send_sequence.append(sequence[i] + " time_ns=" + str(time_sequence[i]))
-
-        logger.info("\n".join(str(item) for item in send_sequence))
-
-    # IF ADC is running, attempt to stop here, wait for disconnect to complete
-    dataq.stop_devices()
-    time.sleep(2)
-
-    dataq.read_messages()  # Clear out any messages
-    dataq.do_udp_discovery()
-    dataq.connect_devices()
-    dataq.send_setup_commands()
-    dataq.start()
-
-    print("Getting data... (press X to quit)")
-
-    # Just read back any information received 
-    init_time = time.time()
-    sequences = []
-    while(True):
-        try:
-            if keyboard.is_pressed('x' or 'X'):
-                dataq.stop_devices()
-                print("Bye!")
-                break
-            else:    
-                sequences = sequences + dataq.read_messages(print_data=False, data_type='DQAdcData', \
-                                    timeout=30,decode=True, expected_count=1)
-        except:
-            pass
-
-        if len(sequences) > dataq.sample_rate * 8:
-            duration = time.time() - init_time
-            # print(duration)
-            # print("%0.2f S/s/Channel" % (len(sequences) / duration / dataq.connected_count / 8))
-            init_time = time.time()
-
-            write_to_log(sequences, duration, logger=log)
-            sequences = []
+    # The config file maps the IP address of the units to a name, and says which channels to set up and how.
+    #  Command line options given override its settings.
+    hardware_info, stripcharts_info, settings = load_config(args['config'])
+    settings.update({key: value for key, value in args.items()
+                     if key in RUNNER_SETTINGS and value != ap.get_default(key)})
+    runner = AcquisitionRunner(hardware_info, stripcharts_info, settings)
+
+    # 'x' quits if the keyboard package is installed (and we may use it), checked on a thread of its own
+    #  so acquisition never waits on it. Ctrl+C or SIGTERM stop cleanly either way.
+    try:
+        import keyboard
+
+        def watch_keyboard():
+            while not runner.stop_event.wait(0.1):
+                try:
+                    pressed = keyboard.is_pressed('x')
+                except Exception as e:
+                    print("Can't read the keyboard (%s), press Ctrl+C to quit" % e)
+                    return
+                if pressed:
+                    runner.stop_event.set()
+        threading.Thread(target=watch_keyboard, name="keyboard", daemon=True).start()
+        print("Getting data... (press X to quit)")
+    except ImportError:
+        print("Getting data... (press Ctrl+C to quit)")
+
+    runner.run(args['duration'])
+    print("Bye!")
@@ -0,0 +1,207 @@
+import threading
+import time
+import numpy as np
+
+
+# Fixed size ring of decoded readings for one unit. There is exactly one writer (the receiver thread)
+# and one reader (the consumer), so no lock is needed: the writer only ever moves write_total forward
+# and the reader only ever moves read_total forward. The writer never waits on the reader, if the reader
+# falls more than a full ring behind, the oldest samples are overwritten and counted as an overrun.
+# Blocks never run across a gap in the sample numbers, so the consumer can label every sample in a block
+#  from the first one's scan list slot. A block cut short by a gap, or starting mid scan after one, ends on
+#  a scan boundary (of scan_length samples) so the blocks after it hold whole scans again.
+class DeviceRingBuffer:
+    def __init__(self, capacity, block_size, scan_length=1):
+        if capacity < block_size:
+            raise Exception("Ring buffer capacity must hold at least one block!")
+
+        self.capacity = capacity
+        self.block_size = block_size
+        self.scan_length = scan_length
+
+        # Preallocated once, the receiver only copies into these
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.counts = np.zeros(capacity, dtype=np.int16)            # The raw counts the readings were scaled from
+        self.sample_numbers = np.zeros(capacity, dtype=np.int64)    # Unwrapped CumulativeCount of every sample
+        self.received_ns = np.zeros(capacity, dtype=np.int64)       # When the packet holding each sample arrived
+
+        self.write_total = 0    # Samples ever written
+        self.write_claimed = 0  # Where the write in progress will end, moved forward before the copy starts
+        self.read_total = 0     # Samples ever handed to the consumer
+
+        # Consumer health, read these to see if the consumer is keeping up
+        self.overruns = 0
+        self.lost_samples = 0
+
+    # Samples written but not yet read
+    def fill(self):
+        return min(self.write_total - self.read_total, self.capacity)
+
+    # Producer side, copy one decoded packet's readings and raw counts in. received_ns (perf_counter_ns) is when
+    #  the packet arrived.
+    def write(self, values, counts, first_sample_number, received_ns=0):
+        count = len(values)
+        if count > self.capacity:   # Only the newest samples would survive anyway
+            values = values[count - self.capacity:]
+            counts = counts[count - self.capacity:]
+            first_sample_number = first_sample_number + count - self.capacity
+            count = self.capacity
+
+        start = self.write_total % self.capacity
+        first = min(count, self.capacity - start)
+        sample_numbers = np.arange(first_sample_number, first_sample_number + count, dtype=np.int64)
+
+        # Claim the slots before touching them, so a reader copying out of them can tell
+        self.write_claimed = self.write_total + count
+        self.values[start:start + first] = values[:first]
+        self.counts[start:start + first] = counts[:first]
+        self.sample_numbers[start:start + first] = sample_numbers[:first]
+        self.received_ns[start:start + first] = received_ns     # For the consumer's receive-to-write latency
+        if first < count:   # Wrap around to the front of the ring
+            self.values[:count - first] = values[first:]
+            self.counts[:count - first] = counts[first:]
+            self.sample_numbers[:count - first] = sample_numbers[first:]
+            self.received_ns[:count - first] = received_ns
+
+        self.write_total = self.write_total + count
+
+    # Skip the reader past anything the writer has already overwritten, in whole blocks
+    def _catch_up(self, write_total):
+        behind = write_total - self.read_total - self.capacity
+        if behind > 0:
+            behind = -(-behind // self.block_size) * self.block_size
+            self.overruns = self.overruns + 1
+            self.lost_samples = self.lost_samples + behind
+            self.read_total = self.read_total + behind
+
+    # Consumer side, returns (sample_numbers, values, counts, completed_ns) for the next complete block, or None if there
+    #  isn't one yet. completed_ns is when the block's last sample arrived. A block is block_size samples
+    #  unless it had to end early at a gap or to get back onto a scan boundary.
+    def read_block(self):
+        while True:
+            write_total = self.write_total
+            self._catch_up(write_total)
+            if write_total - self.read_total < self.block_size:
+                return None
+
+            start = self.read_total % self.capacity
+            index = np.arange(start, start + self.block_size) % self.capacity
+            values = self.values[index]
+            counts = self.counts[index]
+            sample_numbers = self.sample_numbers[index]
+            completed_ns = self.received_ns[index[-1]]
+
+            # If the writer has claimed any of our slots, even if it is still copying into them, the block may
+            #  be torn, try again from the new position
+            if self.write_claimed - self.read_total > self.capacity:
+                self._catch_up(self.write_claimed)
+                continue
+
+            # End at the first gap, then pull the end back to the last whole scan, unless that leaves nothing
+            count = self.block_size
+            gaps = np.flatnonzero(np.diff(sample_numbers) != 1)
+            if len(gaps):
+                count = int(gaps[0]) + 1
+            partial = int(sample_numbers[count - 1] + 1) % self.scan_length
+            if partial < count:
+                count = count - partial
+            if count < self.block_size:
+                values = values[:count]
+                counts = counts[:count]
+                sample_numbers = sample_numbers[:count]
+                completed_ns = self.received_ns[index[count - 1]]
+
+            self.read_total = self.read_total + count
+            return sample_numbers, values, counts, int(completed_ns)
+
+
+# Receiver thread that drains rec_sock as fast as the datagrams arrive and decodes them straight into a
+#  ring buffer per unit, keyed by IP. Nothing in here waits on the consumer.
+class AcquisitionThread(threading.Thread):
+    def __init__(self, dataq, ring_seconds=10, block_seconds=0.1):
+        threading.Thread.__init__(self, name="DataQ receiver", daemon=True)
+        self.dataq = dataq
+        self.stop_event = threading.Event()
+
+        # Size each ring in whole scans so blocks always start on the same scan list position
+        self.rings = {}
+        for ip_address in dataq.routes:
+            scan_length = len(dataq.routes[ip_address]['slots'])
+            block_size = max(1, int(dataq.sample_rate * block_seconds)) * scan_length
+            capacity = max(1, int(ring_seconds / block_seconds)) * block_size
+            self.rings[ip_address] = DeviceRingBuffer(capacity, block_size, scan_length)
+
+        self.packets = 0
+        self.errors = 0
+        self.unknown_packets = 0
+
+        self.publisher = None   # Anything with publish(ip, sample number, values), e.g. dataq_shm.LivePublisher
+
+    def run(self):
+        while not self.stop_event.is_set():
+            # The timeout is only so we notice stop_event while the units are quiet
+            try:
+                batch = self.dataq.receiver.receive(0.5)
+            except OSError:
+                break   # Socket was closed under us
+            if not batch:
+                self.dataq.telemetry.count_timeout('acquisition')    # Units have gone quiet
+                continue
+            received_ns = time.perf_counter_ns()
+            arrivals = self.dataq.receiver.arrival_ns     # Kernel receive times, empty without kernel stats
+            now_ns = time.time_ns() if arrivals else None
+
+            # Decode straight from the receive buffers, only the readings and counts are copied into the rings
+            for index, (data, addr) in enumerate(batch):
+                arrival_ns = arrivals[index] if arrivals else None
+                if arrival_ns is not None:
+                    self.dataq.telemetry.observe('socket_queue', (now_ns - arrival_ns) / 1e9)
+
+                ring = self.rings.get(addr[0])
+                if ring is None:
+                    self.unknown_packets = self.unknown_packets + 1
+                    self.dataq.telemetry.unknown_packets = self.unknown_packets
+                    continue
+
+                try:
+                    decoded_message = self.dataq.decode_adc_message(addr, data, arrival_ns=arrival_ns)
+                except Exception as e:
+                    self.errors = self.errors + 1
+                    self.dataq.telemetry.count_exception('decode', e)
+                    continue
+
+                ring.write(decoded_message['Values'], decoded_message['PayLoadSamples'], decoded_message['SampleNumber'],
+                           received_ns)
+                if self.publisher is not None:
+                    self.publisher.publish(addr[0], decoded_message['SampleNumber'], decoded_message['Values'])
+                self.packets = self.packets + 1
+
+    def stop(self, timeout=2):
+        self.stop_event.set()
+        self.join(timeout)
+
+    # Next complete block for a unit as a message dictionary shaped like the ones read_messages returns, plus
+    #  the sample number, timestamp and raw count of every sample, or None if the unit hasn't filled a block yet.
+    #  Received_ns is the perf_counter_ns() time the packet completing the block was received.
+    def read_block(self, ip_address):
+        block = self.rings[ip_address].read_block()
+        if block is None:
+            return None
+
+        sample_numbers, values, counts, completed_ns = block
+        route = self.dataq.routes[ip_address]
+        return {'IPAddress': ip_address,
+                'Device': route['device'],
+                'SampleNumber': int(sample_numbers[0]),
+                'FirstSlot': int(sample_numbers[0]) % len(route['slots']),
+                'SampleNumbers': sample_numbers,
+                'Timestamps': self.dataq.sample_clock.timestamps(ip_address, sample_numbers),
+                'Values': values,
+                'Counts': counts,
+                'Received_ns': completed_ns}
+
+    # Overrun counters per unit, non-zero means the consumer is falling behind the receiver
+    def overruns(self):
+        return {ip_address: {'overruns': self.rings[ip_address].overruns,
+                             'lost_samples': self.rings[ip_address].lost_samples,
+                             'fill': self.rings[ip_address].fill()} for ip_address in self.rings}
@@ -0,0 +1,321 @@
+import json
+import os
+import struct
+import time
+import datetime
+import numpy as np
+
+from dataq_storage import ColumnarLogReader, DAY_NS, segment_name
+
+
+# *** Min/max/mean aggregation pyramid ***
+# Drawing an hour of a strip chart doesn't need millions of raw points, it needs the min, max and mean of each
+#  pixel column. AggregationPyramid keeps those per channel at several bucket widths (levels), updated as
+#  scans arrive: level 0 is reduced from the new scans, each coarser level from the buckets the level below
+#  just completed, so the work per block only depends on the block. Completed buckets are written next to the
+#  unit's columnar log, one file per level per UTC day:
+#   YYYYMMDD_<level>.dqa   header, then one AGGREGATE record per bucket: bucket start (ns since epoch),
+#                          scan count, then min, max and mean of every channel
+# Buckets start at whole multiples of their width, so every coarser width must be a multiple of the finer ones.
+AGGREGATE_MAGIC = b'DQAGG1\n\0'
+AGGREGATE_LEVELS = [10000000, 1000000000, 60000000000]     # 10 ms, 1 s, 1 min
+
+
+# Short name of a bucket width, e.g. 10ms, 1s, 1min
+def level_name(width_ns):
+    for unit, size in [('min', 60000000000), ('s', 1000000000), ('ms', 1000000), ('us', 1000)]:
+        if width_ns % size == 0:
+            return "%d%s" % (width_ns // size, unit)
+    return "%dns" % width_ns
+
+
+def aggregate_dtype(channel_count, dtype):
+    return np.dtype([('t', '<i8'), ('count', '<i8'), ('min', dtype, (channel_count,)),
+                     ('max', dtype, (channel_count,)), ('mean', dtype, (channel_count,))])
+
+
+# Parses the header at the start of an aggregate file, returns it and its length
+def read_aggregate_header(data):
+    if data[:len(AGGREGATE_MAGIC)] != AGGREGATE_MAGIC:
+        raise Exception("Not a DataQ aggregate file!")
+    header_length = struct.unpack_from('<I', data, len(AGGREGATE_MAGIC))[0]
+    header = json.loads(data[len(AGGREGATE_MAGIC) + 4:len(AGGREGATE_MAGIC) + 4 + header_length])
+    header['dtype'] = np.dtype(header['dtype'])
+    length = len(AGGREGATE_MAGIC) + 4 + header_length
+    return header, length + (-length % 64)
+
+
+# Groups a time ordered run of buckets (or scans, as buckets of one) into buckets width ns wide.
+#  Buckets are (t, count, min, max, sum) arrays, one row per bucket, min/max/sum with a column per channel.
+def reduce_buckets(width, buckets):
+    t, count, mins, maxs, sums = buckets
+    keys = t // width * width
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return (keys[starts], np.add.reduceat(count, starts), np.minimum.reduceat(mins, starts, axis=0),
+            np.maximum.reduceat(maxs, starts, axis=0), np.add.reduceat(sums, starts, axis=0))
+
+
+# Picks the coarsest width that still gives at least one bucket per pixel over t_start..t_end, or None if
+#  even the finest is too coarse and the raw samples are what should be drawn
+def choose_level(levels, t_start, t_end, pixels):
+    span = max(1, t_end - t_start)
+    for width in sorted(levels, reverse=True):
+        if span // width >= pixels:
+            return width
+    return None
+
+
+# Reads aggregate files written by AggregationPyramid. Falls back to the raw columnar log in the same
+#  directory when a window is too short for the finest level.
+class AggregateReader:
+    def __init__(self, directory):
+        self.directory = directory
+        self.raw = ColumnarLogReader(directory)
+
+    # Bucket widths there are files for
+    def levels(self):
+        widths = set()
+        for name in os.listdir(self.directory):
+            if name.endswith('.dqa'):
+                with open(os.path.join(self.directory, name), 'rb') as aggregate_file:
+                    widths.add(read_aggregate_header(aggregate_file.read(65536))[0]['width_ns'])
+        return sorted(widths)
+
+    # Returns (records, channels) of one level between t_start and t_end, records as AGGREGATE rows
+    def read_level(self, width, t_start=None, t_end=None):
+        t_start = np.iinfo(np.int64).min if t_start is None else t_start
+        t_end = np.iinfo(np.int64).max if t_end is None else t_end
+        suffix = '_%s.dqa' % level_name(width)
+        first_day = segment_name(t_start) if t_start > 0 else ''
+        last_day = segment_name(t_end) if t_end < np.iinfo(np.int64).max else '99999999'
+
+        records = []
+        channels = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(suffix) or not first_day <= name[:8] <= last_day:
+                continue
+            path = os.path.join(self.directory, name)
+            with open(path, 'rb') as aggregate_file:
+                header, header_length = read_aggregate_header(aggregate_file.read(65536))
+            dtype = aggregate_dtype(len(header['channels']), header['dtype'])
+            count = (os.path.getsize(path) - header_length) // dtype.itemsize  # A record may be half written
+            day = np.fromfile(path, dtype=dtype, count=count, offset=header_length)
+            records.append(day[np.searchsorted(day['t'], t_start - width + 1):np.searchsorted(day['t'], t_end, 'right')])
+            channels = header['channels']
+
+        if not records:
+            return None, channels
+        return np.concatenate(records), channels
+
+    # Returns a dictionary of 'level' (bucket width, None for raw samples) and per bucket 't', 'count', 'min',
+    #  'max' and 'mean' of one channel, at the level that suits drawing t_start..t_end pixels wide
+    def query(self, channel, t_start, t_end, pixels, levels=None):
+        width = choose_level(levels or self.levels(), t_start, t_end, pixels)
+        if width is None:
+            timestamps, values = self.raw.read(channel, t_start, t_end)
+            return {'level': None, 't': timestamps, 'count': np.ones(len(timestamps), dtype=np.int64),
+                    'min': values, 'max': values, 'mean': values}
+
+        records, channels = self.read_level(width, t_start, t_end)
+        if records is None:
+            return empty_result(width)
+        column = channels.index(channel)
+        return {'level': width, 't': records['t'], 'count': records['count'], 'min': records['min'][:, column],
+                'max': records['max'][:, column], 'mean': records['mean'][:, column]}
+
+    def close(self):
+        self.raw.close()
+
+
+def empty_result(width):
+    return {'level': width, 't': np.zeros(0, dtype=np.int64), 'count': np.zeros(0, dtype=np.int64),
+            'min': np.zeros(0), 'max': np.zeros(0), 'mean': np.zeros(0)}
+
+
+# Keeps the pyramid for one unit, fed whole scans through append() like a ColumnarLogWriter.
+#  Completed buckets are written out every flush_interval seconds, query() also sees the ones that haven't
+#  been written yet and the bucket still filling at each level.
+class AggregationPyramid:
+    def __init__(self, directory, channel_names, levels=AGGREGATE_LEVELS, dtype='<f4', flush_interval=1.0,
+                 retention_days=None):
+        self.levels = sorted(levels)
+        for finer, coarser in zip(self.levels, self.levels[1:]):
+            if coarser % finer:
+                raise Exception("Aggregate level %s is not a multiple of %s!" % (level_name(coarser), level_name(finer)))
+
+        self.directory = directory
+        self.channel_names = list(channel_names)
+        self.dtype = np.dtype(dtype)
+        self.record_dtype = aggregate_dtype(len(self.channel_names), self.dtype)
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        os.makedirs(directory, exist_ok=True)
+
+        self.open = [None] * len(self.levels)           # Per level, the bucket still filling as arrays of one row
+        self.pending = [[] for _ in self.levels]        # Per level, completed buckets not written yet
+        self.files = {}     # Level -> (segment, file)
+        self.flush_time = time.monotonic()
+        self.reader = AggregateReader(directory)
+
+    # Add scans, timestamps is one int64 ns timestamp per scan (in order), values is (scans, channels)
+    def append(self, timestamps, values):
+        if len(timestamps) == 0:
+            return
+
+        values = np.asarray(values, dtype=np.float64)
+        buckets = (np.asarray(timestamps, dtype=np.int64), np.ones(len(timestamps), dtype=np.int64),
+                   values, values, values)
+        for level, width in enumerate(self.levels):
+            buckets = self.add_buckets(level, reduce_buckets(width, buckets))
+            if buckets is None:
+                break   # Nothing completed here, so nothing new for the coarser levels either
+
+        if time.monotonic() - self.flush_time > self.flush_interval:
+            self.flush()
+
+    # Merge freshly reduced buckets into a level. The last one stays open, the rest are complete and are
+    #  returned to be reduced into the next level (None if there are none).
+    def add_buckets(self, level, buckets):
+        open_bucket = self.open[level]
+        if open_bucket is not None:
+            if open_bucket[0][0] == buckets[0][0]:     # Still filling the same bucket
+                buckets[1][0] = buckets[1][0] + open_bucket[1][0]
+                buckets[2][0] = np.minimum(buckets[2][0], open_bucket[2][0])
+                buckets[3][0] = np.maximum(buckets[3][0], open_bucket[3][0])
+                buckets[4][0] = buckets[4][0] + open_bucket[4][0]
+            else:
+                buckets = tuple(np.concatenate([previous, new]) for previous, new in zip(open_bucket, buckets))
+
+        self.open[level] = tuple(a[-1:] for a in buckets)
+        if len(buckets[0]) == 1:
+            return None
+        completed = tuple(a[:-1] for a in buckets)
+        self.pending[level].append(completed)
+        return completed
+
+    # The open bucket of a level as it stands, including the scans still in the open buckets of finer levels.
+    #  Up to two buckets, if the finest scans already started the next one.
+    def current(self, level):
+        parts = [self.open[finer] for finer in range(level, -1, -1) if self.open[finer] is not None]
+        if not parts:
+            return None
+        return reduce_buckets(self.levels[level], tuple(np.concatenate(column) for column in zip(*parts)))
+
+    def to_records(self, buckets):
+        t, count, mins, maxs, sums = buckets
+        records = np.zeros(len(t), dtype=self.record_dtype)
+        records['t'] = t
+        records['count'] = count
+        records['min'] = mins
+        records['max'] = maxs
+        records['mean'] = sums / count[:, None]
+        return records
+
+    def open_file(self, level, segment):
+        if level in self.files:
+            if self.files[level][0] == segment:
+                return self.files[level][1]
+            self.files[level][1].close()
+
+        path = os.path.join(self.directory, '%s_%s.dqa' % (segment, level_name(self.levels[level])))
+        if os.path.exists(path):
+            with open(path, 'rb') as aggregate_file:
+                header = read_aggregate_header(aggregate_file.read(65536))[0]
+            if header['channels'] != self.channel_names or header['dtype'] != self.dtype:
+                raise Exception("%s was written with a different channel setup!" % path)
+            aggregate_file = open(path, 'ab')
+        else:
+            aggregate_file = open(path, 'ab')
+            header = json.dumps({'channels': self.channel_names, 'dtype': self.dtype.str,
+                                 'width_ns': self.levels[level]}).encode()
+            header = AGGREGATE_MAGIC + struct.pack('<I', len(header)) + header
+            aggregate_file.write(header + b'\0' * (-len(header) % 64))
+            self.expire_files()
+
+        self.files[level] = (segment, aggregate_file)
+        return aggregate_file
+
+    # Remove files older than retention_days
+    def expire_files(self):
+        if self.retention_days is None:
+            return
+        oldest = (datetime.datetime.now(datetime.timezone.utc) - \
+                  datetime.timedelta(days=self.retention_days)).strftime('%Y%m%d')
+        for name in os.listdir(self.directory):
+            if name.endswith('.dqa') and name[:8] < oldest:
+                os.remove(os.path.join(self.directory, name))
+
+    # Write completed buckets out, split by the UTC day they start in
+    def flush(self):
+        self.flush_time = time.monotonic()
+        for level in range(len(self.levels)):
+            if not self.pending[level]:
+                continue
+            records = self.to_records(tuple(np.concatenate(column) for column in zip(*self.pending[level])))
+            self.pending[level] = []
+
+            days = records['t'] // DAY_NS
+            for day in np.split(records, np.flatnonzero(np.diff(days)) + 1):
+                aggregate_file = self.open_file(level, segment_name(int(day['t'][0])))
+                aggregate_file.write(day.tobytes())
+                aggregate_file.flush()
+
+    # As AggregateReader.query, including buckets not on disk yet
+    def query(self, channel, t_start, t_end, pixels):
+        result = self.reader.query(channel, t_start, t_end, pixels, levels=self.levels)
+        width = result['level']
+        if width is None:
+            return result
+
+        level = self.levels.index(width)
+        current = self.current(level)
+        buckets = self.pending[level] + ([current] if current is not None else [])
+        if not buckets:
+            return result
+        records = self.to_records(tuple(np.concatenate(column) for column in zip(*buckets)))
+        records = records[(records['t'] > t_start - width) & (records['t'] <= t_end)]
+        if len(result['t']):
+            records = records[records['t'] > result['t'][-1]]   # Flushed between reading the file and now
+        column = self.channel_names.index(channel)
+        return {'level': width,
+                't': np.concatenate([result['t'], records['t']]),
+                'count': np.concatenate([result['count'], records['count']]),
+                'min': np.concatenate([result['min'], records['min'][:, column]]),
+                'max': np.concatenate([result['max'], records['max'][:, column]]),
+                'mean': np.concatenate([result['mean'], records['mean'][:, column]])}
+
+    # Write out everything, including the buckets still filling
+    def close(self):
+        current = [self.current(level) for level in range(len(self.levels))]
+        for level in range(len(self.levels)):
+            if current[level] is not None:
+                self.pending[level].append(current[level])
+            self.open[level] = None
+        self.flush()
+        for segment, aggregate_file in self.files.values():
+            aggregate_file.close()
+        self.files = {}
+        self.reader.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("directory", type=str, help="a unit's log directory, e.g. example_log/columnar/Strip_Chart_1")
+    ap.add_argument("channel", type=str, help="channel name")
+    ap.add_argument("-m", "--minutes", required=False, default=60, type=float, help="how far back to look")
+    ap.add_argument("-p", "--pixels", required=False, default=1000, type=int, help="width of the plot")
+    args = vars(ap.parse_args())
+
+    # What a plot of the last few minutes of a channel would be drawn from
+    reader = AggregateReader(args['directory'])
+    t_end = time.time_ns()
+    t_start = t_end - int(args['minutes'] * 60e9)
+    result = reader.query(args['channel'], t_start, t_end, args['pixels'])
+    print("Level %s, %d points" % (level_name(result['level']) if result['level'] else 'raw', len(result['t'])))
+    if len(result['t']):
+        print("min %0.6f, max %0.6f, mean %0.6f over %d scans" % \
+              (np.min(result['min']), np.max(result['max']),
+               np.sum(result['mean'] * result['count']) / np.sum(result['count']), np.sum(result['count'])))
+    reader.close()
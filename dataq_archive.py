@@ -0,0 +1,386 @@
+import collections
+import datetime
+import json
+import os
+import struct
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from dataq_storage import segment_end, segment_name
+
+
+# *** Raw count archive ***
+# Lossless archive of what the units actually sent: the signed 16 bit count of every sample, with the scales
+#  that turn counts into readings kept in the header. Compared with the text log it keeps the exact counts and
+#  is a small fraction of the size.
+#
+# Laid out like the columnar log, one directory per unit and one segment per UTC day in that directory:
+#   YYYYMMDD.dqr   data file - header, then chunks. A chunk is a uint32 length per column (timestamps first,
+#                  then one per channel) followed by the columns, each delta encoded and compressed on its own
+#                  so a reader only decompresses the channels it is asked for
+#   YYYYMMDD.dqri  chunk index - one ARCHIVE_INDEX record per chunk: first and last timestamp, file offset,
+#                  length, rows
+# Deltas are taken in the column's own type and wrap around, so int16 counts stay int16 and decoding with a
+#  cumulative sum in the same type gives back exactly what went in.
+#
+# Chunks are compressed on a thread pool (zlib, lzma and zstd all release the GIL while they work) and
+#  written in order as they finish, so append() only copies rows into the chunk being filled.
+ARCHIVE_MAGIC = b'DQRAW1\n\0'
+ARCHIVE_INDEX = struct.Struct('<qqQQQ')
+ARCHIVE_INDEX_DTYPE = np.dtype([('t_start', '<i8'), ('t_end', '<i8'), ('offset', '<u8'), ('length', '<u8'),
+                                ('rows', '<u8')])
+ARCHIVE_CODECS = ['zlib', 'lzma', 'zstd']
+
+
+# (compress, decompress) for a codec. zstd needs the zstandard package.
+def archive_codec(codec, level=None):
+    if codec == 'zlib':
+        level = 6 if level is None else level
+        return (lambda data: zlib.compress(data, level)), zlib.decompress
+    if codec == 'lzma':
+        import lzma
+        level = 1 if level is None else level
+        return (lambda data: lzma.compress(data, preset=level)), lzma.decompress
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("The zstd codec needs the zstandard package, or use zlib or lzma!")
+        level = 3 if level is None else level
+        # Compressor objects can't be shared between threads, so a new one for every chunk
+        return (lambda data: zstandard.ZstdCompressor(level=level).compress(data)), \
+               (lambda data: zstandard.ZstdDecompressor().decompress(data))
+    raise Exception("Unknown archive codec %s, use one of %s!" % (codec, ", ".join(ARCHIVE_CODECS)))
+
+
+# Scaled readings back to the counts they were decoded from, for blocks that don't carry their counts. The
+#  readings are count * scale in float64, which divides back to within a rounding error of the count, so
+#  this is exact as long as no scale is zero (or not a number).
+def values_to_counts(values, scale):
+    if not np.all(np.isfinite(scale)) or np.any(scale == 0):
+        raise Exception("Can't get counts back from readings with a zero or non-finite scale!")
+    return np.rint(values / scale).astype('<i2')
+
+
+# Per channel scales of a unit, for RawArchiveWriter: the fused scale its readings were decoded with, and
+#  daq_scale and value_scale as set up in stripchart_setup_dict
+def unit_scales(dataq, ip_address):
+    route = dataq.routes[ip_address]
+    scales = {}
+    for channel_name in route['channel_names']:
+        channel = str(dataq.stripchart_setup_dict[channel_name]['channel'])
+        scales[channel_name] = {'channel': int(channel),
+                                'daq_scale': dataq.scales[ip_address]['daq_scale'][channel],
+                                'value_scale': dataq.scales[ip_address]['value_scale'][channel]}
+    return route['scale'].tolist(), scales
+
+
+# Delta encodes and compresses one chunk, runs on the pool
+def encode_chunk(compress, timestamps, counts):
+    columns = [np.diff(timestamps, prepend=np.int64(0)).astype('<i8')] + \
+              [np.diff(column, prepend=np.int16(0)).astype('<i2') for column in counts]
+    blobs = [compress(column.tobytes()) for column in columns]
+    return struct.pack('<%dI' % len(blobs), *[len(blob) for blob in blobs]) + b''.join(blobs)
+
+
+# Appends a unit's raw counts to its archive. scales is the fused scale of every channel (a reading is
+#  count * scale), scale_metadata anything else worth keeping about them, see unit_scales().
+class RawArchiveWriter:
+    def __init__(self, directory, channel_names, scales, scale_metadata=None, codec='zlib', level=None,
+                 chunk_rows=65536, workers=2, max_pending=8, retention_days=None):
+        self.directory = directory
+        self.channel_names = list(channel_names)
+        self.scales = [float(scale) for scale in scales]
+        self.scale_metadata = scale_metadata or {}
+        self.codec = codec
+        self.compress = archive_codec(codec, level)[0]
+        self.chunk_rows = chunk_rows
+        self.max_pending = max_pending
+        self.retention_days = retention_days
+        os.makedirs(directory, exist_ok=True)
+
+        self.timestamps = np.zeros(chunk_rows, dtype='<i8')
+        self.counts = np.zeros((len(self.channel_names), chunk_rows), dtype='<i2')
+        self.rows = 0
+
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="DataQ archive")
+        self.pending = collections.deque()     # (segment, first, last timestamp, rows, future), in order
+
+        self.segment = None
+        self.data_file = None
+        self.index_file = None
+
+        self.raw_bytes = 0          # Chunks written so far, as int64 timestamps and int16 counts
+        self.compressed_bytes = 0   # and as they are on disk
+
+    def open_segment(self, segment):
+        self.close_segment()
+        data_path = os.path.join(self.directory, segment + '.dqr')
+        new_file = not os.path.exists(data_path)
+
+        # Carrying on with today's segment after a restart is fine, as long as the channels and scales are the same
+        if not new_file:
+            with open(data_path, 'rb') as data_file:
+                header = read_archive_header(data_file.read(65536))[0]
+            if header['channels'] != self.channel_names or header['scales'] != self.scales or \
+               header['codec'] != self.codec:
+                raise Exception("%s was written with a different channel setup!" % data_path)
+
+        self.data_file = open(data_path, 'ab')
+        self.index_file = open(os.path.join(self.directory, segment + '.dqri'), 'ab')
+        self.segment = segment
+
+        if new_file:
+            header = json.dumps({'channels': self.channel_names, 'scales': self.scales,
+                                 'scale_metadata': self.scale_metadata, 'codec': self.codec}).encode()
+            header = ARCHIVE_MAGIC + struct.pack('<I', len(header)) + header
+            self.data_file.write(header + b'\0' * (-len(header) % 64))
+            self.data_file.flush()
+            self.expire_segments()
+
+    def close_segment(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+        self.data_file = None
+        self.index_file = None
+        self.segment = None
+
+    # Remove segments older than retention_days
+    def expire_segments(self):
+        if self.retention_days is None:
+            return
+        oldest = (datetime.datetime.now(datetime.timezone.utc) - \
+                  datetime.timedelta(days=self.retention_days)).strftime('%Y%m%d')
+        for name in os.listdir(self.directory):
+            if name.endswith(('.dqr', '.dqri')) and name[:8] < oldest:
+                os.remove(os.path.join(self.directory, name))
+
+    # Add scans, timestamps is one int64 ns timestamp per scan, counts is (scans, channels) of int16
+    def append(self, timestamps, counts):
+        start = 0
+        while start < len(timestamps):
+            # A chunk never spans two days, so it can't straddle two segments
+            if self.rows and segment_name(timestamps[start]) != segment_name(self.timestamps[0]):
+                self.submit_chunk()
+
+            # and only takes rows up to midnight of its first row's day
+            day_end = segment_end(self.timestamps[0] if self.rows else timestamps[start])
+            count = min(self.chunk_rows - self.rows, int(np.searchsorted(timestamps[start:], day_end)))
+            self.timestamps[self.rows:self.rows + count] = timestamps[start:start + count]
+            self.counts[:, self.rows:self.rows + count] = counts[start:start + count].T
+            self.rows = self.rows + count
+            start = start + count
+
+            if self.rows == self.chunk_rows:
+                self.submit_chunk()
+        self.write_finished()
+
+    # Scaled readings turned back into counts, for blocks without 'Counts'
+    def append_values(self, timestamps, values):
+        self.append(timestamps, values_to_counts(values, np.asarray(self.scales)))
+
+    # Hand the chunk being filled to the pool, waiting for the oldest one if too many are in flight
+    def submit_chunk(self):
+        if self.rows == 0:
+            return
+        rows = self.rows
+        timestamps = self.timestamps[:rows].copy()
+        counts = self.counts[:, :rows].copy()
+        self.pending.append((segment_name(timestamps[0]), int(timestamps[0]), int(timestamps[-1]), rows,
+                             self.pool.submit(encode_chunk, self.compress, timestamps, counts)))
+        self.rows = 0
+        if len(self.pending) > self.max_pending:
+            self.write_chunk(*self.pending.popleft())
+
+    # Write out every chunk the pool has finished, in order
+    def write_finished(self):
+        while self.pending and self.pending[0][4].done():
+            self.write_chunk(*self.pending.popleft())
+
+    def write_chunk(self, segment, t_start, t_end, rows, future):
+        chunk = future.result()
+        if segment != self.segment:
+            self.open_segment(segment)
+
+        offset = self.data_file.tell()
+        self.data_file.write(chunk)
+        self.data_file.flush()
+        self.index_file.write(ARCHIVE_INDEX.pack(t_start, t_end, offset, len(chunk), rows))
+        self.index_file.flush()
+        self.raw_bytes = self.raw_bytes + rows * (8 + 2 * len(self.channel_names))
+        self.compressed_bytes = self.compressed_bytes + len(chunk)
+
+    # Compress and write whatever is buffered as a (short) chunk, and wait for everything in flight
+    def flush(self):
+        self.submit_chunk()
+        while self.pending:
+            self.write_chunk(*self.pending.popleft())
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
+        self.close_segment()
+
+
+# Parses the header at the start of an archive data file, returns it and its length
+def read_archive_header(data):
+    if data[:len(ARCHIVE_MAGIC)] != ARCHIVE_MAGIC:
+        raise Exception("Not a DataQ raw archive!")
+    header_length = struct.unpack_from('<I', data, len(ARCHIVE_MAGIC))[0]
+    header = json.loads(data[len(ARCHIVE_MAGIC) + 4:len(ARCHIVE_MAGIC) + 4 + header_length])
+    length = len(ARCHIVE_MAGIC) + 4 + header_length
+    return header, length + (-length % 64)
+
+
+# Reads a unit's raw archive. Only chunks overlapping the requested window are read, and only the columns
+#  asked for are decompressed. The last few decoded columns are kept, so reading channel after channel of
+#  the same window doesn't decompress the timestamps every time.
+class RawArchiveReader:
+    def __init__(self, directory, cache_columns=64):
+        self.directory = directory
+        self.headers = {}       # segment -> header
+        self.cache = collections.OrderedDict()     # (segment, offset, column) -> decoded column
+        self.cache_columns = cache_columns
+
+    def segments(self):
+        return sorted(name[:-4] for name in os.listdir(self.directory) if name.endswith('.dqr'))
+
+    def header(self, segment):
+        if segment not in self.headers:
+            with open(os.path.join(self.directory, segment + '.dqr'), 'rb') as data_file:
+                self.headers[segment] = read_archive_header(data_file.read(65536))[0]
+        return self.headers[segment]
+
+    def chunk_index(self, segment):
+        return np.fromfile(os.path.join(self.directory, segment + '.dqri'), dtype=ARCHIVE_INDEX_DTYPE)
+
+    def channels(self):
+        segments = self.segments()
+        return self.header(segments[-1])['channels'] if segments else []
+
+    # Column 0 is the timestamps, 1 + n channel n
+    def read_column(self, segment, data_file, offset, rows, column):
+        key = (segment, offset, column)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        header = self.header(segment)
+        columns = 1 + len(header['channels'])
+        data_file.seek(offset)
+        lengths = struct.unpack('<%dI' % columns, data_file.read(4 * columns))
+        data_file.seek(offset + 4 * columns + sum(lengths[:column]))
+        decompress = archive_codec(header['codec'])[1]
+        data = decompress(data_file.read(lengths[column]))
+        if column == 0:
+            decoded = np.cumsum(np.frombuffer(data, dtype='<i8', count=rows), dtype=np.int64)
+        else:
+            decoded = np.cumsum(np.frombuffer(data, dtype='<i2', count=rows), dtype=np.int16)
+
+        self.cache[key] = decoded
+        if len(self.cache) > self.cache_columns:
+            self.cache.popitem(last=False)
+        return decoded
+
+    # Returns (timestamps, counts) for one channel between t_start and t_end (ns since epoch, inclusive), and
+    #  the scale of every segment the counts came from
+    def read_counts(self, channel, t_start=None, t_end=None):
+        t_start = np.iinfo(np.int64).min if t_start is None else t_start
+        t_end = np.iinfo(np.int64).max if t_end is None else t_end
+
+        timestamps = []
+        counts = []
+        scales = []
+        for segment in self.segments():
+            index = self.chunk_index(segment)
+            index = index[(index['t_end'] >= t_start) & (index['t_start'] <= t_end)]
+            if len(index) == 0:
+                continue
+
+            header = self.header(segment)
+            column = 1 + header['channels'].index(channel)
+            with open(os.path.join(self.directory, segment + '.dqr'), 'rb') as data_file:
+                for t_first, t_last, offset, length, rows in index.tolist():
+                    chunk_times = self.read_column(segment, data_file, offset, rows, 0)
+                    chunk_counts = self.read_column(segment, data_file, offset, rows, column)
+                    if t_first < t_start or t_last > t_end:     # Only part of this chunk is in the window
+                        keep = slice(np.searchsorted(chunk_times, t_start, 'left'),
+                                     np.searchsorted(chunk_times, t_end, 'right'))
+                        chunk_times = chunk_times[keep]
+                        chunk_counts = chunk_counts[keep]
+                    timestamps.append(chunk_times)
+                    counts.append(chunk_counts)
+                    scales.append(np.full(len(chunk_counts), header['scales'][column - 1]))
+
+        if not timestamps:
+            return np.zeros(0, dtype='<i8'), np.zeros(0, dtype='<i2'), np.zeros(0)
+        return np.concatenate(timestamps), np.concatenate(counts), np.concatenate(scales)
+
+    # Returns (timestamps, values) for one channel between t_start and t_end, scaled to readings
+    def read(self, channel, t_start=None, t_end=None):
+        timestamps, counts, scales = self.read_counts(channel, t_start, t_end)
+        return timestamps, counts * scales
+
+
+# Sink writing blocks to one RawArchiveWriter per unit, keyed by IP. The counts the units sent are taken
+#  straight from the blocks, only blocks without them are rebuilt from the readings.
+def raw_archive_sink(dataq, archives):
+    from dataq_storage import interleaved_to_scans
+
+    def sink(batch):
+        for block in batch:
+            scan_length = len(dataq.routes[block['IPAddress']]['slots'])
+            if 'Counts' in block:
+                skip, scans = interleaved_to_scans(block['Counts'], block['FirstSlot'], scan_length)
+                archives[block['IPAddress']].append(block['Timestamps'][skip::scan_length][:len(scans)], scans)
+            else:
+                skip, scans = interleaved_to_scans(block['Values'], block['FirstSlot'], scan_length)
+                archives[block['IPAddress']].append_values(block['Timestamps'][skip::scan_length][:len(scans)],
+                                                           scans)
+    return sink
+
+
+# Prints what is in a unit's archive, or one channel of it as CSV
+def main(argv=None):
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Summarize or dump a DataQ raw count archive")
+    ap.add_argument("directory", type=str, help="archive directory of one unit")
+    ap.add_argument("channel", nargs='?', default=None, type=str, help="print this channel as CSV")
+    ap.add_argument("-m", "--minutes", required=False, default=None, type=float, help="only the last N minutes")
+    ap.add_argument("-c", "--counts", required=False, action='store_true', help="print raw counts, not readings")
+    args = vars(ap.parse_args(argv))
+
+    reader = RawArchiveReader(args['directory'])
+    t_start = None
+    if args['minutes'] is not None:
+        t_start = int((datetime.datetime.now().timestamp() - args['minutes'] * 60) * 1e9)
+
+    if args['channel']:
+        if args['counts']:
+            timestamps, values = reader.read_counts(args['channel'], t_start)[:2]
+        else:
+            timestamps, values = reader.read(args['channel'], t_start)
+        print("time_ns,%s" % args['channel'])
+        for timestamp, value in zip(timestamps.tolist(), values.tolist()):
+            print("%d,%s" % (timestamp, value))
+        return 0
+
+    for segment in reader.segments():
+        header = reader.header(segment)
+        index = reader.chunk_index(segment)
+        rows = int(index['rows'].sum())
+        raw_bytes = rows * (8 + 2 * len(header['channels']))
+        stored = os.path.getsize(os.path.join(args['directory'], segment + '.dqr'))
+        print("%s: %d chunks, %d scans of %d channels, %s, %d KB (%0.1fx smaller than raw)" % \
+              (segment, len(index), rows, len(header['channels']), header['codec'], stored // 1024,
+               raw_bytes / stored if stored else 0))
+    print("channels: %s" % ", ".join(reader.channels()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+import asyncio
+import datetime
+import struct
+import time
+
+from data_di4370_ethernet import DATAQ_PACKET_SIZES
+from dataq_codec import RESPONSE_HEADER, DQRESPONSE
+
+
+# Setup commands sent even when the config cache says the unit has them: the scan list and packet size decide
+#  how every DQAdcData payload is decoded, so a stale cache entry for these would garble the data silently
+ALWAYS_SENT_SETTINGS = ['slist', 'ps']
+
+
+# Feeds every DQResponse arriving on the PC's receiving port back to the client, anything else
+#  (DQAdcData, discovery replies) is dropped here
+class DataQCommandProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        if len(data) >= RESPONSE_HEADER.size and struct.unpack_from("@I", data)[0] == DQRESPONSE:
+            self.client.response_received(addr, data)
+
+    def error_received(self, exc):
+        print("Error on DataQ command socket: %s" % exc)
+
+
+# Command channel built on asyncio. Every command returns an awaitable that resolves once every unit it was
+#  sent to has answered. Responses are matched to the unit by IP and, once known, by the Order field of the
+#  DQResponse header. A unit only ever has one command in flight, the protocol has no sequence number to tell
+#  two replies from the same unit apart, but commands to different units run concurrently and each
+#  command's timeout only covers that command.
+class AsyncCommandClient:
+    def __init__(self, dataq, command_port=51235):
+        self.dataq = dataq
+        self.command_port = command_port
+
+        self.transport = None
+        self.pending = {}       # IP -> future for the command currently in flight to that unit
+        self.unit_locks = {}    # IP -> lock held while a command is in flight to that unit
+        self.orders = {}        # IP -> Order in group, learned from the unit's replies
+
+    # Shares the PC's receiving socket with the blocking code, through a duplicate so closing the
+    #  transport leaves dataq.rec_sock open
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: DataQCommandProtocol(self),
+                                                                sock=self.dataq.rec_sock.dup())
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def response_received(self, addr, data):
+        future = self.pending.get(addr[0])
+        if future is None or future.done():
+            return  # Nobody is waiting on this unit, e.g. a late reply to a command that timed out
+
+        try:
+            decoded_message = self.dataq.decode_response_message(addr, data)
+        except Exception as e:
+            future.set_exception(e)
+            return
+
+        expected_order = self.orders.get(addr[0])
+        if expected_order is not None and decoded_message['Order'] != expected_order:
+            return  # A reply from a previous session of this unit, keep waiting
+
+        future.set_result(decoded_message)
+
+    def unit_lock(self, ip_address):
+        if ip_address not in self.unit_locks:
+            self.unit_locks[ip_address] = asyncio.Lock()
+        return self.unit_locks[ip_address]
+
+    # Send one command to a single unit and wait for its response
+    async def command_unit(self, ip_address, command='Shared', payload='', groupid=None, timeout=3):
+        if groupid is None:
+            groupid = self.dataq.new_group_id
+
+        async with self.unit_lock(ip_address):
+            future = asyncio.get_running_loop().create_future()
+            self.pending[ip_address] = future
+            try:
+                msg = self.dataq.pack_command(groupid=groupid, command=command, payload=payload)
+                self.transport.sendto(msg, (ip_address, self.command_port))
+                try:
+                    return await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    raise Exception("DataQ unit on %s did not answer '%s %s' within %s seconds" % \
+                                    (ip_address, command, payload, timeout))
+            finally:
+                del self.pending[ip_address]
+
+    # Send the same command to a group of units at once, resolves to {IP: response} when all have answered
+    async def command(self, ip_addresses, command='Shared', payload='', groupid=None, timeout=3):
+        responses = await asyncio.gather(*[self.command_unit(ip_address, command=command, payload=payload,
+                                                             groupid=groupid, timeout=timeout)
+                                           for ip_address in ip_addresses])
+        return dict(zip(ip_addresses, responses))
+
+    def unit_ips(self):
+        return [chart[1]['ip_address'] for chart in self.dataq.strip_charts]
+
+    # Connect all DataQ devices to this computer, see DataQDI4370Ethernet.connect_devices
+    async def connect_devices(self):
+        connected = await self.command(self.unit_ips(), command='Connect', payload=self.dataq.ip_address)
+        for ip_address, message in connected.items():
+            if message['GroupID'] == self.dataq.new_group_id and message['PayLoad'] == 'connected':
+                print("DataQ device on %s has been set to group %s: %s" % \
+                      (ip_address, message['GroupID'], message['PayLoad']))
+                self.orders[ip_address] = message['Order']
+            else:
+                raise Exception("DataQ unit on %s has not connected as expected" % ip_address)
+
+        # Zero will KeepAlive indefinitely
+        for message in (await self.command(self.unit_ips(), payload="keepalive 0")).values():
+            print(str(message))
+
+    # Basic command for getting info from units
+    async def get_info(self):
+        for message in (await self.command(self.unit_ips(), payload="info 1")).values():
+            print(str(message))
+
+    # Set time on units to current UTC time
+    async def set_time(self):
+        current_utc_time = datetime.datetime.now(datetime.timezone.utc)
+        ymd_string = "ymd %04d/%02d/%02d" % (current_utc_time.year,current_utc_time.month,current_utc_time.day)
+        hms_string = "hms %02d:%02d:%02d" % (current_utc_time.hour,current_utc_time.minute,current_utc_time.second)
+
+        for payload in [hms_string, ymd_string]:
+            for message in (await self.command(self.unit_ips(), payload=payload)).values():
+                print(str(message))
+
+    # Sequence for doing bulk of setup for units, see DataQDI4370Ethernet.send_setup_commands. Every unit is
+    #  configured over unicast at the same time. Given an AppliedConfigCache, a unit is only sent the settings
+    #  that differ from what it last confirmed. packet_size can be 'auto', as in the blocking version.
+    #  Returns the setup time of every unit in seconds, keyed by IP.
+    async def send_setup_commands(self, dec=1, deca=1, sample_rate=1000, packet_size='auto', cache=None):
+        self.dataq.sample_rate = sample_rate
+        self.dataq.dec = dec
+        self.dataq.deca = deca
+        srate = self.dataq.compute_srate(sample_rate, dec, deca)
+        slist_config = self.dataq.compile_scan_lists()
+        self.dataq.configure_sample_clock(srate, dec, deca)
+        packet_sizes = self.dataq.choose_packet_sizes(packet_size, srate, dec, deca)
+
+        # In the order the units have to receive them
+        setups = []
+        for chart in self.dataq.strip_charts:
+            settings = {'encode': "encode 0",
+                        'dec': "dec %s" % dec,
+                        'deca': "deca %s" % deca,
+                        'srate': "srate %s" % srate,
+                        'slist': slist_config[chart[0]],
+                        'ps': "ps %s" % DATAQ_PACKET_SIZES[packet_sizes[chart[1]['ip_address']]]}
+            setups.append(self.configure_unit(chart[1]['ip_address'], settings, cache))
+
+        try:
+            setup_times = await asyncio.gather(*setups)
+        finally:
+            if cache is not None:
+                cache.save()
+        return dict(zip(self.unit_ips(), setup_times))
+
+    # Push one unit's settings, skipping those its cache entry says are already applied. The cache only counts
+    #  if the last discovery before we connected found the unit still in the session it was configured in, and the
+    #  settings that decide how payloads decode are sent every time regardless.
+    async def configure_unit(self, ip_address, settings, cache=None):
+        reply = getattr(self.dataq, 'discovered', {}).get(ip_address, {})
+        serial_number = reply.get('SerialNumber')
+        group_id = int(reply['GroupID']) if reply.get('GroupID', '').isdigit() else None
+        applied = cache.get(serial_number, group_id) if cache is not None else {}
+        if applied:
+            cache.update(serial_number, dict(applied), self.dataq.new_group_id)   # Still holds them in our session
+
+        start_time = time.perf_counter()
+        sent = 0
+        skipped = 0
+        try:
+            for setting in settings:
+                if setting not in ALWAYS_SENT_SETTINGS and applied.get(setting) == settings[setting]:
+                    skipped = skipped + 1
+                    continue
+
+                # A scan list is a list of slist commands, everything else is a single command
+                payloads = settings[setting] if isinstance(settings[setting], list) else [settings[setting]]
+                for payload in payloads:
+                    print(str(await self.command_unit(ip_address, payload=payload, timeout=5)))
+                    sent = sent + 1
+
+                if cache is not None:
+                    cache.update(serial_number, {setting: settings[setting]}, self.dataq.new_group_id)
+        except Exception:
+            if cache is not None:
+                cache.forget(serial_number)     # We no longer know what state the unit is in
+            raise
+
+        setup_time = time.perf_counter() - start_time
+        print("Setup of %s (serial %s) took %0.3f seconds, %d commands sent, %d settings already applied" % \
+              (ip_address, serial_number, setup_time, sent, skipped))
+        return setup_time
+
+
+# Runs connect_devices and send_setup_commands on the asyncio client and returns the per unit setup times
+def bring_up(dataq, dec=1, deca=1, sample_rate=1000, packet_size='auto', cache=None):
+    async def run():
+        async with AsyncCommandClient(dataq) as client:
+            await client.connect_devices()
+            return await client.send_setup_commands(dec=dec, deca=deca, sample_rate=sample_rate,
+                                                    packet_size=packet_size, cache=cache)
+
+    return asyncio.run(run())
@@ -0,0 +1,64 @@
+import struct
+
+
+# *** DataQ Ethernet protocol codec ***
+# Headers of the three message types, '@' is native byte order, size and alignment as the units expect:
+#   DQCommand   type, group ID, command, arg0, arg1, arg2, then a null terminated payload    (to the unit)
+#   DQResponse  type, group ID, order, payload length, then the payload                     (from the unit)
+#   DQAdcData   type, group ID, order, cumulative count, payload samples, then the samples  (from the unit)
+DQCOMMAND = 0x31415926
+DQRESPONSE = 0x21712818
+DQADCDATA = 0x14142135
+
+COMMAND_HEADER = struct.Struct('@IIIIII')
+RESPONSE_HEADER = struct.Struct('@IIII')
+ADC_HEADER = struct.Struct('@IIIII')
+
+ETHERNET_COMMANDS = {'SyncStart': 1,        # HAVE to use this to 'start' with Ethernet devices
+                     'SlaveIp': 5,
+                     'SyncStop': 6,
+                     'Connect': 10,         # These are 'Ethernet-specific' command values
+                     'Disconnect': 11,
+                     'KeepAlive': 12,
+                     'SetWdqHeader': 21,    # For shared commands , the command goes in the 'Payload'
+                     'Shared': 13,}   # All Shared (both USB and Ethernet) protocol commands have a value of 13
+
+# Encoded commands keyed by everything that goes into them. The same few dozen commands are sent over and
+#  over (stop, setup, keepalive), the only ones that keep changing are the clock settings, so the cache is
+#  simply emptied if it ever gets this big.
+COMMAND_CACHE_SIZE = 1024
+command_cache = {}
+
+
+# Returns the DQCommand datagram for a command, see ETHERNET_COMMANDS
+def encode_command(groupid, command, arg0=0, arg1=0, arg2=0, payload=''):
+    key = (groupid, command, arg0, arg1, arg2, payload)
+    packed = command_cache.get(key)
+    if packed is None:
+        # A null-terminated ASCII string or binary image as needed by the specific command
+        packed = COMMAND_HEADER.pack(DQCOMMAND, groupid, ETHERNET_COMMANDS[command], arg0, arg1, arg2) + \
+                 payload.encode('ascii') + b'\0'
+        if len(command_cache) >= COMMAND_CACHE_SIZE:
+            command_cache.clear()
+        command_cache[key] = packed
+    return packed
+
+
+# Parses a DQResponse datagram (bytes or a memoryview into a receive buffer) into (group ID, order, payload),
+#  the payload without its terminators. Only the payload itself is copied out of data.
+def decode_response(data):
+    magic, groupid, order, length = RESPONSE_HEADER.unpack_from(data)
+    if magic != DQRESPONSE:
+        raise Exception("Response TYPE does not match expected for DQResponse!")
+    if len(data) - RESPONSE_HEADER.size != length:
+        raise Exception("Decoded char length does not match expected PayLoadLength!")
+    payload = bytes(data[RESPONSE_HEADER.size:]).rstrip(b'\0').rstrip(b'\n').rstrip(b'\r')
+    return groupid, order, payload.decode('latin-1')   # One character per byte, like chr()
+
+
+# Parses the header of a DQAdcData datagram into (group ID, order, cumulative count, payload samples)
+def decode_adc_header(data):
+    magic, groupid, order, cumulative_count, sample_count = ADC_HEADER.unpack_from(data)
+    if magic != DQADCDATA:
+        raise Exception("Response TYPE does not match expected for DQAdcData!")
+    return groupid, order, cumulative_count, sample_count
@@ -0,0 +1,54 @@
+import json
+import os
+import time
+
+
+# Remembers the configuration each unit last confirmed, keyed by the serial number from its discovery reply,
+#  so a restart only has to send the commands whose values changed. Stored as a small JSON file:
+#   {"<serial>": {"settings": {"encode": "encode 0", ..., "slist": ["slist 0 768", ...]}, "group_id": <group>,
+#                 "applied_at": <time>}}
+# The units can't be asked what they are set to, and they lose their settings when they are power cycled,
+#  so an entry is only trusted while the unit is still in the session (group ID) it was configured in, i.e.
+#  when a run crashed without stopping it and nothing has stopped it since. A unit found idle (including one
+#  dataq_session.SessionManager.recover just stopped), or in anybody else's session, could be holding
+#  anything.
+class AppliedConfigCache:
+    def __init__(self, path='dataq_config_cache.json'):
+        self.path = path
+        self.units = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as cache_file:
+                    self.units = json.load(cache_file)
+            except ValueError:
+                print("Ignoring unreadable config cache %s" % path)
+
+    # Last confirmed settings for a unit, empty if we don't know anything about it. group_id is the GroupID of
+    #  the unit's discovery reply from before we connected to it; unless that is the session the settings were
+    #  applied in, the entry is dropped.
+    def get(self, serial_number, group_id=None):
+        if serial_number is None or serial_number not in self.units:
+            return {}
+        if not group_id or self.units[serial_number].get('group_id') != group_id:
+            self.forget(serial_number)
+            return {}
+        return self.units[serial_number]['settings']
+
+    # Record settings the unit has just confirmed in session group_id
+    def update(self, serial_number, settings, group_id=None):
+        if serial_number is None:
+            return
+        if serial_number not in self.units or self.units[serial_number].get('group_id') != group_id:
+            self.units[serial_number] = {'settings': {}, 'group_id': group_id}
+        self.units[serial_number]['settings'].update(settings)
+        self.units[serial_number]['applied_at'] = time.time()
+
+    # Drop what we know about a unit, e.g. after a command to it failed and its state is unknown
+    def forget(self, serial_number):
+        self.units.pop(serial_number, None)
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as cache_file:
+            json.dump(self.units, cache_file, indent=1)
+        os.replace(temp_path, self.path)    # Never leave a half written cache behind
@@ -0,0 +1,231 @@
+import os
+import re
+import select
+import socket
+import struct
+import sys
+import time
+
+
+# *** Discovery ***
+# Only the standard library, and only the light parts of it, are imported up front: health checks run this
+#  from cron many times a day, where interpreter start up and imports are most of the cost. See
+#  benchmark_ethernet.py -s startup for the budget.
+#
+# 'dataq_instruments' broadcast to port 1235 on a network, every unit on it answers with a line of text to
+#  port 1234 of the address the broadcast came from (Protocol Document, page 12). discover() broadcasts on any
+#  number of interfaces at once and returns as soon as every expected unit has answered, or at the deadline.
+DISCOVERY_MESSAGE = b'dataq_instruments'
+DISCOVERY_PORT = 1235   # Device's discovery receiving port
+REPLY_PORT = 1234       # PC's default discovery receiving port
+
+DISCOVERY_REPLY = re.compile(r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}) " + \
+                             r"(\w{2}:\w{2}:\w{2}:\w{2}:\w{2}:\w{2}) " + \
+                             r"(\w*) (\w*) (\w*) (\w*) (\w*) (\w*) (\w*) (\w*) (\w*) (\w*)")
+DISCOVERY_FIELDS = ['IP', 'MAC', 'SoftwareRev', 'DeviceModel', 'ADCRunning', 'Reserved',
+                    'LengthOfDescription', 'Description', 'SerialNumber', 'GroupID', 'OrderInGroup', 'Master/Slave']
+
+
+# Discovery reply text into a dictionary of DISCOVERY_FIELDS, None if it isn't one
+def parse_discovery_reply(data):
+    result = DISCOVERY_REPLY.search(data)
+    if result is None:
+        return None
+    return dict(zip(DISCOVERY_FIELDS, result.groups()))
+
+
+# (name, IP, broadcast address) of every IPv4 interface that can broadcast. Uses psutil if it is installed,
+#  otherwise asks the kernel directly on Linux, otherwise only knows the interface the host name resolves to.
+def list_interfaces():
+    interfaces = []
+    try:
+        import psutil
+        for name, addresses in psutil.net_if_addrs().items():
+            for address in addresses:
+                if address.family == socket.AF_INET and address.broadcast:
+                    interfaces.append((name, address.address, address.broadcast))
+        return interfaces
+    except ImportError:
+        pass
+
+    if sys.platform.startswith('linux'):
+        import fcntl
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for index, name in socket.if_nameindex():
+                request = struct.pack('256s', name.encode()[:15])
+                try:
+                    ip_address = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), 0x8915, request)[20:24])   # SIOCGIFADDR
+                    broadcast = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), 0x8919, request)[20:24])    # SIOCGIFBRDADDR
+                except OSError:
+                    continue    # No IPv4 address, or can't broadcast
+                if broadcast != '0.0.0.0':
+                    interfaces.append((name, ip_address, broadcast))
+        finally:
+            sock.close()
+        return interfaces
+
+    return [('default', socket.gethostbyname(socket.gethostname()), '255.255.255.255')]
+
+
+# Interfaces to broadcast on from a list of names and/or IPs, 'all' for every one list_interfaces finds
+def select_interfaces(selection):
+    interfaces = list_interfaces()
+    if selection == 'all' or selection == ['all']:
+        return interfaces
+    selected = [interface for interface in interfaces if interface[0] in selection or interface[1] in selection]
+    if len(selected) != len(selection):
+        raise Exception("Unknown interface in %s, have %s!" % \
+                        (", ".join(selection), ", ".join("%s (%s)" % interface[:2] for interface in interfaces)))
+    return selected
+
+
+# Broadcast on every channel, a (send socket, receive socket, broadcast address, interface name) tuple, and
+#  collect replies until every unit in expected_ips and expected_serials has answered or timeout seconds are
+#  up. With nothing expected it always waits the whole timeout. Returns the parsed replies keyed by IP, each
+#  with the interface it came in on and the seconds it took as 'Interface' and 'ReplyTime'.
+def discover(channels, timeout=3, expected_ips=(), expected_serials=()):
+    start_time = time.monotonic()
+    for send_sock, receive_sock, broadcast_address, interface in channels:
+        send_sock.sendto(DISCOVERY_MESSAGE, (broadcast_address, DISCOVERY_PORT))
+
+    interfaces = {channel[1]: channel[3] for channel in channels}
+    expected_ips = set(expected_ips)
+    expected_serials = set(expected_serials)
+    discovered = {}
+    while True:
+        remaining = start_time + timeout - time.monotonic()
+        if remaining <= 0:
+            break
+        for sock in select.select(list(interfaces), [], [], remaining)[0]:
+            try:
+                data, addr = sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                continue
+            reply = parse_discovery_reply(str(data, 'latin-1'))     # Anything else on the port is skipped
+            if reply is None:
+                continue
+            reply['Interface'] = interfaces[sock]
+            reply['ReplyTime'] = time.monotonic() - start_time
+            discovered[reply['IP']] = reply
+
+        if expected_ips or expected_serials:
+            if expected_ips <= set(discovered) and \
+               expected_serials <= set(reply['SerialNumber'] for reply in discovered.values()):
+                break   # Everyone we are looking for has answered
+    return discovered
+
+
+# Remembers discovery results for ttl seconds in a small JSON file, so restarts and health checks within that
+#  time don't have to broadcast again:
+#   {"<ip>": {"reply": {"IP": ..., "SerialNumber": ..., ...}, "seen_at": <time>}}
+class DiscoveryCache:
+    def __init__(self, path='dataq_discovery_cache.json', ttl=60):
+        self.path = path
+        self.ttl = ttl
+        self.units = {}
+        if path is not None and os.path.exists(path):
+            import json
+            try:
+                with open(path) as cache_file:
+                    self.units = json.load(cache_file)
+            except ValueError:
+                print("Ignoring unreadable discovery cache %s" % path)
+
+    # Cached replies keyed by IP if every expected unit was seen within ttl, None if we have to ask again
+    def get(self, expected_ips=(), expected_serials=()):
+        now = time.time()
+        fresh = {ip_address: unit['reply'] for ip_address, unit in self.units.items() if now - unit['seen_at'] < self.ttl}
+        if not (expected_ips or expected_serials) or not set(expected_ips) <= set(fresh) or \
+           not set(expected_serials) <= set(reply['SerialNumber'] for reply in fresh.values()):
+            return None
+        return fresh
+
+    def update(self, discovered):
+        now = time.time()
+        for ip_address, reply in discovered.items():
+            self.units[ip_address] = {'reply': reply, 'seen_at': now}
+        if self.path is not None:
+            import json
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as cache_file:
+                json.dump(self.units, cache_file, indent=1)
+            os.replace(temp_path, self.path)    # Never leave a half written cache behind
+
+    # Forget a unit, e.g. once it stops answering commands
+    def forget(self, ip_address):
+        self.units.pop(ip_address, None)
+
+
+# Discovery with sockets of its own, for when there is no DataQDI4370Ethernet around, e.g. detect_device_ethernet.py
+#  or a health check. Replies come back to port 1234 of bind_address (by default the address the host name
+#  resolves to), so this can't run on a computer whose acquisition is using that port at the time.
+def discover_units(expected_ips=(), expected_serials=(), timeout=3, interfaces=None,
+                   broadcast_address='255.255.255.255', bind_address=None):
+    bind_address = bind_address or socket.gethostbyname(socket.gethostname())
+    channels = []
+    try:
+        for name, ip_address, interface_broadcast in [('default', bind_address, broadcast_address)] + \
+                                                     (select_interfaces(interfaces) if interfaces else []):
+            if channels and ip_address == bind_address:
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            channels.append((sock, sock, interface_broadcast, name))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.bind((ip_address, REPLY_PORT))
+        return discover(channels, timeout, expected_ips, expected_serials)
+    finally:
+        for channel in channels:
+            channel[0].close()
+
+
+# Command line discovery, shared by this module and detect_device_ethernet.py. Exits 0 if every expected
+#  unit answered (or none were expected and any did), 1 otherwise, so it can be used as a health check.
+def main(argv=None):
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Find DataQ units on the local network")
+    ap.add_argument("-e", "--expect", required=False, default=[], action='append',
+                    help="IP of a unit that has to answer, stop as soon as all of them have (repeatable)")
+    ap.add_argument("-s", "--serial", required=False, default=[], action='append',
+                    help="serial number of a unit that has to answer (repeatable)")
+    ap.add_argument("-t", "--timeout", required=False, default=3, type=float, help="longest to wait for replies")
+    ap.add_argument("-b", "--broadcast-address", required=False, default='255.255.255.255', type=str,
+                    help="where to broadcast, '127.255.255.255' for dataq_simulator.py")
+    ap.add_argument("--bind", required=False, default=None, type=str, help="local IP to broadcast from")
+    ap.add_argument("-i", "--interfaces", required=False, default=None, type=str,
+                    help="also broadcast on these interfaces, 'all' or comma separated names or IPs")
+    ap.add_argument("-c", "--cache", required=False, default=None, type=str,
+                    help="file remembering replies, skip the broadcast if every expected unit answered recently")
+    ap.add_argument("--ttl", required=False, default=60, type=float, help="seconds a cached reply is good for")
+    ap.add_argument("-j", "--json", required=False, action='store_true', help="print the replies as JSON")
+    args = vars(ap.parse_args(argv))
+
+    cache = DiscoveryCache(args['cache'], ttl=args['ttl']) if args['cache'] else None
+    discovered = cache.get(args['expect'], args['serial']) if cache is not None else None
+    if discovered is None:
+        discovered = discover_units(args['expect'], args['serial'], timeout=args['timeout'],
+                                    interfaces=args['interfaces'].split(',') if args['interfaces'] else None,
+                                    broadcast_address=args['broadcast_address'], bind_address=args['bind'])
+        if cache is not None:
+            cache.update(discovered)
+
+    missing = [ip_address for ip_address in args['expect'] if ip_address not in discovered]
+    serials = set(reply['SerialNumber'] for reply in discovered.values())
+    missing = missing + [serial for serial in args['serial'] if serial not in serials]
+    if args['json']:
+        import json
+        print(json.dumps({'units': discovered, 'missing': missing}, indent=1))
+    else:
+        for reply in discovered.values():
+            print("Found DataQ device %s on IP %s" % (reply['DeviceModel'], reply['IP']))
+            for field in reply:
+                print("   %s: %s" % (field, reply[field]))
+        for unit in missing:
+            print("DataQ device %s did not answer!" % unit)
+
+    return 1 if missing or not discovered else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+import collections
+import gzip
+import http.client
+import socket
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+from dataq_storage import interleaved_to_scans
+
+# Readings come from 16 bit counts, 10 significant digits tell every count apart
+FIELD_FORMAT = '%.10g'
+
+
+# Line protocol escaping, see https://docs.influxdata.com/influxdb/v2/reference/syntax/line-protocol/
+def escape_key(text):
+    return text.replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def escape_measurement(text):
+    return text.replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ')
+
+
+# Exports decoded blocks to a time series database in line protocol. Each scan of a unit becomes one line,
+#  tagged with the unit's device name and with every channel of the unit as a field:
+#   dataq,device=Strip_Chart_1 Example_Channel_Name_03=1.25,Example_Channel_Name_04=-0.5 1700000000000000000
+#
+# Lines are queued in a bounded buffer and sent in batches by sender threads, each keeping its own persistent
+#  connection open. url is http(s)://host:port/path?query for an HTTP write endpoint (InfluxDB /write or
+#  /api/v2/write, VictoriaMetrics, a Telegraf http_listener, ...) or tcp://host:port for a plain socket
+#  listener. Failed sends are retried with backoff, and while the endpoint is down lines stay buffered, the
+#  oldest are dropped once max_buffered_lines is reached. Line protocol has no NaN or infinity, so such
+#  readings are left out of their line (and a scan with no finite readings at all is skipped).
+class LineProtocolExporter:
+    def __init__(self, dataq, url, measurement='dataq', batch_lines=5000, flush_interval=1.0,
+                 max_buffered_lines=1000000, use_gzip=False, retries=3, backoff=0.5, timeout=5,
+                 headers=None, connections=2):
+        self.dataq = dataq
+        self.url = urllib.parse.urlsplit(url)
+        if self.url.scheme not in ['http', 'https', 'tcp']:
+            raise Exception("Exporter url has to be http://, https:// or tcp://, not %s" % url)
+
+        self.measurement = escape_measurement(measurement)
+        self.batch_lines = batch_lines
+        self.flush_interval = flush_interval
+        self.use_gzip = use_gzip and self.url.scheme != 'tcp'
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        self.headers['Content-Type'] = 'text/plain; charset=utf-8'
+        if self.use_gzip:
+            self.headers['Content-Encoding'] = 'gzip'
+
+        self.templates = {}     # IP -> line template for that unit
+        self.field_keys = {}    # IP -> (line prefix, escaped channel names), for scans with non-finite readings
+        self.buffer = collections.deque()
+        self.max_buffered_lines = max_buffered_lines
+        self.buffer_lock = threading.Condition()
+
+        # Metrics, see metrics()
+        self.lines_sent = 0
+        self.batches_sent = 0
+        self.bytes_sent = 0
+        self.dropped_lines = 0
+        self.rejected_lines = 0
+        self.send_errors = 0
+        self.nonfinite_fields = 0   # NaN or infinite readings left out
+
+        self.stop_event = threading.Event()
+        self.senders = [threading.Thread(target=self.run, name="DataQ exporter %d" % i, daemon=True)
+                        for i in range(0, connections)]
+        for sender in self.senders:
+            sender.start()
+
+    # "<measurement>,device=<device> <ch>=%.10g,<ch>=%.10g %d" for one unit, filled in with one scan per line
+    def line_template(self, ip_address):
+        if ip_address not in self.templates:
+            route = self.dataq.routes[ip_address]
+            prefix = "%s,device=%s" % (self.measurement, escape_key(route['device']))
+            keys = [escape_key(name) for name in route['channel_names']]
+            fields = ",".join("%s=%s" % (key.replace('%', '%%'), FIELD_FORMAT) for key in keys)
+            self.templates[ip_address] = "%s %s %%d" % (prefix.replace('%', '%%'), fields)
+            self.field_keys[ip_address] = (prefix, keys)
+        return self.templates[ip_address]
+
+    # Line for a scan with NaN or infinite readings, with only its finite fields, or None if it has none
+    def partial_line(self, ip_address, row, timestamp):
+        prefix, keys = self.field_keys[ip_address]
+        fields = [("%s=" + FIELD_FORMAT) % (key, value) for key, value in zip(keys, row) if np.isfinite(value)]
+        self.nonfinite_fields = self.nonfinite_fields + len(row) - len(fields)
+        if not fields:
+            return None
+        return "%s %s %d" % (prefix, ",".join(fields), timestamp)
+
+    # Turn blocks (as AcquisitionThread.read_block returns them) into lines and queue them
+    def export_blocks(self, blocks):
+        lines = []
+        for block in blocks:
+            template = self.line_template(block['IPAddress'])
+            scan_length = len(self.dataq.routes[block['IPAddress']]['slots'])
+            skip, scans = interleaved_to_scans(block['Values'], block['FirstSlot'], scan_length)
+            scan_times = block['Timestamps'][skip::scan_length][:len(scans)]
+            finite = np.isfinite(scans).all(axis=1)
+            if finite.all():
+                for row, timestamp in zip(scans.tolist(), scan_times.tolist()):
+                    lines.append(template % (*row, timestamp))
+                continue
+            for row, timestamp, row_finite in zip(scans.tolist(), scan_times.tolist(), finite.tolist()):
+                line = template % (*row, timestamp) if row_finite else \
+                       self.partial_line(block['IPAddress'], row, timestamp)
+                if line is not None:
+                    lines.append(line)
+        self.export_lines(lines)
+
+    def export_lines(self, lines):
+        with self.buffer_lock:
+            self.buffer.extend(lines)
+            self.trim_buffer()
+            if len(self.buffer) >= self.batch_lines:
+                self.buffer_lock.notify()
+
+    # Up to batch_lines lines, waiting up to flush_interval for a full batch
+    def take_batch(self):
+        with self.buffer_lock:
+            if len(self.buffer) < self.batch_lines and not self.stop_event.is_set():
+                self.buffer_lock.wait(self.flush_interval)
+            count = min(len(self.buffer), self.batch_lines)
+            return [self.buffer.popleft() for _ in range(0, count)]
+
+    # Put a batch we couldn't send back at the front of the buffer, ahead of newer lines. If that overfills it,
+    #  the same as in export_lines goes: the oldest lines, which are these.
+    def return_batch(self, lines):
+        with self.buffer_lock:
+            self.buffer.extendleft(reversed(lines))
+            self.trim_buffer()
+
+    # Endpoint can't keep up or is down, the oldest data goes first. Called with buffer_lock held.
+    def trim_buffer(self):
+        overflow = len(self.buffer) - self.max_buffered_lines
+        if overflow > 0:
+            for _ in range(0, overflow):
+                self.buffer.popleft()
+            self.dropped_lines = self.dropped_lines + overflow
+
+    def connect(self):
+        port = self.url.port
+        if self.url.scheme == 'tcp':
+            return socket.create_connection((self.url.hostname, port), timeout=self.timeout)
+        if self.url.scheme == 'https':
+            return http.client.HTTPSConnection(self.url.hostname, port or 443, timeout=self.timeout)
+        return http.client.HTTPConnection(self.url.hostname, port or 80, timeout=self.timeout)
+
+    # Returns True once the endpoint took the batch, False if it refused it for good (bad request),
+    #  raises if it couldn't be reached
+    def send(self, connection, body):
+        if self.url.scheme == 'tcp':
+            connection.sendall(body)
+            return True
+
+        path = self.url.path or '/'
+        if self.url.query:
+            path = path + '?' + self.url.query
+        connection.request('POST', path, body=body, headers=self.headers)
+        response = connection.getresponse()
+        response.read()     # Has to be drained before the connection can be reused
+        if response.status < 300:
+            return True
+        if 400 <= response.status < 500 and response.status != 429:
+            print("Line protocol endpoint refused a batch: %d %s" % (response.status, response.reason))
+            return False
+        raise Exception("Line protocol endpoint answered %d %s" % (response.status, response.reason))
+
+    def run(self):
+        connection = None
+        while True:
+            lines = self.take_batch()
+            if not lines:
+                if self.stop_event.is_set():
+                    break
+                continue
+
+            body = ("\n".join(lines) + "\n").encode()
+            if self.use_gzip:
+                body = gzip.compress(body, compresslevel=5)
+
+            sent = False
+            for attempt in range(0, self.retries + 1):
+                try:
+                    if connection is None:
+                        connection = self.connect()
+                    if not self.send(connection, body):
+                        self.rejected_lines = self.rejected_lines + len(lines)
+                    sent = True
+                    break
+                except Exception as e:
+                    self.send_errors = self.send_errors + 1
+                    if connection is not None:
+                        connection.close()
+                    connection = None
+                    if attempt == self.retries:
+                        print("Sending %d lines to %s failed: %s" % (len(lines), self.url.netloc, e))
+                    else:
+                        time.sleep(self.backoff * (2 ** attempt))
+
+            if sent:
+                self.lines_sent = self.lines_sent + len(lines)
+                self.batches_sent = self.batches_sent + 1
+                self.bytes_sent = self.bytes_sent + len(body)
+            elif self.stop_event.is_set():
+                self.dropped_lines = self.dropped_lines + len(lines)     # Shutting down, can't wait out the outage
+            else:
+                # Endpoint is down, keep the lines and wait before trying again
+                self.return_batch(lines)
+                self.stop_event.wait(self.backoff * (2 ** self.retries))
+
+        if connection is not None:
+            connection.close()
+
+    # Send what's buffered and stop the sender threads
+    def close(self, timeout=None):
+        self.stop_event.set()
+        with self.buffer_lock:
+            self.buffer_lock.notify_all()
+        for sender in self.senders:
+            sender.join(timeout)
+
+    def metrics(self):
+        return {'buffered_lines': len(self.buffer),
+                'lines_sent': self.lines_sent,
+                'batches_sent': self.batches_sent,
+                'bytes_sent': self.bytes_sent,
+                'dropped_lines': self.dropped_lines,
+                'rejected_lines': self.rejected_lines,
+                'send_errors': self.send_errors,
+                'nonfinite_fields': self.nonfinite_fields}
+
+
+# Stand-in for a line protocol write endpoint, for trying the exporter without a database. Keeps the lines
+#  it was sent in .lines, answers 204 like InfluxDB does. fail_next makes it answer 503 to the next requests.
+class LineProtocolTestServer(ThreadingHTTPServer):
+    def __init__(self, address=('127.0.0.1', 0)):
+        self.lines = []
+        self.requests = 0
+        self.fail_next = 0
+        self.lock = threading.Lock()
+        super().__init__(address, LineProtocolTestHandler)
+        self.thread = threading.Thread(target=self.serve_forever, name="Line protocol test server", daemon=True)
+        self.thread.start()
+
+    def url(self, path='/api/v2/write?bucket=dataq&precision=ns'):
+        return "http://%s:%d%s" % (self.server_address[0], self.server_address[1], path)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class LineProtocolTestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # Keep alive, so the exporter's connections persist
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+
+        with self.server.lock:
+            self.server.requests = self.server.requests + 1
+            failing = self.server.fail_next > 0
+            if failing:
+                self.server.fail_next = self.server.fail_next - 1
+            else:
+                self.server.lines.extend(body.decode().splitlines())
+
+        self.send_response(503 if failing else 204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-u", "--url", required=False, default=None, type=str,
+                    help="write endpoint to export to, a local stand-in server is used if not given")
+    ap.add_argument("-n", "--blocks", required=False, default=200, type=int,
+                    help="number of 1000 sample blocks to export")
+    ap.add_argument("-z", "--gzip", required=False, action='store_true', help="gzip request bodies")
+    args = vars(ap.parse_args())
+
+    # Just enough of DataQDI4370Ethernet for the exporter, one unit with 4 channels
+    class ExampleUnits:
+        routes = {'192.168.0.80': {'device': 'Strip_Chart_1',
+                                   'channel_names': ['Example_Channel_Name_%02d' % i for i in range(1, 5)]}}
+        routes['192.168.0.80']['slots'] = routes['192.168.0.80']['channel_names']
+
+    server = None
+    url = args['url']
+    if url is None:
+        server = LineProtocolTestServer()
+        server.fail_next = 3    # Start with a short outage, the exporter has to retry
+        url = server.url()
+
+    exporter = LineProtocolExporter(ExampleUnits(), url, use_gzip=args['gzip'], backoff=0.05)
+    start_time = time.perf_counter()
+    start_ns = time.time_ns()
+    for i in range(0, args['blocks']):
+        sample_numbers = np.arange(i * 1000, (i + 1) * 1000, dtype=np.int64)
+        exporter.export_blocks([{'IPAddress': '192.168.0.80', 'FirstSlot': 0,
+                                 'Timestamps': start_ns + (sample_numbers // 4) * 1000000,
+                                 'Values': np.sin(sample_numbers / 100.0)}])
+    exporter.close()
+    elapsed = time.perf_counter() - start_time
+
+    metrics = exporter.metrics()
+    print("Exported %d lines in %d batches (%d bytes) in %0.3f s, %d send errors, %d dropped" % \
+          (metrics['lines_sent'], metrics['batches_sent'], metrics['bytes_sent'], elapsed,
+           metrics['send_errors'], metrics['dropped_lines']))
+    if server is not None:
+        print("Stand-in server got %d lines in %d requests, e.g.\n%s" % \
+              (len(server.lines), server.requests, server.lines[0]))
+        server.close()
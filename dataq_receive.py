@@ -0,0 +1,149 @@
+import select
+import socket
+import struct
+import sys
+
+
+# Linux socket options the socket module doesn't name. With SO_RXQ_OVFL every datagram received after the
+#  kernel had to drop some carries the socket's running drop count, with SO_TIMESTAMPNS every datagram
+#  carries the time (CLOCK_REALTIME, as time.time_ns()) the kernel received it.
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+DROP_COUNT = struct.Struct("@I")
+TIMESPEC = struct.Struct("@qq")
+
+# Roughly what the kernel charges a socket's receive buffer per datagram on top of its data (the sk_buff)
+DATAGRAM_OVERHEAD = 1024
+
+
+# Asks for a receive buffer that holds headroom_seconds of datagrams_per_second datagrams of datagram_size
+#  bytes, so a stall of that long in the receiver doesn't overflow it. Never shrinks the buffer. The kernel
+#  caps the request at net.core.rmem_max, returns (bytes asked for, bytes granted).
+def size_receive_buffer(sock, datagrams_per_second, datagram_size, headroom_seconds=2):
+    requested = int(datagrams_per_second * (datagram_size + DATAGRAM_OVERHEAD) * headroom_seconds)
+    if requested > receive_buffer_size(sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, requested)
+    return requested, receive_buffer_size(sock)
+
+
+# Usable size of a socket's receive buffer, Linux reports double what was set to cover its bookkeeping
+def receive_buffer_size(sock):
+    size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    return size // 2 if sys.platform.startswith('linux') else size
+
+
+# Pool of preallocated receive buffers. Datagrams are read straight into these with recvfrom_into, so
+#  receiving doesn't allocate a new bytes object per datagram. Buffers are handed out round robin, a view
+#  stays valid until the pool wraps around, i.e. for the next count - 1 datagrams.
+class DatagramBufferPool:
+    def __init__(self, count=256, size=2048):
+        self.count = count
+        self.size = size
+        self.buffers = [bytearray(size) for _ in range(count)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.next = 0
+
+        # Last slice handed out for each buffer. The units send fixed size packets, so after the first pass
+        #  through the pool this saves creating a new memoryview per datagram.
+        self.slices = [self.views[i][:0] for i in range(count)]
+
+    # Buffer the next datagram goes into, only given out once advance() is called
+    def current(self):
+        return self.views[self.next]
+
+    # Hands out the current buffer trimmed to nbytes and moves on to the next one
+    def advance(self, nbytes):
+        view = self.slices[self.next]
+        if len(view) != nbytes:
+            view = self.views[self.next][:nbytes]
+            self.slices[self.next] = view
+        self.next = (self.next + 1) % self.count
+        return view
+
+
+# Batched receive on top of a DatagramBufferPool. Each call waits (up to timeout) for the socket to become
+#  readable, then drains as many queued datagrams as it can without blocking again, up to max_batch.
+#  On Linux under load that is many datagrams per wakeup instead of one.
+class DatagramReceiver:
+    def __init__(self, sock, buffer_count=256, buffer_size=2048, max_batch=64):
+        if max_batch > buffer_count:
+            raise Exception("Buffer pool must be at least as large as a batch!")
+
+        self.sock = sock
+        self.pool = DatagramBufferPool(count=buffer_count, size=buffer_size)
+        self.max_batch = max_batch
+
+        self.wakeups = 0
+        self.datagrams = 0
+
+        # With enable_kernel_stats: datagrams the kernel dropped on this socket because its buffer was full,
+        #  and the kernel's receive time of every datagram in the last batch, in the same order
+        self.kernel_stats = False
+        self.kernel_drops = 0
+        self.arrival_ns = []
+        self.ancillary_size = socket.CMSG_SPACE(DROP_COUNT.size) + socket.CMSG_SPACE(TIMESPEC.size)
+
+        self.capture = None     # Anything with write(batch), e.g. dataq_simulator.CaptureWriter, sees every batch
+
+    # Turn on SO_RXQ_OVFL and SO_TIMESTAMPNS, Linux only. Returns False where the kernel doesn't have them,
+    #  receiving then carries on without kernel drop counts or arrival times.
+    def enable_kernel_stats(self):
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        except OSError:
+            return False
+        self.kernel_stats = True
+        return True
+
+    # Returns a list of (memoryview, addr) pairs, empty if nothing arrived before timeout. max_count caps the
+    #  batch below max_batch, anything past it stays queued on the socket for the next call.
+    # The views point into the pool, decode (or copy) them before asking for more than a pool's worth.
+    def receive(self, timeout=None, max_count=None):
+        if self.sock.gettimeout() != 0.0:
+            self.sock.settimeout(0.0)   # Non-blocking, waiting is done by select below
+
+        limit = min(max_count, self.max_batch) if max_count else self.max_batch
+        batch = []
+        if self.kernel_stats:
+            self.arrival_ns = []
+        while len(batch) < limit:
+            view = self.pool.current()
+            try:
+                if self.kernel_stats:
+                    nbytes, ancdata, flags, addr = self.sock.recvmsg_into([view], self.ancillary_size)
+                    self.read_ancillary(ancdata)
+                else:
+                    nbytes, addr = self.sock.recvfrom_into(view)
+            except (BlockingIOError, InterruptedError):
+                if batch:
+                    break   # Drained everything that was queued
+
+                readable = select.select([self.sock], [], [], timeout)[0]
+                if not readable:
+                    break   # Timeout has occurred
+                continue
+            batch.append((self.pool.advance(nbytes), addr))
+
+        if batch:
+            self.wakeups = self.wakeups + 1
+            self.datagrams = self.datagrams + len(batch)
+            if self.capture is not None:
+                self.capture.write(batch)
+        return batch
+
+    # Picks the drop count and arrival time out of one datagram's ancillary data. The drop count only comes
+    #  with datagrams that arrived after a drop, it is left as it was otherwise.
+    def read_ancillary(self, ancdata):
+        arrival_ns = None
+        for level, kind, data in ancdata:
+            if level != socket.SOL_SOCKET:
+                continue
+            if kind == SO_TIMESTAMPNS:
+                seconds, nanoseconds = TIMESPEC.unpack_from(data)
+                arrival_ns = seconds * 1000000000 + nanoseconds
+            elif kind == SO_RXQ_OVFL:
+                self.kernel_drops = DROP_COUNT.unpack_from(data)[0]   # Running total for the socket
+        self.arrival_ns.append(arrival_ns)
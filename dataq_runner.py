@@ -0,0 +1,439 @@
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+from data_di4370_ethernet import DataQDI4370Ethernet, PACKET_LATENCY_MS, RECEIVE_HEADROOM_SECONDS
+
+
+# *** Headless acquisition ***
+# Runs the whole data path (discovery, session bring up, receiver, writer, log/aggregate/export sinks,
+#  telemetry) without a keyboard, for running as a service:
+#
+#   runner = AcquisitionRunner.from_config('dataq.json')
+#   runner.run()            # Until SIGTERM/SIGINT/SIGHUP, or run(duration=60) for a minute
+#
+# or start() and stop() from code that does something else meanwhile. A consumer thread moves complete
+#  blocks from the receiver to the writer and waits on stop_event when there are none, so stopping takes
+#  effect within 10 ms and nothing is polled per packet. stop() drains what has been received, flushes and
+#  closes every writer, then stops the units.
+#
+# The config file is JSON, or YAML if PyYAML is installed:
+#   {"hardware": {"Strip_Chart_1": {"ip_address": "192.168.0.80"}, ...},
+#    "stripcharts": {"Example_Channel_Name_01": {"channel": 6, "strip_chart": "Strip_Chart_1",
+#                                                "daq_scale": 1, "value_scale": 1000}, ...},
+#    "settings": {"sample_rate": 1000, "store": "columnar", ...}}
+# settings take the names of RUNNER_SETTINGS, which are data_di4370_ethernet.py's command line options.
+RUNNER_SETTINGS = {'sample_rate': 1000,
+                   'dec': 1,
+                   'deca': 1,
+                   'packet_size': 'auto',
+                   'packet_latency': PACKET_LATENCY_MS,
+                   'receive_headroom': RECEIVE_HEADROOM_SECONDS,
+                   'log_name': 'example_log/example.log',
+                   'async_setup': False,
+                   'config_cache': 'dataq_config_cache.json',
+                   'discovery_timeout': 3,
+                   'discovery_cache': None,
+                   'discovery_ttl': 60,
+                   'interfaces': None,
+                   'store': 'text',
+                   'store_dir': 'example_log/columnar',
+                   'archive_codec': 'zlib',
+                   'archive_workers': 2,
+                   'retention_days': 30,
+                   'aggregate': False,
+                   'triggers': None,        # List of trigger dictionaries, see dataq_trigger.py
+                   'trigger_pre_ms': 100,
+                   'trigger_post_ms': 100,
+                   'trigger_decimate': 100,  # With triggers, log every Nth scan continuously
+                   'event_dir': 'example_log/events',
+                   'writer_policy': 'block',
+                   'spill_dir': 'example_log/spill',
+                   'export_url': None,
+                   'export_token': None,
+                   'export_gzip': False,
+                   'simulate': False,
+                   'capture': None,
+                   'shards': 0,
+                   'live_ring': False,
+                   'stats_port': None,
+                   'report_interval': 10}    # Seconds between printed summaries, 0 for none
+
+
+# (hardware, stripcharts, settings) from a config file, settings filled in from RUNNER_SETTINGS
+def load_config(path):
+    with open(path) as config_file:
+        if path.endswith('.yaml') or path.endswith('.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise Exception("Reading %s needs PyYAML, or use a JSON config!" % path)
+            config = yaml.safe_load(config_file)
+        else:
+            config = json.load(config_file)
+
+    for key in ['hardware', 'stripcharts']:
+        if not config.get(key):
+            raise Exception("Config %s has no '%s'!" % (path, key))
+    unknown = [key for key in config.get('settings', {}) if key not in RUNNER_SETTINGS]
+    if unknown:
+        raise Exception("Unknown settings in %s: %s!" % (path, ", ".join(unknown)))
+    return config['hardware'], config['stripcharts'], dict(RUNNER_SETTINGS, **config.get('settings', {}))
+
+
+# Rotating text log for text_log_sink, a new file every minute and the last 5 kept
+def create_timed_rotating_log(path):
+    import logging
+    from logging.handlers import TimedRotatingFileHandler
+
+    logger = logging.getLogger("Rotating Log")
+    logger.setLevel(logging.INFO)
+    handler = TimedRotatingFileHandler(path, when="m", interval=1, backupCount=5)
+    logger.addHandler(handler)
+    return logger
+
+
+# Simulated units for settings['simulate'], in a process of their own so they don't compete with us for the GIL
+def run_simulator(ip_addresses):
+    from dataq_simulator import DataQSimulator
+    for name in ['SIGTERM', 'SIGINT', 'SIGHUP']:
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_DFL)    # Forked with the runner's handlers
+    DataQSimulator(ip_addresses).start()
+    while True:
+        time.sleep(60)
+
+
+class AcquisitionRunner:
+    def __init__(self, hardware, stripcharts, settings=None):
+        self.hardware = {name: dict(unit) for name, unit in hardware.items()}
+        self.stripcharts = stripcharts
+        self.settings = dict(RUNNER_SETTINGS, **(settings or {}))
+        self.stop_event = threading.Event()
+
+        # Everything start() sets up, None until then so stop() can clean up after a start that failed halfway
+        self.dataq = None
+        self.simulator = None
+        self.sessions = None
+        self.receiver = None
+        self.live = None
+        self.columnar_logs = {}
+        self.archives = {}
+        self.pyramids = {}
+        self.trigger_engines = {}
+        self.exporter = None
+        self.writer = None
+        self.telemetry_server = None
+        self.consumer = None
+        self.stopped = False
+
+        self.report_time = None
+        self.last_stats = None
+        self.overruns = {}
+
+    @classmethod
+    def from_config(cls, path, **settings):
+        hardware, stripcharts, config_settings = load_config(path)
+        return cls(hardware, stripcharts, dict(config_settings, **settings))
+
+    # SIGTERM (systemd stop), SIGINT (Ctrl+C) and SIGHUP set stop_event, run() then shuts down cleanly.
+    #  Only possible from the main thread.
+    def install_signal_handlers(self):
+        def handler(signum, frame):
+            print("Got signal %d, stopping" % signum)
+            self.stop_event.set()
+
+        for name in ['SIGTERM', 'SIGINT', 'SIGHUP']:
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), handler)
+
+    # Bring the units up and start receiving and logging, returns once every unit is streaming
+    def start(self):
+        settings = self.settings
+
+        # Same units, simulated on loopback addresses with the same last octet
+        broadcast_address = '255.255.255.255'
+        if settings['simulate']:
+            import multiprocessing
+
+            for unit in self.hardware.values():
+                unit['ip_address'] = "127.0.0.%s" % unit['ip_address'].split('.')[-1]
+            broadcast_address = '127.255.255.255'
+            self.simulator = multiprocessing.Process(target=run_simulator, daemon=True,
+                                                     args=([unit['ip_address'] for unit in self.hardware.values()],))
+            self.simulator.start()
+            time.sleep(0.5)
+
+        dataq = DataQDI4370Ethernet(hardware_dict=self.hardware, stripchart_setup_dict=self.stripcharts,
+                                    broadcast_address=broadcast_address)
+        self.dataq = dataq
+        dataq.packet_latency_ms = settings['packet_latency']
+        dataq.receive_headroom_seconds = settings['receive_headroom']
+
+        discovery_cache = None
+        if settings['discovery_cache']:
+            from dataq_discovery import DiscoveryCache
+            discovery_cache = DiscoveryCache(settings['discovery_cache'], ttl=settings['discovery_ttl'])
+        dataq.do_udp_discovery(timeout=settings['discovery_timeout'], cache=discovery_cache,
+                               interfaces=settings['interfaces'].split(',') if settings['interfaces'] else None)
+
+        # Stop anything a previous run left going, then connect and configure
+        from dataq_session import SessionManager
+        self.sessions = SessionManager(dataq)
+        packet_size = settings['packet_size']
+        packet_size = int(packet_size) if packet_size != 'auto' else packet_size
+        if settings['async_setup']:
+            from dataq_config_cache import AppliedConfigCache
+            self.sessions.bring_up(dec=settings['dec'], deca=settings['deca'], sample_rate=settings['sample_rate'],
+                                   packet_size=packet_size, cache=AppliedConfigCache(settings['config_cache']))
+        else:
+            self.sessions.bring_up(dec=settings['dec'], deca=settings['deca'], sample_rate=settings['sample_rate'],
+                                   packet_size=packet_size, use_async=False)
+
+        if settings['capture']:
+            from dataq_simulator import CaptureWriter
+            dataq.receiver.capture = CaptureWriter(settings['capture'])   # Sharded, only the default port is captured
+
+        # Receive and decode on a dedicated thread, or sharded in worker processes
+        if settings['shards']:
+            from dataq_sharded import ShardedAcquisition
+            self.receiver = ShardedAcquisition(dataq, units_per_shard=settings['shards'])
+        else:
+            from dataq_acquisition import AcquisitionThread
+            self.receiver = AcquisitionThread(dataq)
+
+        if settings['live_ring']:
+            from dataq_shm import LivePublisher
+            self.live = LivePublisher(dataq)
+            self.receiver.publisher = self.live
+            print("Live data in shared memory: %s" % ", ".join(self.live.names()))
+
+        self.writer = self.create_writer()
+
+        if settings['stats_port']:
+            from dataq_telemetry_server import TelemetryServer
+            self.telemetry_server = TelemetryServer(dataq, ('127.0.0.1', settings['stats_port']))
+
+        self.receiver.start()
+        self.sessions.start()
+        print(self.sessions.summary())
+
+        self.report_time = time.time()
+        self.consumer = threading.Thread(target=self.consume, name="DataQ consumer", daemon=True)
+        self.consumer.start()
+
+    # Log sink (text, columnar or raw archive), plus aggregation and export if asked for, behind a BlockWriter. With
+    #  triggers the log only gets every trigger_decimate'th scan and full rate data around events goes to
+    #  event_dir, aggregation and export still see every scan.
+    def create_writer(self):
+        from dataq_writer import BlockWriter, text_log_sink, columnar_log_sink
+
+        settings = self.settings
+        dataq = self.dataq
+        if settings['store'] == 'columnar':
+            from dataq_storage import ColumnarLogWriter
+            for ip_address in dataq.routes:
+                self.columnar_logs[ip_address] = ColumnarLogWriter(
+                    os.path.join(settings['store_dir'], dataq.routes[ip_address]['device']),
+                    dataq.routes[ip_address]['channel_names'], retention_days=settings['retention_days'])
+            sinks = [columnar_log_sink(dataq, self.columnar_logs)]
+        elif settings['store'] == 'raw':
+            from dataq_archive import RawArchiveWriter, raw_archive_sink, unit_scales
+            for ip_address in dataq.routes:
+                scales, scale_metadata = unit_scales(dataq, ip_address)
+                self.archives[ip_address] = RawArchiveWriter(
+                    os.path.join(settings['store_dir'], dataq.routes[ip_address]['device']),
+                    dataq.routes[ip_address]['channel_names'], scales, scale_metadata,
+                    codec=settings['archive_codec'], workers=settings['archive_workers'],
+                    retention_days=settings['retention_days'])
+            sinks = [raw_archive_sink(dataq, self.archives)]
+        else:
+            sinks = [text_log_sink(dataq, create_timed_rotating_log(settings['log_name']))]
+
+        if settings['triggers']:
+            from dataq_trigger import create_trigger_engines, trigger_sink
+            self.trigger_engines = create_trigger_engines(dataq, settings['event_dir'], settings['triggers'],
+                                                          pre_ms=settings['trigger_pre_ms'],
+                                                          post_ms=settings['trigger_post_ms'],
+                                                          decimate=settings['trigger_decimate'])
+            sinks = [trigger_sink(dataq, self.trigger_engines, sinks[0])]
+
+        if settings['aggregate']:
+            from dataq_aggregate import AggregationPyramid
+            from dataq_writer import aggregate_sink
+            for ip_address in dataq.routes:
+                self.pyramids[ip_address] = AggregationPyramid(
+                    os.path.join(settings['store_dir'], dataq.routes[ip_address]['device']),
+                    dataq.routes[ip_address]['channel_names'], retention_days=settings['retention_days'])
+            sinks.append(aggregate_sink(dataq, self.pyramids))
+
+        if settings['export_url']:
+            from dataq_exporter import LineProtocolExporter
+            self.exporter = LineProtocolExporter(dataq, settings['export_url'], use_gzip=settings['export_gzip'],
+                                                 headers={'Authorization': 'Token %s' % settings['export_token']} \
+                                                         if settings['export_token'] else None)
+            sinks.append(self.exporter.export_blocks)
+
+        if len(sinks) == 1:
+            sink = sinks[0]
+        else:
+            def sink(batch):
+                for each_sink in sinks:
+                    each_sink(batch)
+
+        return BlockWriter(sink, policy=settings['writer_policy'], spill_dir=settings['spill_dir'],
+                           telemetry=dataq.telemetry)
+
+    # Hands every complete block to the writer. Returns whether there were any.
+    def move_blocks(self):
+        got_block = False
+        for ip_address in self.receiver.rings:
+            block = self.receiver.read_block(ip_address)
+            while block is not None:
+                self.writer.put(block)
+                got_block = True
+                block = self.receiver.read_block(ip_address)
+        return got_block
+
+    # Consumer thread
+    def consume(self):
+        while not self.stop_event.is_set():
+            try:
+                if not self.move_blocks():
+                    self.stop_event.wait(0.01)     # Nothing complete yet, give the receiver the CPU
+            except Exception as e:
+                self.dataq.telemetry.count_exception('consumer', e)    # Keep going, but it shows up in the stats
+                self.stop_event.wait(0.01)
+
+            if self.settings['report_interval'] and time.time() - self.report_time > self.settings['report_interval']:
+                self.report_time = time.time()
+                self.report()
+
+    # Stats summary, gaps, consumer overruns and writer/exporter backlog since the last report
+    def report(self):
+        stats = self.dataq.stats()
+        for line in self.dataq.telemetry.summary_lines(stats, self.last_stats):
+            print(line)
+        self.last_stats = stats
+
+        for gap in self.dataq.sample_clock.take_gaps():
+            print("Gap on %s: expected count %d, got %d, %d samples lost%s" % \
+                  (gap['IPAddress'], gap['ExpectedCount'], gap['CumulativeCount'], gap['LostSamples'],
+                   " while the kernel dropped %d datagrams" % gap['KernelDrops'] if gap.get('KernelDrops') else ""))
+
+        # Let us know if logging has fallen so far behind that the receiver overwrote data
+        for ip_address, counters in self.receiver.overruns().items():
+            if counters['overruns'] != self.overruns.get(ip_address, 0):
+                print("Consumer fell behind on %s, %d samples lost in %d overruns" % \
+                      (ip_address, counters['lost_samples'], counters['overruns']))
+            self.overruns[ip_address] = counters['overruns']
+
+        for ip_address, engine in sorted(self.trigger_engines.items()):
+            print("Triggers on %s: %d events captured, %d triggering scans during captures" % \
+                  (ip_address, engine.events, engine.missed))
+
+        for ip_address, archive in sorted(self.archives.items()):
+            if archive.compressed_bytes:
+                print("Archive of %s: %0.1f MB of counts in %0.1f MB, %0.1fx, %d chunks compressing" % \
+                      (ip_address, archive.raw_bytes / 1e6, archive.compressed_bytes / 1e6,
+                       archive.raw_bytes / archive.compressed_bytes, len(archive.pending)))
+
+        metrics = self.writer.metrics()
+        print("Writer: queue depth %d (max %d), write latency %0.3f s avg / %0.3f s max, %d dropped, %d spilled" % \
+              (metrics['queue_depth'], metrics['max_queue_depth'], metrics['write_latency_avg'],
+               metrics['write_latency_max'], metrics['dropped_blocks'], metrics['spilled_blocks']))
+        if self.exporter is not None:
+            metrics = self.exporter.metrics()
+            print("Exporter: %d lines sent, %d buffered, %d dropped, %d send errors" % \
+                  (metrics['lines_sent'], metrics['buffered_lines'], metrics['dropped_lines'],
+                   metrics['send_errors']))
+
+    # Stop receiving, write out everything received, close every writer and stop the units. Safe to call
+    #  more than once and after a start() that failed.
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.stop_event.set()
+
+        if self.consumer is not None:
+            self.consumer.join(5)
+        if self.receiver is not None:
+            self.receiver.stop()
+            if self.writer is not None:
+                self.move_blocks()     # Whatever completed before the receiver stopped
+        if self.writer is not None:
+            self.writer.close()
+        if self.exporter is not None:
+            self.exporter.close(timeout=10)
+        for columnar_log in self.columnar_logs.values():
+            columnar_log.close()
+        for archive in self.archives.values():
+            archive.close()
+        for pyramid in self.pyramids.values():
+            pyramid.close()
+        for engine in self.trigger_engines.values():
+            engine.close()
+        if self.telemetry_server is not None:
+            self.telemetry_server.close()
+        if self.live is not None:
+            self.live.close()
+
+        if self.dataq is not None:
+            if self.dataq.receiver.capture is not None:
+                self.dataq.receiver.capture.close()
+
+            # Confirmed stop of every unit, or the blind broadcast if they won't confirm
+            try:
+                if self.sessions is None:
+                    raise Exception("No sessions to stop")
+                self.sessions.stop()
+                print(self.sessions.summary())
+            except Exception as e:
+                print("Units did not confirm stopping (%s), broadcasting stop" % e)
+                self.dataq.stop_devices()
+            self.dataq.close()
+
+        if self.simulator is not None:
+            self.simulator.terminate()
+
+    # start(), then wait until stop_event is set (by a signal, or another thread) or duration seconds have
+    #  passed, then stop(). Returns the final stats.
+    def run(self, duration=None):
+        if threading.current_thread() is threading.main_thread():
+            self.install_signal_handlers()
+        end_time = time.monotonic() + duration if duration is not None else None
+        try:
+            self.start()
+            while not self.stop_event.is_set():
+                if end_time is not None and time.monotonic() >= end_time:
+                    break
+                self.stop_event.wait(0.5 if end_time is None else max(0, min(0.5, end_time - time.monotonic())))
+        finally:
+            self.stop()
+        return self.dataq.stats() if self.dataq is not None else None
+
+
+# Service entry point, e.g. ExecStart=/usr/bin/python3 /opt/dataq/dataq_runner.py /etc/dataq/dataq.json
+def main(argv=None):
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Acquire from DataQ units as configured in a config file until stopped")
+    ap.add_argument("config", type=str, help="JSON (or YAML) file with hardware, stripcharts and settings")
+    ap.add_argument("-d", "--duration", required=False, default=None, type=float,
+                    help="stop after this many seconds instead of waiting for a signal")
+    ap.add_argument("--simulate", required=False, action='store_true',
+                    help="run against simulated units on loopback instead of the hardware")
+    args = vars(ap.parse_args(argv))
+
+    runner = AcquisitionRunner.from_config(args['config'], **({'simulate': True} if args['simulate'] else {}))
+    runner.run(args['duration'])
+    print("Bye!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+import asyncio
+import time
+
+from dataq_async import AsyncCommandClient
+from dataq_discovery import discover
+
+
+# *** Unit session lifecycle ***
+# Every unit goes idle -> connected -> configured -> running -> stopping -> idle, and SessionManager only moves
+#  it on once the unit has confirmed the step: its answer to Connect and to each setup command, its first
+#  DQAdcData packet after SyncStart, and its discovery reply (GroupID back to 0) after SyncStop/Disconnect.
+#  That replaces the fixed sleeps and the blind SyncStop/Disconnect broadcast to every group ID, so coming
+#  back up after a crash takes as long as the units take to answer.
+#
+#   sessions = SessionManager(dataq)
+#   sessions.bring_up(sample_rate=1000)     # Recover, connect and configure every unit, packet size to suit
+#   receiver.start()
+#   sessions.start()    # SyncStart, returns once every unit is streaming
+#   ...
+#   receiver.stop()     # Discovery replies come in on the data port, the receiver would eat them
+#   sessions.stop()
+#
+# How long each phase took goes into dataq.telemetry.startup, so it shows up in stats() and /metrics.
+SESSION_TRANSITIONS = {'unknown': ['idle', 'connected', 'running'],     # Whatever discovery finds
+                       'idle': ['connected'],
+                       'connected': ['configured', 'stopping'],
+                       'configured': ['running', 'stopping'],
+                       'running': ['stopping'],
+                       'stopping': ['idle']}
+
+
+# State a unit's discovery reply says it is in
+def discovered_state(reply):
+    if reply['GroupID'] == '0':
+        return 'idle'
+    if reply['ADCRunning'] not in ['0', '']:
+        return 'running'
+    return 'connected'
+
+
+class UnitSession:
+    def __init__(self, ip_address, device):
+        self.ip_address = ip_address
+        self.device = device
+        self.state = 'unknown'
+        self.group_id = None
+        self.history = []   # (state, perf_counter time it was reached)
+
+    def move(self, state):
+        if state not in SESSION_TRANSITIONS[self.state]:
+            raise Exception("DataQ unit on %s can't go from %s to %s!" % (self.ip_address, self.state, state))
+        self.state = state
+        self.history.append((state, time.perf_counter()))
+
+
+class SessionManager:
+    def __init__(self, dataq, timeout=5, poll_interval=0.02):
+        self.dataq = dataq
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.sessions = {chart[1]['ip_address']: UnitSession(chart[1]['ip_address'], chart[0])
+                         for chart in dataq.strip_charts}
+        self.start_time = None
+
+    def states(self):
+        return {ip_address: session.state for ip_address, session in self.sessions.items()}
+
+    def record(self, phase, start_time):
+        self.dataq.telemetry.startup[phase] = time.perf_counter() - start_time
+
+    # Broadcasts discovery over and over until every unit in ip_addresses reports one of states, returns
+    #  their replies keyed by IP
+    def wait_for_state(self, ip_addresses, states, timeout=None):
+        end_time = time.monotonic() + (timeout or self.timeout)
+        channels = [(self.dataq.disc_sock, self.dataq.rec_sock, self.dataq.broadcast_address,
+                     self.dataq.disc_sock.getsockname()[0])]
+        pending = set(ip_addresses)
+        replies = {}
+        while pending:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                raise Exception("DataQ units on %s did not get to %s within %s seconds!" % \
+                                (", ".join(sorted(pending)), " or ".join(states), timeout or self.timeout))
+            for ip_address, reply in discover(channels, min(remaining, 0.5), expected_ips=pending).items():
+                if ip_address in pending and discovered_state(reply) in states:
+                    replies[ip_address] = reply
+                    pending.discard(ip_address)
+            if pending:
+                time.sleep(self.poll_interval)
+        return replies
+
+    # Find out what state every unit is in and bring the ones still in a session back to idle. A unit left
+    #  connected or running by a crashed run is stopped with its own group ID; like the blind broadcast this
+    #  replaces, that also takes a unit away from another computer it is connected to.
+    def recover(self):
+        start_time = time.perf_counter()
+        replies = self.wait_for_state(self.sessions, ['idle', 'connected', 'running'])
+        for ip_address, reply in replies.items():
+            self.sessions[ip_address].state = 'unknown'
+            self.sessions[ip_address].move(discovered_state(reply))
+            self.sessions[ip_address].group_id = int(reply['GroupID'])
+        self.dataq.discovered = replies     # Serial numbers for the config cache
+        self.record('discover', start_time)
+
+        start_time = time.perf_counter()
+        busy = [ip_address for ip_address, session in self.sessions.items() if session.state != 'idle']
+        for ip_address in busy:
+            self.send_stop(ip_address, self.sessions[ip_address].group_id)
+        if busy:
+            print("Stopping DataQ units left in a session: %s" % ", ".join(busy))
+            # The config cache must see them idle now, whatever session they were configured in is gone
+            self.dataq.discovered.update(self.wait_for_state(busy, ['idle']))
+            for ip_address in busy:
+                self.sessions[ip_address].move('idle')
+            self.dataq.read_messages(timeout=0, decode=False)     # Whatever they sent before they stopped
+        self.record('stop', start_time)
+
+    def send_stop(self, ip_address, group_id):
+        for command in ['SyncStop', 'Disconnect']:
+            msg = self.dataq.pack_command(groupid=group_id, command=command)
+            self.dataq.disc_sock.sendto(msg, (ip_address, 51235))   # Device's command receiving port
+        self.sessions[ip_address].move('stopping')
+
+    # Recover, then connect and configure every unit, concurrently with dataq_async.AsyncCommandClient or
+    #  one command at a time with the blocking methods (use_async=False, which doesn't use a cache)
+    def bring_up(self, dec=1, deca=1, sample_rate=1000, packet_size='auto', cache=None, use_async=True):
+        self.start_time = time.perf_counter()
+        self.recover()
+
+        if not use_async:
+            start_time = time.perf_counter()
+            self.dataq.connect_devices()
+            for session in self.sessions.values():
+                session.move('connected')
+                session.group_id = self.dataq.new_group_id
+            self.record('connect', start_time)
+
+            start_time = time.perf_counter()
+            self.dataq.send_setup_commands(dec=dec, deca=deca, sample_rate=sample_rate, packet_size=packet_size)
+            for session in self.sessions.values():
+                session.move('configured')
+            self.record('configure', start_time)
+            return None
+
+        async def run():
+            async with AsyncCommandClient(self.dataq) as client:
+                start_time = time.perf_counter()
+                await client.connect_devices()
+                for session in self.sessions.values():
+                    session.move('connected')
+                    session.group_id = self.dataq.new_group_id
+                self.record('connect', start_time)
+
+                start_time = time.perf_counter()
+                setup_times = await client.send_setup_commands(dec=dec, deca=deca, sample_rate=sample_rate,
+                                                               packet_size=packet_size, cache=cache)
+                for session in self.sessions.values():
+                    session.move('configured')
+                self.record('configure', start_time)
+                return setup_times
+
+        return asyncio.run(run())
+
+    # SyncStart, then wait for every unit's first DQAdcData packet. Needs a receiver (AcquisitionThread)
+    #  decoding, sharded workers only pass their counters on once a second.
+    def start(self, timeout=None):
+        start_time = time.perf_counter()
+        telemetry = self.dataq.telemetry
+        packets = {ip_address: telemetry.devices.get(ip_address, {}).get('packets', 0) for ip_address in self.sessions}
+        self.dataq.start()
+
+        end_time = time.monotonic() + (timeout or self.timeout)
+        pending = set(self.sessions)
+        while pending:
+            for ip_address in list(pending):
+                if telemetry.devices.get(ip_address, {}).get('packets', 0) > packets[ip_address]:
+                    self.sessions[ip_address].move('running')
+                    pending.discard(ip_address)
+            if pending:
+                if time.monotonic() > end_time:
+                    raise Exception("No data from DataQ units on %s after SyncStart!" % ", ".join(sorted(pending)))
+                time.sleep(0.001)
+        self.record('first_data', start_time)
+        if self.start_time is not None:
+            self.record('startup', self.start_time)
+
+    # SyncStop and Disconnect every unit, returns once discovery shows them all idle again. Stop the receiver
+    #  first, discovery replies come in on the data port.
+    def stop(self, timeout=None):
+        start_time = time.perf_counter()
+        for ip_address, session in self.sessions.items():
+            if session.state not in ['idle', 'stopping']:
+                self.send_stop(ip_address, session.group_id)
+        self.wait_for_state(self.sessions, ['idle'], timeout)
+        for session in self.sessions.values():
+            if session.state == 'stopping':
+                session.move('idle')
+        self.record('shutdown', start_time)
+
+    def summary(self):
+        return "Startup: " + ", ".join("%s %0.3f s" % item for item in self.dataq.telemetry.startup.items())
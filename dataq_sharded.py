@@ -0,0 +1,271 @@
+import collections
+import multiprocessing
+import multiprocessing.connection
+import socket
+import threading
+import time
+import numpy as np
+
+from data_di4370_ethernet import DataQDI4370Ethernet, DATAQ_PACKET_SIZES, ADC_HEADER_SIZE
+from dataq_acquisition import AcquisitionThread
+from dataq_receive import DatagramReceiver, receive_buffer_size, size_receive_buffer
+from dataq_telemetry import Telemetry, LatencyHistogram
+from dataq_timestamps import SampleClock
+
+
+# *** Sharded acquisition ***
+# One Python process can only receive and decode so many units before the GIL is the limit. In sharded mode
+#  every unit (or group of units_per_shard units) is pointed at its own data port with the PORT command, and
+#  each port is received and decoded by its own worker process. Workers cut their units' data into blocks and
+#  send them to the coordinator over a pipe as compact NumPy arrays; the coordinator turns them back into the
+#  same block dictionaries AcquisitionThread.read_block returns, so logging and export don't change.
+#
+#   dataq.send_setup_commands()
+#   receiver = ShardedAcquisition(dataq, units_per_shard=1)
+#   receiver.start()    # Assigns ports and starts the workers, before dataq.start()
+#   dataq.start()
+#   ... receiver.read_block(ip_address) as with AcquisitionThread ...
+#   receiver.stop()
+
+STATS_INTERVAL = 1.0    # Seconds between telemetry updates from each worker
+
+
+# The parts of DataQDI4370Ethernet a worker needs to decode its units: routes, scales and the sample clock,
+#  without any of the command sockets. Decoding runs the same code as in a single process.
+class ShardDecoder:
+    decode_adc_message = DataQDI4370Ethernet.decode_adc_message
+    packet_scale_vector = DataQDI4370Ethernet.packet_scale_vector
+
+    def __init__(self, sock, routes, sample_rate, clock_units, buffer_size=ADC_HEADER_SIZE + max(DATAQ_PACKET_SIZES)):
+        self.receiver = DatagramReceiver(sock, buffer_size=buffer_size)
+        self.receiver.enable_kernel_stats()
+        self.gap_kernel_drops = 0
+        self.routes = routes
+        self.packet_scales = {}
+        self.sample_rate = sample_rate
+        self.telemetry = Telemetry()
+
+        # Only used to unwrap CumulativeCount and spot gaps, timestamps are made by the coordinator's clock
+        self.sample_clock = SampleClock()
+        self.sample_clock.units = clock_units
+        self.sample_clock.anchor(0)
+
+
+# Worker process: receive and decode one port, send blocks and telemetry to the coordinator.
+# Messages on the pipe are ('ready', port), ('blocks', [(ip, first_sample_number, values, counts, completed_ns),
+#  ...]) and ('stats', telemetry stats, overruns, gaps). The ring never lets a block run across a gap, so
+#  the sample numbers of a block always run on from the first.
+def run_shard(config, connection, stop_event):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if config['socket_buffer']:
+        requested = config['socket_buffer']
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, requested)
+    else:
+        requested = size_receive_buffer(sock, config['packet_rate'], config['buffer_size'],
+                                        config['headroom_seconds'])[0]
+    sock.bind((config['bind_address'], config['port']))
+
+    decoder = ShardDecoder(sock, config['routes'], config['sample_rate'], config['clock_units'], config['buffer_size'])
+    acquisition = AcquisitionThread(decoder, ring_seconds=config['ring_seconds'],
+                                    block_seconds=config['block_seconds'])
+    acquisition.start()
+    connection.send(('ready', config['port']))
+
+    def send_stats():
+        decoder.telemetry.update_socket("port %d" % config['port'], decoder.receiver.kernel_drops,
+                                        receive_buffer_size(sock), requested)
+        connection.send(('stats', decoder.telemetry.stats(), acquisition.overruns(),
+                         decoder.sample_clock.take_gaps()))
+
+    stats_time = time.monotonic()
+    while not stop_event.is_set():
+        blocks = []
+        for ip_address, ring in acquisition.rings.items():
+            while True:
+                block = ring.read_block()
+                if block is None:
+                    break
+                sample_numbers, values, counts, completed_ns = block
+                blocks.append((ip_address, int(sample_numbers[0]), values, counts, completed_ns))
+
+        if blocks:
+            connection.send(('blocks', blocks))
+        else:
+            time.sleep(0.01)
+
+        if time.monotonic() - stats_time > STATS_INTERVAL:
+            stats_time = time.monotonic()
+            send_stats()
+
+    acquisition.stop()
+    send_stats()
+    sock.close()
+    connection.close()
+
+
+# Coordinator side. Has the consumer interface of AcquisitionThread (start, stop, rings, read_block, overruns),
+#  so it can take its place. rings holds a queue of received blocks per unit, keyed by IP. Each worker's
+#  socket buffer is socket_buffer bytes, or by default sized like rec_sock for the packet rate of its units.
+class ShardedAcquisition(threading.Thread):
+    def __init__(self, dataq, units_per_shard=1, base_port=1240, ring_seconds=10, block_seconds=0.1,
+                 socket_buffer=None):
+        threading.Thread.__init__(self, name="DataQ shard coordinator", daemon=True)
+        self.dataq = dataq
+        self.base_port = base_port
+        self.ring_seconds = ring_seconds
+        self.block_seconds = block_seconds
+        self.socket_buffer = socket_buffer
+
+        ip_addresses = list(dataq.routes)
+        self.shards = [ip_addresses[i:i + units_per_shard] for i in range(0, len(ip_addresses), units_per_shard)]
+
+        # Received blocks waiting for the consumer, the oldest go once a unit has ring_seconds of them queued
+        max_blocks = max(1, int(ring_seconds / block_seconds))
+        self.rings = {ip_address: collections.deque() for ip_address in ip_addresses}
+        self.max_blocks = max_blocks
+        self.dropped = {ip_address: {'overruns': 0, 'lost_samples': 0} for ip_address in ip_addresses}
+
+        self.stop_event = multiprocessing.Event()
+        self.processes = []
+        self.connections = []
+        self.shard_stats = {}       # Shard index -> last ('stats', ...) message
+        self.stats_lock = threading.Lock()
+
+        # As AcquisitionThread.publisher, fed a block at a time as they arrive from the workers
+        self.publisher = None
+
+    # Point every unit at its shard's port, then start the workers. Call before dataq.start(), so no
+    #  samples arrive before the workers are listening.
+    def start(self):
+        bind_address = self.dataq.rec_sock.getsockname()[0]
+        for index, shard in enumerate(self.shards):
+            port = self.base_port + index
+            config = {'port': port,
+                      'bind_address': bind_address,
+                      'socket_buffer': self.socket_buffer,
+                      'buffer_size': self.dataq.socket_buffer_size,
+                      'packet_rate': sum(self.dataq.packet_rates.get(ip_address, 1000) for ip_address in shard),
+                      'headroom_seconds': self.dataq.receive_headroom_seconds,
+                      'routes': {ip_address: self.dataq.routes[ip_address] for ip_address in shard},
+                      'clock_units': {ip_address: dict(self.dataq.sample_clock.units[ip_address]) for ip_address in shard},
+                      'sample_rate': self.dataq.sample_rate,
+                      'ring_seconds': self.ring_seconds,
+                      'block_seconds': self.block_seconds}
+            receiving, sending = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=run_shard, args=(config, sending, self.stop_event),
+                                              name="DataQ shard %d" % index, daemon=True)
+            process.start()
+            sending.close()     # The worker has its own copy, ours would keep the pipe open after it exits
+            self.processes.append(process)
+            self.connections.append(receiving)
+
+        # Only move the units over once their worker is listening
+        for index, connection in enumerate(self.connections):
+            if not connection.poll(30):
+                raise Exception("Shard %d did not start!" % index)
+            message = connection.recv()
+            for ip_address in self.shards[index]:
+                self.dataq.set_data_port(ip_address, message[1])
+                print("DataQ unit on %s sends data to port %d" % (ip_address, message[1]))
+
+        threading.Thread.start(self)
+
+    def run(self):
+        readers = list(self.connections)
+        while readers:
+            for connection in multiprocessing.connection.wait(readers, timeout=0.5):
+                try:
+                    message = connection.recv()
+                except EOFError:
+                    readers.remove(connection)  # Worker has exited
+                    continue
+
+                if message[0] == 'blocks':
+                    for block in message[1]:
+                        self.queue_block(block)
+                elif message[0] == 'stats':
+                    self.update_stats(self.connections.index(connection), message)
+
+    def queue_block(self, block):
+        if self.publisher is not None:
+            self.publisher.publish(block[0], block[1], block[2])
+        ring = self.rings[block[0]]
+        if len(ring) >= self.max_blocks:
+            dropped = ring.popleft()
+            self.dropped[block[0]]['overruns'] += 1
+            self.dropped[block[0]]['lost_samples'] += len(dropped[2])
+        ring.append(block)
+
+    # Fold a worker's telemetry into dataq.telemetry, so dataq.stats() and the demo's reports cover all shards
+    def update_stats(self, index, message):
+        stats, gaps = message[1], message[3]     # message[2], the overruns, is read by overruns()
+        telemetry = self.dataq.telemetry
+        with self.stats_lock:
+            self.shard_stats[index] = message
+            for ip_address, counters in stats['devices'].items():
+                telemetry.devices[ip_address] = counters     # Each unit is only ever in one shard
+            self.dataq.sample_clock.add_gaps(gaps)
+
+            for name in ['decode', 'socket_queue']:
+                histogram = LatencyHistogram()
+                for shard_message in self.shard_stats.values():
+                    shard_histogram = shard_message[1]['histograms'][name]
+                    histogram.counts = [a + b for a, b in zip(histogram.counts,
+                                                              [c for _, c in shard_histogram['buckets']])]
+                    histogram.count = histogram.count + shard_histogram['count']
+                    histogram.total = histogram.total + shard_histogram['sum']
+                    histogram.max = max(histogram.max, shard_histogram['max'])
+                telemetry.histograms[name] = histogram
+
+        with telemetry.lock:
+            telemetry.sockets.update(stats['sockets'])
+        for key, count in stats['exceptions'].items():
+            with telemetry.lock:
+                telemetry.exceptions['shard %d %s' % (index, key)] = count
+        for key, count in stats['timeouts'].items():
+            with telemetry.lock:
+                telemetry.timeouts['shard %d %s' % (index, key)] = count
+
+    # Stop the workers and move the units back to the default data port
+    def stop(self, timeout=5):
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.join(timeout)
+        for shard in self.shards:
+            for ip_address in shard:
+                self.dataq.set_data_port(ip_address, 1234, confirm=False)
+
+    # Next block for a unit, shaped like AcquisitionThread.read_block's, or None if there isn't one
+    def read_block(self, ip_address):
+        try:
+            ip_address, first, values, counts, completed_ns = self.rings[ip_address].popleft()
+        except IndexError:
+            return None
+
+        sample_numbers = np.arange(first, first + len(values), dtype=np.int64)
+        route = self.dataq.routes[ip_address]
+        return {'IPAddress': ip_address,
+                'Device': route['device'],
+                'SampleNumber': first,
+                'FirstSlot': first % len(route['slots']),
+                'SampleNumbers': sample_numbers,
+                'Timestamps': self.dataq.sample_clock.timestamps(ip_address, sample_numbers),
+                'Values': values,
+                'Counts': counts,
+                'Received_ns': completed_ns}
+
+    # Worker ring overruns plus blocks dropped here because the consumer fell behind, per unit
+    def overruns(self):
+        counters = {}
+        with self.stats_lock:
+            for message in self.shard_stats.values():
+                counters.update(message[2])
+        for ip_address in self.rings:
+            unit = dict(counters.get(ip_address, {'overruns': 0, 'lost_samples': 0, 'fill': 0}))
+            unit['overruns'] = unit['overruns'] + self.dropped[ip_address]['overruns']
+            unit['lost_samples'] = unit['lost_samples'] + self.dropped[ip_address]['lost_samples']
+            counters[ip_address] = unit
+        return counters
@@ -0,0 +1,287 @@
+import json
+import os
+import struct
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+
+from dataq_storage import interleaved_to_scans
+
+
+# *** Live data ring in shared memory ***
+# The acquisition process publishes every unit's decoded scans into a shared memory segment named
+#  <prefix>_<device>, as soon as they are decoded. Any number of local processes can map it with
+#  LiveRingReader and get NumPy views of the latest samples per channel, without copying or parsing anything.
+#
+# Segment layout:
+#   LIVE_HEADER   magic, header length, channel count, capacity (scans)
+#   control       two int64: sequence counter, scans ever written
+#   metadata      JSON: channel names, dtype, device, IP
+#   timestamps    int64[2 * capacity], ns since epoch of every scan
+#   values        dtype[channels, 2 * capacity], one row per channel
+# Every scan is written twice, capacity apart, so the latest n scans are always one contiguous slice.
+#
+# The sequence counter is a seqlock: odd while the writer is updating, bumped again when it is done. Readers
+#  take their slices between two reads of it and retry if it changed, so they never see a half written update
+#  and never make the writer wait. Aligned 8 byte stores are atomic and ordered on x86-64; on weaker memory
+#  models (ARM) an occasional torn read is possible.
+LIVE_MAGIC = b'DQLIVE1\0'
+LIVE_HEADER = struct.Struct('<8sIIQ')
+CONTROL_OFFSET = LIVE_HEADER.size
+METADATA_OFFSET = CONTROL_OFFSET + 16
+
+
+def live_ring_name(prefix, device):
+    return "%s_%s" % (prefix, device)
+
+
+# Computes where everything is in a segment
+def live_ring_layout(header_length, channel_count, capacity, dtype):
+    timestamps_offset = header_length
+    values_offset = timestamps_offset + 2 * capacity * 8
+    size = values_offset + channel_count * 2 * capacity * np.dtype(dtype).itemsize
+    return timestamps_offset, values_offset, size
+
+
+# Maps the timestamps, values and control words of a segment as arrays
+def map_live_ring(buffer, header_length, channel_count, capacity, dtype):
+    timestamps_offset, values_offset, _ = live_ring_layout(header_length, channel_count, capacity, dtype)
+    control = np.ndarray(2, dtype='<i8', buffer=buffer, offset=CONTROL_OFFSET)
+    timestamps = np.ndarray(2 * capacity, dtype='<i8', buffer=buffer, offset=timestamps_offset)
+    values = np.ndarray((channel_count, 2 * capacity), dtype=dtype, buffer=buffer, offset=values_offset)
+    return control, timestamps, values
+
+
+# True unless we know process pid is gone
+def process_alive(pid):
+    if not pid or sys.platform == 'win32':
+        return True     # Windows removes a segment with its last handle, one that exists is in use
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass    # Somebody else's, but it is there
+    return True
+
+
+# Writer side of one unit's ring, there must only ever be one writer per segment. A segment of the same name
+#  is only replaced if the process that wrote it has gone, or with replace=True.
+class LiveRingWriter:
+    def __init__(self, name, channel_names, capacity=65536, dtype='<f8', metadata=None, replace=False):
+        self.name = name
+        self.channel_names = list(channel_names)
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+
+        metadata = dict(metadata or {}, channels=self.channel_names, dtype=self.dtype.str, pid=os.getpid())
+        metadata = json.dumps(metadata).encode()
+        header_length = METADATA_OFFSET + len(metadata)
+        header_length = header_length + (-header_length % 64)
+        _, _, size = live_ring_layout(header_length, len(self.channel_names), capacity, self.dtype)
+
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left over from a run that didn't shut down cleanly, readers still holding it keep their copy
+            stale = shared_memory.SharedMemory(name=name)
+            try:
+                magic, header_length = LIVE_HEADER.unpack_from(stale.buf)[:2]
+                writer_pid = json.loads(bytes(stale.buf[METADATA_OFFSET:header_length]).rstrip(b'\0'))['pid'] \
+                             if magic == LIVE_MAGIC else None
+            except (ValueError, KeyError, struct.error):
+                writer_pid = None
+            stale.close()
+            if not replace and (writer_pid is None or process_alive(writer_pid)):
+                raise Exception("Live ring %s is in use%s, stop that writer or pass replace=True!" % \
+                                (name, " by process %d" % writer_pid if writer_pid else ""))
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        self.shm.buf[:METADATA_OFFSET] = bytes(METADATA_OFFSET)
+        self.shm.buf[METADATA_OFFSET:METADATA_OFFSET + len(metadata)] = metadata
+        self.control, self.timestamps, self.values = map_live_ring(self.shm.buf, header_length,
+                                                                   len(self.channel_names), capacity, self.dtype)
+        # Magic goes in last, a reader that finds it can trust the rest of the header
+        self.shm.buf[:LIVE_HEADER.size] = LIVE_HEADER.pack(LIVE_MAGIC, header_length, len(self.channel_names), capacity)
+
+    # Add scans, timestamps is one int64 per scan, scans is (scans, channels)
+    def publish(self, timestamps, scans):
+        count = len(timestamps)
+        if count == 0:
+            return
+        if count > self.capacity:
+            timestamps = timestamps[count - self.capacity:]
+            scans = scans[count - self.capacity:]
+            count = self.capacity
+
+        total = int(self.control[1])
+        start = total % self.capacity
+        first = min(count, self.capacity - start)
+
+        self.control[0] = self.control[0] + 1     # Odd, readers back off
+        for base in [start, start + self.capacity]:
+            self.timestamps[base:base + first] = timestamps[:first]
+            self.values[:, base:base + first] = scans[:first].T
+        if first < count:   # Wrapped, the rest goes at the front of both copies
+            rest = count - first
+            for base in [0, self.capacity]:
+                self.timestamps[base:base + rest] = timestamps[first:]
+                self.values[:, base:base + rest] = scans[first:].T
+        self.control[1] = total + count
+        self.control[0] = self.control[0] + 1     # Even again, update complete
+
+    def close(self, unlink=True):
+        del self.control, self.timestamps, self.values
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+# Publishes decoded data of every unit to its own LiveRingWriter. Packets don't have to hold whole scans, so the
+#  samples of a scan that isn't complete yet are held back until the rest of it arrives.
+class LivePublisher:
+    def __init__(self, dataq, prefix='dataq', capacity=65536, dtype='<f8', replace=False):
+        self.dataq = dataq
+        self.rings = {}
+        self.pending = {}   # IP -> (sample number, samples) of an incomplete scan
+        for ip_address, route in dataq.routes.items():
+            self.rings[ip_address] = LiveRingWriter(live_ring_name(prefix, route['device']), route['channel_names'],
+                                                    capacity=capacity, dtype=dtype,
+                                                    metadata={'device': route['device'], 'ip_address': ip_address},
+                                                    replace=replace)
+            self.pending[ip_address] = None
+
+    # Publish consecutive samples of one unit, first_sample_number is the sample number of values[0]
+    def publish(self, ip_address, first_sample_number, values):
+        pending = self.pending[ip_address]
+        if pending is not None and pending[0] + len(pending[1]) == first_sample_number:
+            first_sample_number = pending[0]
+            values = np.concatenate([pending[1], values])
+
+        scan_length = len(self.dataq.routes[ip_address]['slots'])
+        skip, scans = interleaved_to_scans(values, first_sample_number % scan_length, scan_length)
+        used = skip + len(scans) * scan_length
+        self.pending[ip_address] = (first_sample_number + used, values[used:].copy()) if used < len(values) else None
+
+        if len(scans):
+            scan_starts = np.arange(len(scans), dtype=np.int64) * scan_length + first_sample_number + skip
+            self.rings[ip_address].publish(self.dataq.sample_clock.timestamps(ip_address, scan_starts), scans)
+
+    def names(self):
+        return [ring.name for ring in self.rings.values()]
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+
+
+# Reader side, attach to a unit's ring by name (see live_ring_name). Views it hands out point straight into
+#  shared memory: they were consistent when taken, and stay so until the writer has added capacity - n more
+#  scans. Check with intact(), or pass copy=True for arrays that are yours to keep.
+class LiveRingReader:
+    def __init__(self, name):
+        self.name = name
+        self.shm = shared_memory.SharedMemory(name=name)
+        if sys.version_info < (3, 13):
+            # Before 3.13 attaching registers the segment to be removed when this process exits, it isn't ours
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        magic, header_length, channel_count, capacity = LIVE_HEADER.unpack_from(self.shm.buf)
+        if magic != LIVE_MAGIC:
+            raise Exception("%s is not a DataQ live ring!" % name)
+        metadata = bytes(self.shm.buf[METADATA_OFFSET:header_length]).rstrip(b'\0')
+        self.metadata = json.loads(metadata)
+        self.channels = self.metadata['channels']
+        self.capacity = capacity
+        self.control, self.timestamps, self.values = map_live_ring(self.shm.buf, header_length, channel_count,
+                                                                   capacity, np.dtype(self.metadata['dtype']))
+
+    # Scans ever written
+    def total(self):
+        return int(self.control[1])
+
+    # Returns (total, timestamps, values) for the latest n scans (fewer if not that many have been written yet),
+    #  values has one row per channel, in the order of channels. total is the scan count the snapshot ends at.
+    #  Raises if no consistent snapshot could be taken in timeout seconds, e.g. the writer died mid update.
+    def latest(self, n, copy=False, timeout=1.0):
+        n = min(n, self.capacity)
+        end_time = None
+        while True:
+            sequence = int(self.control[0])
+            if sequence & 1:
+                # Writer is in the middle of an update, it is only ever a few microseconds
+                if end_time is None:
+                    end_time = time.monotonic() + timeout
+                elif time.monotonic() > end_time:
+                    raise Exception("Writer of %s has been in the middle of an update for %g s!" % (self.name, timeout))
+                time.sleep(0.00005)
+                continue
+            total = int(self.control[1])
+            count = min(n, total)
+            end = total % self.capacity + self.capacity
+            timestamps = self.timestamps[end - count:end]
+            values = self.values[:, end - count:end]
+            if copy:
+                timestamps = timestamps.copy()
+                values = values.copy()
+            if int(self.control[0]) == sequence:
+                return total, timestamps, values
+            if end_time is None:
+                end_time = time.monotonic() + timeout
+            elif time.monotonic() > end_time:
+                raise Exception("No consistent snapshot of %s in %g s!" % (self.name, timeout))
+
+    # Latest n scans of one channel, (total, timestamps, values)
+    def channel(self, name, n, copy=False):
+        total, timestamps, values = self.latest(n, copy=copy)
+        return total, timestamps, values[self.channels.index(name)]
+
+    # True while views from a latest(n) snapshot ending at total still hold what they did
+    def intact(self, total, n):
+        return self.total() - total <= self.capacity - n
+
+    # Waits (polling) until more than total scans have been written, returns the new total or None on timeout
+    def wait(self, total, timeout=None, poll_interval=0.0002):
+        end_time = None if timeout is None else time.monotonic() + timeout
+        while True:
+            current = self.total()
+            if current > total:
+                return current
+            if end_time is not None and time.monotonic() > end_time:
+                return None
+            time.sleep(poll_interval)
+
+    def close(self):
+        del self.control, self.timestamps, self.values
+        self.shm.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("name", type=str, help="live ring to watch, e.g. dataq_Strip_Chart_1")
+    ap.add_argument("-n", "--scans", required=False, default=10, type=int, help="scans to average per print")
+    ap.add_argument("-i", "--interval", required=False, default=1.0, type=float, help="seconds between prints")
+    args = vars(ap.parse_args())
+
+    # Prints the latest readings of every channel, and how far behind the newest scan's timestamp we are
+    reader = LiveRingReader(args['name'])
+    total = reader.total()
+    try:
+        while True:
+            total = reader.wait(total, timeout=5)
+            if total is None:
+                print("Nothing new in 5 s")
+                total = reader.total()
+                continue
+            now = time.time_ns()
+            _, timestamps, values = reader.latest(args['scans'])
+            print("%d scans, newest %0.3f ms old: %s" % \
+                  (total, (now - timestamps[-1]) / 1e6,
+                   ", ".join("%s=%0.4f" % (name, value) for name, value in zip(reader.channels, values.mean(axis=1)))))
+            time.sleep(args['interval'])
+    except KeyboardInterrupt:
+        reader.close()
@@ -0,0 +1,392 @@
+import argparse
+import random
+import select
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+from dataq_codec import COMMAND_HEADER, RESPONSE_HEADER, ADC_HEADER, DQCOMMAND, DQRESPONSE, DQADCDATA, \
+    ETHERNET_COMMANDS
+
+
+# *** Simulated DI-4370 units ***
+# Speaks the subset of the DataQ Ethernet protocol data_di4370_ethernet.py uses, so it can be developed and
+#  benchmarked on loopback without hardware:
+#   discovery  'dataq_instruments' broadcast on port 1235, answered with the text reply do_udp_discovery parses
+#   DQCommand  on port 51235, broadcast or unicast: Connect, Disconnect, SyncStart, SyncStop, KeepAlive and
+#              Shared commands (srate, dec, deca, slist, ps, encode, keepalive, port, info, ...), answered with
+#              a DQResponse echoing the command like the units do
+#   DQAdcData  streamed to the client's port 1234 after SyncStart, paced by srate/dec/deca and the scan list
+#              length, with CumulativeCount counting every sample, including the ones dropped on purpose
+#
+# Every unit gets its own loopback address (127.0.0.80, ...), clients broadcast to 127.255.255.255, e.g.
+#   simulator = DataQSimulator(['127.0.0.80', '127.0.0.81'])
+#   simulator.start()
+#   dataq = DataQDI4370Ethernet(hardware_dict={'Strip_Chart_1': {'ip_address': '127.0.0.80'}, ...},
+#                               stripchart_setup_dict=..., broadcast_address='127.255.255.255')
+DISCOVERY_PORT = 1235
+COMMAND_PORT = 51235
+CLIENT_PORT = 1234
+
+COMMAND_NAMES = {value: name for name, value in ETHERNET_COMMANDS.items()}
+
+KEEPALIVE_TIMEOUT = 8   # Seconds without a command before a unit drops its session, unless "keepalive 0"
+
+
+class SimulatedUnit:
+    def __init__(self, simulator, ip_address, order, loss_rate=0.0, loss_burst=1):
+        self.simulator = simulator
+        self.ip_address = ip_address
+        self.order = order
+        self.serial_number = "SIM%05d" % int(ip_address.split('.')[-1])
+        self.mac = "00:80:64:00:00:%02x" % (int(ip_address.split('.')[-1]) % 256)
+        self.loss_rate = loss_rate
+        self.loss_burst = loss_burst
+
+        self.group_id = 0       # 0 is idle
+        self.client = None      # (IP, port) the session's responses and data go to
+        self.keepalive_timeout = KEEPALIVE_TIMEOUT
+        self.last_command = time.monotonic()
+        self.settings = {'srate': 60000, 'dec': 1, 'deca': 1, 'ps': 0, 'encode': 0, 'slist': {}}
+
+        self.stream_thread = None
+        self.streaming = threading.Event()
+        self.packets_sent = 0
+        self.packets_dropped = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((ip_address, COMMAND_PORT))
+
+    def discovery_reply(self):
+        description = "Simulated"
+        return ("%s %s %s %s %d %d %d %s %s %d %d %d" % \
+                (self.ip_address, self.mac, "SIM1", "4370", int(self.streaming.is_set()), 0, len(description),
+                 description, self.serial_number, self.group_id, self.order, 0)).encode('ascii')
+
+    def respond(self, payload):
+        payload = payload.encode('ascii') + b'\r\0'
+        self.sock.sendto(RESPONSE_HEADER.pack(DQRESPONSE, self.group_id, self.order, len(payload)) + payload,
+                         self.client)
+
+    # Handles one DQCommand datagram from addr, broadcast or sent to this unit
+    def handle_command(self, data, addr):
+        if len(data) < COMMAND_HEADER.size:
+            return
+        magic, group_id, command, arg0, arg1, arg2 = COMMAND_HEADER.unpack_from(data)
+        if magic != DQCOMMAND:
+            return
+        command = COMMAND_NAMES.get(command)
+        payload = data[COMMAND_HEADER.size:].split(b'\0')[0].decode('ascii', 'replace').strip()
+
+        if command == 'Connect':
+            if self.group_id not in [0, group_id]:
+                return      # Connected to somebody else, the real units ignore us too
+            self.group_id = group_id
+            client_ip = payload if payload and payload != '0.0.0.0' else addr[0]
+            self.client = (client_ip, self.simulator.client_port)
+            self.last_command = time.monotonic()
+            self.respond('connected')
+            return
+
+        if self.group_id == 0 or group_id != self.group_id:
+            return      # Not our session
+        self.last_command = time.monotonic()
+
+        if command == 'SyncStart':
+            self.start_stream()
+        elif command == 'SyncStop':
+            self.stop_stream()
+        elif command == 'Disconnect':
+            self.drop_session()
+        elif command == 'Shared':
+            self.respond(self.shared_command(payload))
+            if payload.startswith('port '):    # Confirmed on the old port, everything after goes to the new one
+                self.client = (self.client[0], int(payload.split()[1]))
+
+    # Applies a Shared command, returns the response payload
+    def shared_command(self, payload):
+        words = payload.split()
+        if not words:
+            return payload
+        name, args = words[0], words[1:]
+
+        if name in ['srate', 'dec', 'deca', 'ps', 'encode'] and args:
+            self.settings[name] = int(args[0])
+        elif name == 'slist' and len(args) == 2:
+            self.settings['slist'][int(args[0])] = int(args[1])
+        elif name == 'keepalive' and args:
+            self.keepalive_timeout = None if int(args[0]) == 0 else KEEPALIVE_TIMEOUT
+        elif name == 'info' and args:
+            info = {'0': 'DATAQ', '1': '4370', '2': 'SIM1', '6': self.serial_number}
+            return "%s %s" % (payload, info.get(args[0], '0'))
+        return payload
+
+    def drop_session(self):
+        self.stop_stream()
+        self.group_id = 0
+        self.client = None
+        self.keepalive_timeout = KEEPALIVE_TIMEOUT
+
+    def check_keepalive(self):
+        if self.group_id and self.keepalive_timeout is not None and \
+           time.monotonic() - self.last_command > self.keepalive_timeout:
+            print("Simulated unit %s: no KeepAlive for %d s, dropping session" % \
+                  (self.ip_address, self.keepalive_timeout))
+            self.drop_session()
+
+    def start_stream(self):
+        self.stop_stream()
+        self.streaming.set()
+        self.stream_thread = threading.Thread(target=self.stream, name="Simulated %s" % self.ip_address, daemon=True)
+        self.stream_thread.start()
+
+    def stop_stream(self):
+        self.streaming.clear()
+        if self.stream_thread is not None and self.stream_thread is not threading.current_thread():
+            self.stream_thread.join()
+        self.stream_thread = None
+
+    # One sine wave per scan list slot, each with its own phase, interleaved like the unit sends them.
+    #  Doubled so a packet starting anywhere in the first period can be sliced out without wrapping, as long as
+    #  a period (in samples) is longer than a packet.
+    def waveform(self, scan_length, period=1000):
+        phases = np.arange(scan_length) / max(scan_length, 1)
+        scans = np.arange(period)[:, None] / period + phases[None, :]
+        table = (np.sin(2 * np.pi * scans) * 16000).astype('<i2').ravel()
+        return np.concatenate([table, table])
+
+    def stream(self):
+        scan_length = max(1, len(self.settings['slist']))
+        samples_per_packet = (16 << self.settings['ps']) // 2
+        sample_rate = 60e6 / (self.settings['srate'] * self.settings['dec'] * self.settings['deca']) * scan_length
+        table = self.waveform(scan_length, period=max(1000, samples_per_packet // scan_length + 1))
+        period = len(table) // 2
+        group_id = self.group_id
+
+        sent_samples = 0    # Including the ones dropped on purpose, CumulativeCount keeps counting those
+        drop = 0
+        start_time = time.perf_counter()
+        while self.streaming.is_set():
+            if self.simulator.realtime:
+                due = start_time + (sent_samples + samples_per_packet) / sample_rate
+                wait = due - time.perf_counter()
+                if wait > 0.001:    # Behind schedule (or close to it) just send, so we catch up in a burst
+                    time.sleep(wait)
+
+            if drop == 0 and self.loss_rate and random.random() < self.loss_rate:
+                drop = self.loss_burst
+            if drop:
+                drop = drop - 1
+                self.packets_dropped = self.packets_dropped + 1
+            else:
+                offset = sent_samples % period
+                packet = ADC_HEADER.pack(DQADCDATA, group_id, self.order, sent_samples % (1 << 32),
+                                         samples_per_packet) + table[offset:offset + samples_per_packet].tobytes()
+                try:
+                    self.sock.sendto(packet, self.client)     # Follows a PORT command while streaming
+                except (OSError, TypeError):
+                    pass    # ENOBUFS at max speed or the session just dropped, lost like it would be on the wire
+                self.packets_sent = self.packets_sent + 1
+            sent_samples = sent_samples + samples_per_packet
+
+
+# Runs a set of simulated units: one control thread for discovery and commands, one thread per streaming unit.
+#  realtime=False streams as fast as the sockets go, for throughput testing.
+class DataQSimulator:
+    def __init__(self, ip_addresses, broadcast_address='127.255.255.255', client_port=CLIENT_PORT,
+                 loss_rate=0.0, loss_burst=1, realtime=True):
+        self.broadcast_address = broadcast_address
+        self.client_port = client_port
+        self.realtime = realtime
+        self.units = [SimulatedUnit(self, ip_address, order, loss_rate=loss_rate, loss_burst=loss_burst)
+                      for order, ip_address in enumerate(ip_addresses)]
+
+        self.discovery_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.discovery_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.discovery_sock.bind((broadcast_address, DISCOVERY_PORT))
+        self.broadcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.broadcast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.broadcast_sock.bind((broadcast_address, COMMAND_PORT))
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="DataQ simulator", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print("Simulating DataQ units on %s" % ", ".join(unit.ip_address for unit in self.units))
+
+    def run(self):
+        sockets = [self.discovery_sock, self.broadcast_sock] + [unit.sock for unit in self.units]
+        while not self.stop_event.is_set():
+            for sock in select.select(sockets, [], [], 0.5)[0]:
+                try:
+                    data, addr = sock.recvfrom(2048)
+                except OSError:
+                    continue
+
+                if sock is self.discovery_sock:
+                    if data.startswith(b'dataq_instruments'):
+                        for unit in self.units:     # Replies go to the client's port, from the unit's address
+                            unit.sock.sendto(unit.discovery_reply(), (addr[0], self.client_port))
+                elif sock is self.broadcast_sock:
+                    for unit in self.units:
+                        unit.handle_command(data, addr)
+                else:
+                    for unit in self.units:
+                        if unit.sock is sock:
+                            unit.handle_command(data, addr)
+
+            for unit in self.units:
+                unit.check_keepalive()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        for unit in self.units:
+            unit.stop_stream()
+            unit.sock.close()
+        self.discovery_sock.close()
+        self.broadcast_sock.close()
+
+
+# *** Raw packet capture and replay ***
+# A capture file is CAPTURE_MAGIC followed by one record per datagram: CAPTURE_RECORD (receive time in ns
+#  since epoch, source IPv4 address, source port, datagram length), then the datagram itself.
+CAPTURE_MAGIC = b'DQCAP1\n\0'
+CAPTURE_RECORD = struct.Struct('<q4sHH')
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.capture_file = open(path, 'wb')
+        self.capture_file.write(CAPTURE_MAGIC)
+        self.datagrams = 0
+
+    # batch is a list of (data, addr) pairs as DatagramReceiver.receive returns them
+    def write(self, batch, time_ns=None):
+        time_ns = time.time_ns() if time_ns is None else time_ns
+        for data, addr in batch:
+            self.capture_file.write(CAPTURE_RECORD.pack(time_ns, socket.inet_aton(addr[0]), addr[1], len(data)))
+            self.capture_file.write(data)
+        self.datagrams = self.datagrams + len(batch)
+
+    def close(self):
+        self.capture_file.close()
+
+
+# Yields (time_ns, addr, data) for every datagram in a capture file
+def read_capture(path):
+    with open(path, 'rb') as capture_file:
+        if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise Exception("%s is not a DataQ capture!" % path)
+        while True:
+            record = capture_file.read(CAPTURE_RECORD.size)
+            if len(record) < CAPTURE_RECORD.size:
+                break
+            time_ns, ip, port, length = CAPTURE_RECORD.unpack(record)
+            data = capture_file.read(length)
+            if len(data) < length:
+                break   # Capture was cut off mid record
+            yield time_ns, (socket.inet_ntoa(ip), port), data
+
+
+# Sends a capture to target (host, port) again, each datagram from the loopback address address_map gives
+#  its original source (by default 127.0.0.<last octet>, so 192.168.0.80 replays from 127.0.0.80) so the
+#  client still tells the units apart. speed 1 keeps the original timing, 2 is twice as fast, 0 is as fast
+#  as possible. Returns the number of datagrams sent.
+def replay(path, target, speed=1.0, address_map=None):
+    address_map = dict(address_map or {})
+    sockets = {}
+    start_time = None
+    first_ns = None
+    count = 0
+    for time_ns, addr, data in read_capture(path):
+        if addr[0] not in sockets:
+            source = address_map.get(addr[0], "127.0.0.%s" % addr[0].split('.')[-1])
+            sockets[addr[0]] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sockets[addr[0]].bind((source, 0))
+
+        if speed:
+            if start_time is None:
+                start_time = time.perf_counter()
+                first_ns = time_ns
+            wait = start_time + (time_ns - first_ns) / 1e9 / speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+        sockets[addr[0]].sendto(data, target)
+        count = count + 1
+
+    for sock in sockets.values():
+        sock.close()
+    return count
+
+
+# Records every datagram arriving on port (e.g. from units another program has started) until duration runs out
+def capture(path, port=CLIENT_PORT, ip_address='', duration=10):
+    from dataq_receive import DatagramReceiver
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((ip_address, port))
+    receiver = DatagramReceiver(sock, buffer_size=4096)
+    writer = CaptureWriter(path)
+    end_time = time.monotonic() + duration
+    while time.monotonic() < end_time:
+        batch = receiver.receive(min(0.5, max(0.0, end_time - time.monotonic())))
+        if batch:
+            writer.write(batch)
+    writer.close()
+    sock.close()
+    return writer.datagrams
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest='mode', required=True)
+
+    simulate_ap = sub.add_parser('simulate', help="run simulated units until interrupted")
+    simulate_ap.add_argument("-u", "--units", nargs='+', default=['127.0.0.80', '127.0.0.81'],
+                             help="loopback address of each simulated unit")
+    simulate_ap.add_argument("-b", "--broadcast-address", default='127.255.255.255', type=str)
+    simulate_ap.add_argument("-p", "--client-port", default=CLIENT_PORT, type=int,
+                             help="port the client receives responses and data on")
+    simulate_ap.add_argument("-l", "--loss-rate", default=0.0, type=float, help="chance of dropping a packet")
+    simulate_ap.add_argument("--loss-burst", default=1, type=int, help="packets dropped in a row per loss")
+    simulate_ap.add_argument("--max-speed", action='store_true', help="stream as fast as possible")
+
+    capture_ap = sub.add_parser('capture', help="record datagrams arriving on a port to a file")
+    capture_ap.add_argument("file", type=str)
+    capture_ap.add_argument("-p", "--port", default=CLIENT_PORT, type=int)
+    capture_ap.add_argument("-d", "--duration", default=10, type=float)
+
+    replay_ap = sub.add_parser('replay', help="play a capture back to a client")
+    replay_ap.add_argument("file", type=str)
+    replay_ap.add_argument("-t", "--target", default='127.0.0.1:%d' % CLIENT_PORT, type=str, help="host:port")
+    replay_ap.add_argument("-s", "--speed", default=1.0, type=float, help="1 is real time, 0 is max speed")
+    args = vars(ap.parse_args())
+
+    if args['mode'] == 'simulate':
+        simulator = DataQSimulator(args['units'], broadcast_address=args['broadcast_address'],
+                                   client_port=args['client_port'], loss_rate=args['loss_rate'],
+                                   loss_burst=args['loss_burst'], realtime=not args['max_speed'])
+        simulator.start()
+        try:
+            while True:
+                time.sleep(10)
+                for unit in simulator.units:
+                    print("%s: group %d, %s, %d packets sent, %d dropped" % \
+                          (unit.ip_address, unit.group_id, "streaming" if unit.streaming.is_set() else "idle",
+                           unit.packets_sent, unit.packets_dropped))
+        except KeyboardInterrupt:
+            simulator.stop()
+    elif args['mode'] == 'capture':
+        print("Captured %d datagrams" % capture(args['file'], port=args['port'], duration=args['duration']))
+    else:
+        host, port = args['target'].rsplit(':', 1)
+        start_time = time.perf_counter()
+        count = replay(args['file'], (host, int(port)), speed=args['speed'])
+        print("Replayed %d datagrams in %0.3f s" % (count, time.perf_counter() - start_time))
@@ -0,0 +1,235 @@
+import datetime
+import json
+import mmap
+import os
+import struct
+import numpy as np
+
+
+# *** Columnar acquisition log ***
+# One directory per unit, one segment per UTC day in that directory:
+#   YYYYMMDD.dqc  data file - header, then chunks of scans. A chunk is <rows> int64 timestamps (ns since epoch)
+#                 followed by one column of <rows> values per channel, padded to a multiple of 8 bytes
+#   YYYYMMDD.dqi  chunk index - one CHUNK_INDEX record per chunk: first and last timestamp, file offset, rows
+# The index is only appended after its chunk is on disk, so a reader never sees a chunk that isn't complete.
+SEGMENT_MAGIC = b'DQCOL1\n\0'
+CHUNK_INDEX = struct.Struct('<qqQQ')
+CHUNK_INDEX_DTYPE = np.dtype([('t_start', '<i8'), ('t_end', '<i8'), ('offset', '<u8'), ('rows', '<u8')])
+
+
+DAY_NS = 86400 * 1000000000
+
+
+# UTC day of a timestamp, in whole nanoseconds so it agrees with segment_end() right up to midnight
+def segment_name(timestamp_ns):
+    day = int(timestamp_ns) // DAY_NS
+    return datetime.datetime.fromtimestamp(day * 86400, datetime.timezone.utc).strftime('%Y%m%d')
+
+
+# First timestamp (ns) of the day after the one timestamp_ns is in
+def segment_end(timestamp_ns):
+    return (int(timestamp_ns) // DAY_NS + 1) * DAY_NS
+
+
+# Parses the header at the start of a data file, raises if it isn't one
+def read_segment_header(data):
+    if data[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+        raise Exception("Not a columnar DataQ log!")
+    header_length = struct.unpack_from('<I', data, len(SEGMENT_MAGIC))[0]
+    header = json.loads(data[len(SEGMENT_MAGIC) + 4:len(SEGMENT_MAGIC) + 4 + header_length])
+    header['dtype'] = np.dtype(header['dtype'])
+    return header
+
+
+# Splits an interleaved block of readings into whole scans, one row per scan and one column per scan list
+#  slot. Samples before the first complete scan and after the last one are dropped. Returns the index of
+#  the first sample used and the (scans, scan_length) array.
+def interleaved_to_scans(values, first_slot, scan_length):
+    skip = (scan_length - first_slot) % scan_length
+    scans = max(0, (len(values) - skip) // scan_length)
+    return skip, values[skip:skip + scans * scan_length].reshape(scans, scan_length)
+
+
+# Appends scans for one unit to its columnar log. Rows are buffered until a chunk is full, so a chunk is
+#  written with one write call.
+class ColumnarLogWriter:
+    def __init__(self, directory, channel_names, chunk_rows=4096, dtype='<f4', retention_days=None):
+        self.directory = directory
+        self.channel_names = list(channel_names)
+        self.chunk_rows = chunk_rows
+        self.dtype = np.dtype(dtype)
+        self.retention_days = retention_days
+        os.makedirs(directory, exist_ok=True)
+
+        self.timestamps = np.zeros(chunk_rows, dtype='<i8')
+        self.values = np.zeros((len(self.channel_names), chunk_rows), dtype=self.dtype)
+        self.rows = 0
+
+        self.segment = None
+        self.data_file = None
+        self.index_file = None
+
+    def open_segment(self, segment):
+        self.close_segment()
+        data_path = os.path.join(self.directory, segment + '.dqc')
+        new_file = not os.path.exists(data_path)
+
+        # Carrying on with today's segment after a restart is fine, as long as the channels are the same
+        if not new_file:
+            with open(data_path, 'rb') as data_file:
+                header = read_segment_header(data_file.read(65536))
+            if header['channels'] != self.channel_names or header['dtype'] != self.dtype:
+                raise Exception("%s was written with a different channel setup!" % data_path)
+
+        self.data_file = open(data_path, 'ab')
+        self.index_file = open(os.path.join(self.directory, segment + '.dqi'), 'ab')
+        self.segment = segment
+
+        if new_file:
+            header = json.dumps({'channels': self.channel_names, 'dtype': self.dtype.str}).encode()
+            header = SEGMENT_MAGIC + struct.pack('<I', len(header)) + header
+            header = header + b'\0' * (-len(header) % 64)     # Keep chunks 8 byte aligned for the reader
+            self.data_file.write(header)
+            self.data_file.flush()
+            self.expire_segments()
+
+    def close_segment(self):
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+        self.data_file = None
+        self.index_file = None
+        self.segment = None
+
+    # Remove segments older than retention_days
+    def expire_segments(self):
+        if self.retention_days is None:
+            return
+        oldest = (datetime.datetime.now(datetime.timezone.utc) - \
+                  datetime.timedelta(days=self.retention_days)).strftime('%Y%m%d')
+        for name in os.listdir(self.directory):
+            if name.endswith(('.dqc', '.dqi')) and name[:8] < oldest:
+                os.remove(os.path.join(self.directory, name))
+
+    # Add scans, timestamps is one int64 ns timestamp per scan, values is (scans, channels)
+    def append(self, timestamps, values):
+        start = 0
+        while start < len(timestamps):
+            # A chunk never spans two days, so it can't straddle two segments
+            if self.rows and segment_name(timestamps[start]) != segment_name(self.timestamps[0]):
+                self.write_chunk()
+
+            # and only takes rows up to midnight of its first row's day
+            day_end = segment_end(self.timestamps[0] if self.rows else timestamps[start])
+            count = min(self.chunk_rows - self.rows, int(np.searchsorted(timestamps[start:], day_end)))
+            self.timestamps[self.rows:self.rows + count] = timestamps[start:start + count]
+            self.values[:, self.rows:self.rows + count] = values[start:start + count].T
+            self.rows = self.rows + count
+            start = start + count
+
+            if self.rows == self.chunk_rows:
+                self.write_chunk()
+
+    def write_chunk(self):
+        if self.rows == 0:
+            return
+
+        segment = segment_name(self.timestamps[0])
+        if segment != self.segment:
+            self.open_segment(segment)
+
+        rows = self.rows
+        chunk = self.timestamps[:rows].tobytes() + self.values[:, :rows].tobytes()
+        chunk = chunk + b'\0' * (-len(chunk) % 8)
+
+        offset = self.data_file.tell()
+        self.data_file.write(chunk)
+        self.data_file.flush()
+        self.index_file.write(CHUNK_INDEX.pack(int(self.timestamps[0]), int(self.timestamps[rows - 1]), offset, rows))
+        self.index_file.flush()
+        self.rows = 0
+
+    # Write whatever is buffered as a (short) chunk
+    def flush(self):
+        self.write_chunk()
+
+    def close(self):
+        self.flush()
+        self.close_segment()
+
+
+# Reads a unit's columnar log through mmap. Only the chunks overlapping the requested window are touched,
+#  and nothing is parsed: columns come straight out of the mapped files as NumPy arrays.
+class ColumnarLogReader:
+    def __init__(self, directory):
+        self.directory = directory
+        self.maps = {}      # segment -> (file, mmap, header)
+
+    def segments(self):
+        return sorted(name[:-4] for name in os.listdir(self.directory) if name.endswith('.dqc'))
+
+    def open_segment(self, segment):
+        data_path = os.path.join(self.directory, segment + '.dqc')
+        size = os.path.getsize(data_path)
+        if segment in self.maps and len(self.maps[segment][1]) == size:
+            return self.maps[segment]
+
+        if segment in self.maps:    # The writer has added chunks since we mapped it
+            self.maps[segment][0].close()   # The old map stays alive for as long as arrays still point into it
+
+        data_file = open(data_path, 'rb')
+        mapped = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = read_segment_header(mapped)
+
+        self.maps[segment] = (data_file, mapped, header)
+        return self.maps[segment]
+
+    def chunk_index(self, segment):
+        return np.fromfile(os.path.join(self.directory, segment + '.dqi'), dtype=CHUNK_INDEX_DTYPE)
+
+    def channels(self):
+        segments = self.segments()
+        return self.open_segment(segments[-1])[2]['channels'] if segments else []
+
+    # Returns (timestamps, values) for one channel between t_start and t_end (ns since epoch, inclusive)
+    def read(self, channel, t_start=None, t_end=None):
+        t_start = np.iinfo(np.int64).min if t_start is None else t_start
+        t_end = np.iinfo(np.int64).max if t_end is None else t_end
+
+        timestamps = []
+        values = []
+        for segment in self.segments():
+            index = self.chunk_index(segment)
+            index = index[(index['t_end'] >= t_start) & (index['t_start'] <= t_end)]
+            if len(index) == 0:
+                continue
+
+            _, mapped, header = self.open_segment(segment)
+            column = header['channels'].index(channel)
+            itemsize = header['dtype'].itemsize
+            for t_first, t_last, offset, rows in index.tolist():
+                chunk_times = np.frombuffer(mapped, dtype='<i8', count=rows, offset=offset)
+                chunk_values = np.frombuffer(mapped, dtype=header['dtype'], count=rows,
+                                             offset=offset + rows * 8 + column * rows * itemsize)
+                if t_first < t_start or t_last > t_end:     # Only part of this chunk is in the window
+                    keep = slice(np.searchsorted(chunk_times, t_start, 'left'),
+                                 np.searchsorted(chunk_times, t_end, 'right'))
+                    chunk_times = chunk_times[keep]
+                    chunk_values = chunk_values[keep]
+                timestamps.append(chunk_times)
+                values.append(chunk_values)
+
+        if not timestamps:
+            return np.zeros(0, dtype='<i8'), np.zeros(0, dtype=np.float32)
+        if len(timestamps) == 1:
+            return timestamps[0], values[0]     # Zero copy, straight out of the map
+        return np.concatenate(timestamps), np.concatenate(values)
+
+    def close(self):
+        for data_file, mapped, header in self.maps.values():
+            data_file.close()
+            try:
+                mapped.close()
+            except BufferError:
+                pass    # Arrays we handed out still use it, it goes away with them
+        self.maps = {}
@@ -0,0 +1,199 @@
+import bisect
+import threading
+import time
+
+
+# Histogram bucket upper bounds in seconds, 4 per decade from 1 us to 10 s, anything slower goes in the last
+#  (overflow) bucket
+LATENCY_BUCKETS = tuple(1e-6 * 10 ** (i / 4) for i in range(0, 29))
+
+
+# Fixed bucket latency histogram, cheap enough to observe every packet. Quantiles are estimated as the upper
+#  bound of the bucket they fall in, so they are at most one bucket (~78%) high.
+class LatencyHistogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen = seen + count
+            if seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.total,
+                'avg': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99),
+                'buckets': [[bound, count] for bound, count in zip(self.bounds + (float('inf'),), self.counts)]}
+
+
+# Counters and histograms for the data path. Per unit (keyed by IP): packets, bytes and samples decoded,
+#  CumulativeCount gaps and samples lost in them, and resyncs (the count jumping back, e.g. the unit restarted). Overall: decode time and receive-to-write latency
+#  histograms, socket timeouts by where they happened and exceptions by where and type.
+#
+# The receiver thread is the only one counting packets, so those are plain attribute updates; timeouts
+#  and exceptions can come from any thread and go through the lock.
+class Telemetry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.time()
+        self.devices = {}
+        self.histograms = {'decode': LatencyHistogram(), 'recv_to_write': LatencyHistogram(),
+                           'socket_queue': LatencyHistogram()}     # Kernel receive time to decoded
+        self.timeouts = {}
+        self.exceptions = {}    # "where:ExceptionType" -> count
+        self.unknown_packets = 0
+        self.startup = {}       # Phase -> seconds it took, see dataq_session.SessionManager
+        self.sockets = {}       # Receiving socket -> kernel drops and receive buffer size, see update_socket
+
+    def device(self, ip_address, device=None):
+        counters = self.devices.get(ip_address)
+        if counters is None:
+            counters = {'device': device, 'packets': 0, 'bytes': 0, 'samples': 0, 'gaps': 0, 'lost_samples': 0,
+                        'kernel_gaps': 0, 'kernel_lost_samples': 0, 'resyncs': 0, 'last_packet_time': None}
+            self.devices[ip_address] = counters
+        return counters
+
+    def count_packet(self, ip_address, device, samples, nbytes, decode_seconds):
+        counters = self.device(ip_address, device)
+        counters['packets'] += 1
+        counters['bytes'] += nbytes
+        counters['samples'] += samples
+        counters['last_packet_time'] = time.time()
+        self.histograms['decode'].observe(decode_seconds)
+
+    # kernel is True when the receiving socket dropped datagrams since the last gap, i.e. the samples were
+    #  lost on this computer rather than on the network or by the unit. A count that went backwards lost
+    #  nothing we can count, it is a resync.
+    def count_gap(self, ip_address, lost_samples, kernel=False):
+        counters = self.device(ip_address)
+        if lost_samples < 0:
+            counters['resyncs'] += 1
+            return
+        counters['gaps'] += 1
+        counters['lost_samples'] += lost_samples
+        if kernel:
+            counters['kernel_gaps'] += 1
+            counters['kernel_lost_samples'] += lost_samples
+
+    # Kernel side of a receiving socket: datagrams dropped because its buffer was full, the buffer's size
+    #  and what was asked for
+    def update_socket(self, where, dropped_datagrams, receive_buffer, requested_buffer=None):
+        with self.lock:
+            self.sockets[where] = {'dropped_datagrams': dropped_datagrams,
+                                   'receive_buffer': receive_buffer,
+                                   'requested_buffer': requested_buffer}
+
+    def count_timeout(self, where):
+        with self.lock:
+            self.timeouts[where] = self.timeouts.get(where, 0) + 1
+
+    def count_exception(self, where, exception):
+        key = "%s:%s" % (where, type(exception).__name__)
+        with self.lock:
+            self.exceptions[key] = self.exceptions.get(key, 0) + 1
+
+    def observe(self, histogram, seconds):
+        self.histograms[histogram].observe(seconds)
+
+    # Snapshot of everything as plain dicts and numbers, safe to json.dumps
+    def stats(self):
+        with self.lock:
+            return {'time': time.time(),
+                    'uptime': time.time() - self.start_time,
+                    'devices': {ip_address: dict(counters) for ip_address, counters in list(self.devices.items())},
+                    'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+                    'timeouts': dict(self.timeouts),
+                    'exceptions': dict(self.exceptions),
+                    'unknown_packets': self.unknown_packets,
+                    'startup': dict(self.startup),
+                    'sockets': {where: dict(counters) for where, counters in self.sockets.items()}}
+
+    # One line per unit plus latencies and errors, rates are since the previous snapshot if one is given
+    def summary_lines(self, stats, previous=None):
+        elapsed = stats['time'] - previous['time'] if previous else stats['uptime']
+        lines = []
+        for ip_address, counters in sorted(stats['devices'].items()):
+            before = previous['devices'].get(ip_address, {}) if previous else {}
+            samples = counters['samples'] - before.get('samples', 0)
+            lines.append("%s (%s): %d packets, %0.0f S/s, %d gaps, %d samples lost (%d in kernel drops)%s" % \
+                         (counters['device'], ip_address, counters['packets'], samples / elapsed if elapsed else 0,
+                          counters['gaps'], counters['lost_samples'], counters['kernel_lost_samples'],
+                          ", %d resyncs" % counters['resyncs'] if counters.get('resyncs') else ""))
+        for name, histogram in sorted(stats['histograms'].items()):
+            if histogram['count']:
+                lines.append("%s: p50 %0.6f s, p99 %0.6f s, max %0.6f s over %d" % \
+                             (name, histogram['p50'], histogram['p99'], histogram['max'], histogram['count']))
+        for where, counters in sorted(stats['sockets'].items()):
+            lines.append("socket %s: %d datagrams dropped by the kernel, receive buffer %d KB%s" % \
+                         (where, counters['dropped_datagrams'], counters['receive_buffer'] // 1024,
+                          " (asked for %d KB)" % (counters['requested_buffer'] // 1024)
+                          if (counters['requested_buffer'] or 0) > counters['receive_buffer'] else ""))
+        if stats['timeouts']:
+            lines.append("timeouts: %s" % ", ".join("%s %d" % item for item in sorted(stats['timeouts'].items())))
+        if stats['exceptions']:
+            lines.append("exceptions: %s" % ", ".join("%s %d" % item for item in sorted(stats['exceptions'].items())))
+        return lines
+
+    # Prometheus text exposition format, for scraping
+    def prometheus_text(self, stats=None):
+        stats = stats or self.stats()
+        lines = []
+        for name in ['packets', 'bytes', 'samples', 'gaps', 'lost_samples', 'kernel_gaps', 'kernel_lost_samples',
+                     'resyncs']:
+            lines.append("# TYPE dataq_%s_total counter" % name)
+            for ip_address, counters in sorted(stats['devices'].items()):
+                lines.append('dataq_%s_total{ip="%s",device="%s"} %d' % \
+                             (name, ip_address, counters['device'], counters[name]))
+
+        for name, histogram in sorted(stats['histograms'].items()):
+            lines.append("# TYPE dataq_%s_seconds histogram" % name)
+            cumulative = 0
+            for bound, count in histogram['buckets']:
+                cumulative = cumulative + count
+                lines.append('dataq_%s_seconds_bucket{le="%s"} %d' % \
+                             (name, "+Inf" if bound == float('inf') else "%g" % bound, cumulative))
+            lines.append("dataq_%s_seconds_sum %r" % (name, histogram['sum']))
+            lines.append("dataq_%s_seconds_count %d" % (name, histogram['count']))
+
+        lines.append("# TYPE dataq_timeouts_total counter")
+        for where, count in sorted(stats['timeouts'].items()):
+            lines.append('dataq_timeouts_total{where="%s"} %d' % (where, count))
+        lines.append("# TYPE dataq_exceptions_total counter")
+        for key, count in sorted(stats['exceptions'].items()):
+            where, exception_type = key.split(':', 1)
+            lines.append('dataq_exceptions_total{where="%s",type="%s"} %d' % (where, exception_type, count))
+        lines.append("# TYPE dataq_unknown_packets_total counter")
+        lines.append("dataq_unknown_packets_total %d" % stats['unknown_packets'])
+        lines.append("# TYPE dataq_kernel_dropped_datagrams_total counter")
+        for where, counters in sorted(stats['sockets'].items()):
+            lines.append('dataq_kernel_dropped_datagrams_total{socket="%s"} %d' % (where, counters['dropped_datagrams']))
+        lines.append("# TYPE dataq_receive_buffer_bytes gauge")
+        for where, counters in sorted(stats['sockets'].items()):
+            lines.append('dataq_receive_buffer_bytes{socket="%s"} %d' % (where, counters['receive_buffer']))
+        lines.append("# TYPE dataq_startup_seconds gauge")
+        for phase, seconds in stats['startup'].items():
+            lines.append('dataq_startup_seconds{phase="%s"} %r' % (phase, seconds))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,46 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Kept out of dataq_telemetry.py so acquisition, which always imports that, doesn't pay for http.server
+#  unless stats are actually served
+#
+# Serves a stats() callable over HTTP on the local machine: /metrics in Prometheus text format, /stats as JSON,
+#  anything else as the human readable summary
+class TelemetryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, dataq, address=('127.0.0.1', 9134)):
+        self.dataq = dataq
+        super().__init__(address, TelemetryHandler)
+        self.thread = threading.Thread(target=self.serve_forever, name="DataQ telemetry", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TelemetryHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        stats = self.server.dataq.stats()
+        if self.path.startswith('/metrics'):
+            body = self.server.dataq.telemetry.prometheus_text(stats)
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path.startswith('/stats'):
+            body = json.dumps(stats, indent=1)
+            content_type = 'application/json'
+        else:
+            body = "\n".join(self.server.dataq.telemetry.summary_lines(stats)) + "\n"
+            content_type = 'text/plain'
+
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,96 @@
+import collections
+import threading
+import numpy as np
+
+
+# Sample accurate timestamps for each unit's data stream. Every unit is anchored to host time once, when it
+#  is told to start, after that a sample's time only depends on its CumulativeCount and the configured
+#  scan rate, so host scheduling jitter never gets into the timestamps.
+#
+# The unit scans its scan list once every srate * dec * deca ticks of its 60 MHz clock, so scan n of a
+#  stream starts at anchor_ns + n * srate * dec * deca * 1000 / 60 ns. All samples of a scan get the time the
+#  scan started.
+#
+# CumulativeCount is a 32 bit counter of samples sent. It is unwrapped into a 64 bit sample number here, and
+#  whenever it doesn't continue where the previous packet ended a gap record is kept. A negative LostSamples
+#  means the count went backwards, e.g. the unit restarted.
+#
+# Packets are observed on the receiver thread while gaps are taken on another, so the gap records are behind
+#  a lock. Only the last max_gaps are kept if nobody takes them, dropped_gaps counts the rest.
+class SampleClock:
+    def __init__(self, max_gaps=10000):
+        self.units = {}
+        self.gaps = collections.deque(maxlen=max_gaps)
+        self.dropped_gaps = 0
+        self.gaps_lock = threading.Lock()
+
+    # Set up (or reset) a unit's stream, has to be called again whenever its scan rate or scan list changes
+    def configure(self, ip_address, srate, dec=1, deca=1, scan_length=1, device=None):
+        self.units[ip_address] = {'device': device,
+                                  'ticks_per_scan': srate * dec * deca,    # 60 MHz ticks
+                                  'scan_length': scan_length,
+                                  'anchor_ns': None,
+                                  'next_sample': None}  # Unwrapped sample number we expect next
+
+    # Tie sample 0 of every configured unit (or just one) to host time, right after SyncStart
+    def anchor(self, host_ns, ip_address=None):
+        for ip in ([ip_address] if ip_address else self.units):
+            self.units[ip]['anchor_ns'] = host_ns
+            self.units[ip]['next_sample'] = 0   # So samples lost before the first packet count as a gap
+
+    # Track one packet, returns the unwrapped sample number of its first sample and the gap record this packet
+    #  started, None if it carried on where the previous one ended. kernel_drops goes into the gap record as
+    #  KernelDrops: datagrams the receiving socket dropped since the previous gap, if the caller knows.
+    def observe(self, ip_address, cumulative_count, sample_count, host_ns=None, kernel_drops=None):
+        unit = self.units[ip_address]
+        gap = None
+        if unit['next_sample'] is None:
+            sample_number = cumulative_count
+        else:
+            # How far the 32 bit count moved on from where we expected it, negative if it went backwards
+            jump = (cumulative_count - unit['next_sample']) % (1 << 32)
+            if jump >= (1 << 31):
+                jump = jump - (1 << 32)
+            sample_number = unit['next_sample'] + jump
+
+            if jump != 0:
+                gap = {'IPAddress': ip_address,
+                       'Device': unit['device'],
+                       'ExpectedCount': unit['next_sample'] % (1 << 32),
+                       'CumulativeCount': cumulative_count,
+                       'LostSamples': jump,
+                       'SampleNumber': unit['next_sample'],
+                       'Time_ns': host_ns}
+                if kernel_drops is not None:
+                    gap['KernelDrops'] = kernel_drops
+                self.add_gaps([gap])
+
+        unit['next_sample'] = sample_number + sample_count
+        return sample_number, gap
+
+    # Keep gap records, e.g. ones a sharded worker found
+    def add_gaps(self, gaps):
+        with self.gaps_lock:
+            overflow = len(self.gaps) + len(gaps) - self.gaps.maxlen
+            if overflow > 0:
+                self.dropped_gaps = self.dropped_gaps + overflow
+            self.gaps.extend(gaps)
+
+    # Gap records since the last call
+    def take_gaps(self):
+        with self.gaps_lock:
+            gaps = list(self.gaps)
+            self.gaps.clear()
+        return gaps
+
+    # Timestamps (int64 ns since epoch) for an array of unwrapped sample numbers
+    def timestamps(self, ip_address, sample_numbers):
+        unit = self.units[ip_address]
+        if unit['anchor_ns'] is None:
+            raise Exception("Sample clock for %s has not been anchored, call anchor() after SyncStart" % ip_address)
+        scans = np.asarray(sample_numbers, dtype=np.int64) // unit['scan_length']
+        return unit['anchor_ns'] + (scans * unit['ticks_per_scan'] * 50) // 3     # 60 MHz ticks to ns
+
+    # Timestamps for count consecutive samples starting at sample number first
+    def sample_timestamps(self, ip_address, first, count):
+        return self.timestamps(ip_address, np.arange(first, first + count, dtype=np.int64))
@@ -0,0 +1,349 @@
+import datetime
+import json
+import math
+import os
+import struct
+import sys
+import numpy as np
+
+
+# *** Trigger engine ***
+# Full rate data is only kept around events. TriggerEngine takes one unit's scans a block at a time and
+#  evaluates its triggers over the whole block with NumPy, Python only runs per event. Every event is written
+#  as a capture of all the unit's channels from pre_ms before the triggering scan to post_ms after it, the
+#  continuous stream comes back out decimated for the regular log.
+#
+# A trigger is a dictionary naming a channel, a type and its parameters:
+#   {"name": "overpressure", "channel": "Example_Channel_Name_03", "type": "level", "level": 5.0,
+#    "direction": "above"}
+#   level   the value is above (or 'below') level
+#   edge    the value crosses level, direction 'rising', 'falling' or 'either'
+#   window  the value is outside low..high ('outside': false for inside)
+#   slope   the value changes faster than rate units per second, direction 'rising', 'falling' or 'either'
+# level and window fire on any scan meeting them, edge and slope only where they happen. After an event the
+#  engine doesn't fire again until the post trigger capture is complete; scans meeting a trigger in that
+#  time are counted in missed, not captured.
+#
+# Captures go into directory, one file per event:
+#   YYYYMMDD_HHMMSS_ffffff_<trigger name>.dqe   header, then the timestamp (int64 ns) of every scan, then the
+#                                               scans, a row per scan and a column per channel
+EVENT_MAGIC = b'DQEVT1\n\0'
+TRIGGER_TYPES = ['level', 'edge', 'window', 'slope']
+
+
+# Parses the header at the start of an event file, returns it and its length
+def read_event_header(data):
+    if data[:len(EVENT_MAGIC)] != EVENT_MAGIC:
+        raise Exception("Not a DataQ event file!")
+    header_length = struct.unpack_from('<I', data, len(EVENT_MAGIC))[0]
+    header = json.loads(data[len(EVENT_MAGIC) + 4:len(EVENT_MAGIC) + 4 + header_length])
+    header['dtype'] = np.dtype(header['dtype'])
+    length = len(EVENT_MAGIC) + 4 + header_length
+    return header, length + (-length % 64)
+
+
+# Returns (header, timestamps, scans) of one event file
+def read_event(path):
+    with open(path, 'rb') as event_file:
+        data = event_file.read()
+    header, header_length = read_event_header(data)
+    timestamps = np.frombuffer(data, dtype='<i8', count=header['scans'], offset=header_length)
+    scans = np.frombuffer(data, dtype=header['dtype'], count=header['scans'] * len(header['channels']),
+                          offset=header_length + 8 * header['scans']).reshape(header['scans'], len(header['channels']))
+    return header, timestamps, scans
+
+
+# Headers of the events in a directory whose trigger time is between t_start and t_end, oldest first,
+#  each with its file name as 'path'
+def list_events(directory, t_start=None, t_end=None):
+    events = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.dqe'):
+            continue
+        path = os.path.join(directory, name)
+        with open(path, 'rb') as event_file:
+            header = read_event_header(event_file.read(65536))[0]
+        if (t_start is None or header['trigger_ns'] >= t_start) and (t_end is None or header['trigger_ns'] <= t_end):
+            header['path'] = path
+            events.append(header)
+    return events
+
+
+# Checks a trigger dictionary, returns it with defaults filled in
+def check_trigger(trigger, channel_names):
+    trigger = dict(trigger)
+    if trigger.get('type') not in TRIGGER_TYPES:
+        raise Exception("Trigger type %s is not one of %s!" % (trigger.get('type'), ", ".join(TRIGGER_TYPES)))
+    if trigger.get('channel') not in channel_names:
+        raise Exception("Trigger on unknown channel %s!" % trigger.get('channel'))
+    required = {'level': ['level'], 'edge': ['level'], 'window': ['low', 'high'], 'slope': ['rate']}
+    for key in required[trigger['type']]:
+        if key not in trigger:
+            raise Exception("%s trigger on %s needs '%s'!" % (trigger['type'], trigger['channel'], key))
+    trigger.setdefault('name', "%s_%s" % (trigger['channel'], trigger['type']))
+    trigger.setdefault('direction', 'above' if trigger['type'] == 'level' else 'rising')
+    trigger.setdefault('outside', True)
+    return trigger
+
+
+# Indices (into values) of the scans a trigger fires on. previous is the value of the scan before values[0],
+#  None at the very start. scan_rate is in scans per second, for slope.
+def trigger_hits(trigger, values, previous, scan_rate):
+    kind = trigger['type']
+    if kind == 'level':
+        return np.flatnonzero(values < trigger['level'] if trigger['direction'] == 'below' else values > trigger['level'])
+    if kind == 'window':
+        inside = (values >= trigger['low']) & (values <= trigger['high'])
+        return np.flatnonzero(~inside if trigger['outside'] else inside)
+
+    # edge and slope compare every scan with the one before it
+    before = np.empty_like(values)
+    before[0] = values[0] if previous is None else previous
+    before[1:] = values[:-1]
+    if kind == 'edge':
+        rising = (before <= trigger['level']) & (values > trigger['level'])
+        falling = (before >= trigger['level']) & (values < trigger['level'])
+    else:
+        change = (values - before) * scan_rate
+        rising = change > trigger['rate']
+        falling = change < -trigger['rate']
+    if trigger['direction'] == 'rising':
+        return np.flatnonzero(rising)
+    if trigger['direction'] == 'falling':
+        return np.flatnonzero(falling)
+    return np.flatnonzero(rising | falling)
+
+
+# Triggers and captures for one unit, fed whole scans through append() like a ColumnarLogWriter. decimate
+#  is how many scans of the continuous stream append() returns one of, 1 for all of them.
+class TriggerEngine:
+    def __init__(self, directory, channel_names, triggers, scan_rate, pre_ms=100, post_ms=100, decimate=1,
+                 dtype='<f4'):
+        self.directory = directory
+        self.channel_names = list(channel_names)
+        self.triggers = [check_trigger(trigger, self.channel_names) for trigger in triggers]
+        self.columns = [self.channel_names.index(trigger['channel']) for trigger in self.triggers]
+        self.scan_rate = scan_rate
+        self.pre_scans = int(math.ceil(pre_ms * scan_rate / 1000))
+        self.post_scans = int(math.ceil(post_ms * scan_rate / 1000))
+        self.decimate = max(1, int(decimate))
+        self.dtype = np.dtype(dtype)
+        os.makedirs(directory, exist_ok=True)
+
+        # Pre trigger ring: the last pre_scans scans before the current block
+        self.ring_timestamps = np.zeros(self.pre_scans, dtype=np.int64)
+        self.ring_values = np.zeros((self.pre_scans, len(self.channel_names)), dtype=np.float64)
+        self.ring_next = 0
+        self.ring_filled = 0
+
+        self.scan_count = 0         # Scans seen so far, the absolute number of the next scan
+        self.armed_at = 0           # First scan number that may trigger again
+        self.previous = None        # Last scan seen, for edge and slope
+        self.capture = None         # Capture waiting for its post trigger scans
+        self.phase = 0              # Offset of the next scan to keep when decimating
+
+        self.events = 0
+        self.missed = 0
+
+    # Add scans, timestamps is one int64 ns timestamp per scan (in order), values is (scans, channels).
+    #  Returns the decimated (timestamps, values) for the continuous log.
+    def append(self, timestamps, values):
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        count = len(timestamps)
+        if count == 0:
+            return timestamps, values
+
+        if self.capture is not None:
+            self.continue_capture(timestamps, values, 0)
+
+        # Every trigger over the whole block at once, merged in scan order (first trigger first on a tie)
+        indices = []
+        owners = []
+        for number, (trigger, column) in enumerate(zip(self.triggers, self.columns)):
+            previous = None if self.previous is None else self.previous[column]
+            hits = trigger_hits(trigger, values[:, column], previous, self.scan_rate)
+            indices.append(hits)
+            owners.append(np.full(len(hits), number))
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        order = np.argsort(indices, kind='stable')
+        indices = indices[order]
+        owners = np.concatenate(owners)[order] if owners else indices
+
+        # Only the scans starting a capture are looked at one by one, at most one per post trigger window
+        position = 0
+        started = 0
+        while True:
+            position = max(position, self.armed_at - self.scan_count)
+            next_hit = np.searchsorted(indices, position)
+            if next_hit == len(indices):
+                break
+            index = int(indices[next_hit])
+            self.start_capture(self.triggers[owners[next_hit]], timestamps, values, index)
+            self.continue_capture(timestamps, values, index)
+            position = index + 1
+            started = started + 1
+        self.missed = self.missed + len(np.unique(indices)) - started
+
+        self.scan_count = self.scan_count + count
+        self.previous = values[-1].copy()
+        self.write_ring(timestamps, values)
+
+        keep = slice(self.phase, None, self.decimate)
+        self.phase = (self.phase - count) % self.decimate
+        return timestamps[keep], values[keep]
+
+    # Pre trigger scans plus the triggering one, from the ring and this block
+    def start_capture(self, trigger, timestamps, values, index):
+        ring_timestamps, ring_values = self.read_ring()
+        pre = max(0, self.pre_scans - index)    # How many of the pre trigger scans come from the ring
+        pre = min(pre, len(ring_timestamps))
+        first = max(0, index - self.pre_scans)
+        self.capture = {'trigger': trigger,
+                        'trigger_ns': int(timestamps[index]),
+                        'trigger_value': float(values[index, self.channel_names.index(trigger['channel'])]),
+                        'timestamps': [ring_timestamps[len(ring_timestamps) - pre:], timestamps[first:index]],
+                        'values': [ring_values[len(ring_values) - pre:], values[first:index]],
+                        'remaining': self.post_scans + 1}
+        self.armed_at = self.scan_count + index + self.post_scans + 1
+        self.events = self.events + 1
+
+    # Adds scans from index on to the open capture until it has its post trigger scans, then writes it
+    def continue_capture(self, timestamps, values, index):
+        end = min(len(timestamps), index + self.capture['remaining'])
+        self.capture['timestamps'].append(timestamps[index:end])
+        self.capture['values'].append(values[index:end])
+        self.capture['remaining'] = self.capture['remaining'] - (end - index)
+        if self.capture['remaining'] == 0:
+            self.write_capture(self.capture)
+            self.capture = None
+
+    def write_capture(self, capture):
+        timestamps = np.concatenate(capture['timestamps']).astype('<i8')
+        values = np.concatenate(capture['values']).astype(self.dtype)
+        trigger_time = datetime.datetime.fromtimestamp(capture['trigger_ns'] / 1e9, datetime.timezone.utc)
+        name = "%s_%s.dqe" % (trigger_time.strftime('%Y%m%d_%H%M%S_%f'), capture['trigger']['name'])
+
+        header = json.dumps({'channels': self.channel_names, 'dtype': self.dtype.str, 'scans': len(timestamps),
+                             'trigger': capture['trigger'], 'trigger_ns': capture['trigger_ns'],
+                             'trigger_value': capture['trigger_value'],
+                             'pre_scans': self.pre_scans, 'post_scans': self.post_scans}).encode()
+        header = EVENT_MAGIC + struct.pack('<I', len(header)) + header
+        with open(os.path.join(self.directory, name), 'wb') as event_file:
+            event_file.write(header + b'\0' * (-len(header) % 64))
+            event_file.write(timestamps.tobytes())
+            event_file.write(values.tobytes())
+
+    # Keep the last pre_scans scans, at most two copies per block
+    def write_ring(self, timestamps, values):
+        capacity = self.pre_scans
+        if capacity == 0:
+            return
+        if len(timestamps) >= capacity:
+            self.ring_timestamps[:] = timestamps[-capacity:]
+            self.ring_values[:] = values[-capacity:]
+            self.ring_next = 0
+            self.ring_filled = capacity
+            return
+
+        first = min(len(timestamps), capacity - self.ring_next)
+        self.ring_timestamps[self.ring_next:self.ring_next + first] = timestamps[:first]
+        self.ring_values[self.ring_next:self.ring_next + first] = values[:first]
+        rest = len(timestamps) - first
+        self.ring_timestamps[:rest] = timestamps[first:]
+        self.ring_values[:rest] = values[first:]
+        self.ring_next = (self.ring_next + len(timestamps)) % capacity
+        self.ring_filled = min(capacity, self.ring_filled + len(timestamps))
+
+    # The ring's scans, oldest first (copies)
+    def read_ring(self):
+        if self.ring_filled < self.pre_scans:
+            return self.ring_timestamps[:self.ring_filled].copy(), self.ring_values[:self.ring_filled].copy()
+        order = np.r_[self.ring_next:self.pre_scans, 0:self.ring_next]
+        return self.ring_timestamps[order], self.ring_values[order]
+
+    # Write out a capture still waiting for post trigger scans, with what it has
+    def close(self):
+        if self.capture is not None:
+            self.write_capture(self.capture)
+            self.capture = None
+
+
+# One TriggerEngine per unit, keyed by IP, each with the triggers on its own channels (channel names are
+#  unique across units). Units without triggers still get one, for the decimation.
+def create_trigger_engines(dataq, directory, triggers, pre_ms=100, post_ms=100, decimate=1):
+    engines = {}
+    known = []
+    for ip_address, route in dataq.routes.items():
+        ticks_per_scan = dataq.sample_clock.units[ip_address]['ticks_per_scan']
+        unit_triggers = [trigger for trigger in triggers if trigger.get('channel') in route['channel_names']]
+        engines[ip_address] = TriggerEngine(os.path.join(directory, route['device']), route['channel_names'],
+                                            unit_triggers, 60e6 / ticks_per_scan, pre_ms=pre_ms, post_ms=post_ms,
+                                            decimate=decimate)
+        known.extend(route['channel_names'])
+    for trigger in triggers:
+        if trigger.get('channel') not in known:
+            raise Exception("Trigger on unknown channel %s!" % trigger.get('channel'))
+    return engines
+
+
+# Sink running full rate blocks through one TriggerEngine per unit, keyed by IP, and handing the decimated
+#  blocks on to sink (e.g. a columnar_log_sink). The decimated blocks only carry what the log sinks use.
+def trigger_sink(dataq, engines, sink):
+    from dataq_storage import interleaved_to_scans
+
+    def trigger_batch(batch):
+        decimated = []
+        for block in batch:
+            scan_length = len(dataq.routes[block['IPAddress']]['slots'])
+            skip, scans = interleaved_to_scans(block['Values'], block['FirstSlot'], scan_length)
+            engine = engines[block['IPAddress']]
+            phase = engine.phase
+            timestamps, scans = engine.append(block['Timestamps'][skip::scan_length][:len(scans)], scans)
+            if len(timestamps):
+                decimated.append({'IPAddress': block['IPAddress'],
+                                  'Device': block['Device'],
+                                  'FirstSlot': 0,
+                                  'Timestamps': np.repeat(timestamps, scan_length),
+                                  'Values': scans.ravel(),
+                                  'Received_ns': block.get('Received_ns')})
+                if 'Counts' in block:   # Decimated the same way, for the raw archive
+                    counts = interleaved_to_scans(block['Counts'], block['FirstSlot'], scan_length)[1]
+                    decimated[-1]['Counts'] = counts[phase::engine.decimate].ravel()
+        if decimated:
+            sink(decimated)
+    return trigger_batch
+
+
+# Lists the events in a directory (or a unit's directory in it), or prints one event's scans
+def main(argv=None):
+    import argparse
+
+    ap = argparse.ArgumentParser(description="List DataQ trigger events")
+    ap.add_argument("directory", type=str, help="event directory of a unit, or a .dqe file to print")
+    ap.add_argument("-c", "--csv", required=False, action='store_true', help="print an event's scans as CSV")
+    args = vars(ap.parse_args(argv))
+
+    if os.path.isfile(args['directory']):
+        header, timestamps, scans = read_event(args['directory'])
+        if args['csv']:
+            print("time_ns," + ",".join(header['channels']))
+            for timestamp, scan in zip(timestamps.tolist(), scans.tolist()):
+                print("%d,%s" % (timestamp, ",".join("%f" % value for value in scan)))
+            return 0
+        events = [dict(header, path=args['directory'])]
+    else:
+        events = list_events(args['directory'])
+
+    for event in events:
+        trigger_time = datetime.datetime.fromtimestamp(event['trigger_ns'] / 1e9)
+        print("%s %s: %s %s on %s, value %f, %d scans (%d before)" % \
+              (trigger_time.strftime('%Y-%m-%d %H:%M:%S.%f'), event['trigger']['name'], event['trigger']['type'],
+               event['trigger']['direction'], event['trigger']['channel'], event['trigger_value'], event['scans'],
+               event['pre_scans']))
+    print("%d events" % len(events))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
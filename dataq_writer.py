@@ -0,0 +1,208 @@
+import os
+import pickle
+import queue
+import threading
+import time
+
+from dataq_storage import interleaved_to_scans
+
+
+# Writes decoded blocks from a worker thread. Producers put() blocks into a bounded queue, the worker hands
+#  them to sink (a callable taking a list of blocks) in batches, a batch goes out once it holds batch_blocks
+#  blocks or its oldest block is flush_interval seconds old.
+#
+# policy decides what put() does while the queue is full because storage is slow:
+#   'block'  wait for room, backpressure goes all the way up to the producer
+#   'drop'   throw the block away and count it
+#   'spill'  pickle the block to a file in spill_dir, the worker writes spilled blocks back out (in order)
+#            once it has caught up
+#
+# With a Telemetry, the receive-to-write latency of every block carrying Received_ns goes into its
+#  'recv_to_write' histogram and sink exceptions are counted by type.
+class BlockWriter:
+    def __init__(self, sink, max_queue_blocks=256, batch_blocks=32, flush_interval=1.0, policy='block',
+                 spill_dir='example_log/spill', telemetry=None):
+        if policy not in ['block', 'drop', 'spill']:
+            raise Exception("Unknown writer policy %s!" % policy)
+
+        self.sink = sink
+        self.telemetry = telemetry
+        self.batch_blocks = batch_blocks
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=max_queue_blocks)
+
+        self.spill_dir = spill_dir
+        self.spill_lock = threading.Lock()
+        self.spill_file = None
+        self.spill_sequence = 0
+        self.spilled_pending = 0    # Blocks on disk, not yet written to the sink
+        if policy == 'spill':
+            os.makedirs(spill_dir, exist_ok=True)
+
+        # Metrics, see metrics()
+        self.blocks_written = 0
+        self.batches_written = 0
+        self.dropped_blocks = 0
+        self.spilled_blocks = 0
+        self.max_queue_depth = 0
+        self.write_latency_last = 0.0
+        self.write_latency_max = 0.0
+        self.write_latency_total = 0.0
+        self.sink_errors = 0
+
+        self.stop_event = threading.Event()
+        self.worker = threading.Thread(target=self.run, name="DataQ writer", daemon=True)
+        self.worker.start()
+
+    # Producer side, never blocks unless policy is 'block'. Returns False if the block was dropped.
+    def put(self, block):
+        # Once spilling, keep spilling until the worker has written the spill back, so blocks stay in order
+        if self.policy == 'spill' and self.spilled_pending:
+            self.spill(block)
+            return True
+
+        try:
+            self.queue.put(block, block=(self.policy == 'block'))
+        except queue.Full:
+            if self.policy == 'drop':
+                self.dropped_blocks = self.dropped_blocks + 1
+                return False
+            self.spill(block)
+
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return True
+
+    def spill(self, block):
+        with self.spill_lock:
+            if self.spill_file is None:
+                self.spill_sequence = self.spill_sequence + 1
+                self.spill_file = open(os.path.join(self.spill_dir, "spill_%06d.pickle" % self.spill_sequence), 'wb')
+            pickle.dump(block, self.spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+            self.spilled_pending = self.spilled_pending + 1
+            self.spilled_blocks = self.spilled_blocks + 1
+
+    # Worker side, hand the current spill file back and read it. Anything spilled meanwhile goes to a new file.
+    def take_spill(self):
+        with self.spill_lock:
+            if self.spill_file is None:
+                return []
+            path = self.spill_file.name
+            self.spill_file.close()
+            self.spill_file = None
+
+        blocks = []
+        with open(path, 'rb') as spill_file:
+            while True:
+                try:
+                    blocks.append(pickle.load(spill_file))
+                except EOFError:
+                    break
+        os.remove(path)
+        return blocks
+
+    def write_batch(self, batch):
+        if not batch:
+            return
+
+        start_time = time.perf_counter()
+        try:
+            self.sink(batch)
+        except Exception as e:
+            self.sink_errors = self.sink_errors + 1
+            print("Writing %d blocks failed: %s" % (len(batch), e))
+            if self.telemetry is not None:
+                self.telemetry.count_exception('writer', e)
+        latency = time.perf_counter() - start_time
+
+        if self.telemetry is not None:
+            written_ns = time.perf_counter_ns()
+            for block in batch:
+                if 'Received_ns' in block:
+                    self.telemetry.observe('recv_to_write', (written_ns - block['Received_ns']) / 1e9)
+
+        self.write_latency_last = latency
+        self.write_latency_max = max(self.write_latency_max, latency)
+        self.write_latency_total = self.write_latency_total + latency
+        self.blocks_written = self.blocks_written + len(batch)
+        self.batches_written = self.batches_written + 1
+
+    def run(self):
+        batch = []
+        batch_start = None
+        while True:
+            timeout = self.flush_interval if batch_start is None else \
+                      max(0.0, batch_start + self.flush_interval - time.monotonic())
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+                if batch_start is None:
+                    batch_start = time.monotonic()
+            except queue.Empty:
+                pass
+
+            if len(batch) >= self.batch_blocks or \
+               (batch and time.monotonic() - batch_start >= self.flush_interval) or \
+               (batch and self.stop_event.is_set() and self.queue.empty()):
+                self.write_batch(batch)
+                batch = []
+                batch_start = None
+
+            # Caught up with the queue, now write back what was spilled while we were behind
+            if self.spilled_pending and self.queue.empty() and not batch:
+                spilled = self.take_spill()
+                for start in range(0, len(spilled), self.batch_blocks):
+                    self.write_batch(spilled[start:start + self.batch_blocks])
+                with self.spill_lock:
+                    self.spilled_pending = self.spilled_pending - len(spilled)
+
+            if self.stop_event.is_set() and self.queue.empty() and not batch and not self.spilled_pending:
+                break
+
+    # Write out everything queued or spilled and stop the worker
+    def close(self, timeout=None):
+        self.stop_event.set()
+        self.worker.join(timeout)
+
+    def metrics(self):
+        return {'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'blocks_written': self.blocks_written,
+                'batches_written': self.batches_written,
+                'dropped_blocks': self.dropped_blocks,
+                'spilled_blocks': self.spilled_blocks,
+                'spilled_pending': self.spilled_pending,
+                'write_latency_last': self.write_latency_last,
+                'write_latency_max': self.write_latency_max,
+                'write_latency_avg': self.write_latency_total / self.batches_written if self.batches_written else 0.0,
+                'sink_errors': self.sink_errors}
+
+
+# Sink writing blocks to the text log as "<channel> value=<reading> time_ns=<timestamp>" lines, one
+#  logger call per batch
+def text_log_sink(dataq, logger):
+    def sink(batch):
+        lines = []
+        for block in batch:
+            lines.extend(dataq.format_adc_lines(block))
+        logger.info("\n".join(lines))
+    return sink
+
+
+# Sink writing blocks to one ColumnarLogWriter per unit, keyed by IP
+def columnar_log_sink(dataq, columnar_logs):
+    def sink(batch):
+        for block in batch:
+            scan_length = len(dataq.routes[block['IPAddress']]['slots'])
+            skip, scans = interleaved_to_scans(block['Values'], block['FirstSlot'], scan_length)
+            columnar_logs[block['IPAddress']].append(block['Timestamps'][skip::scan_length][:len(scans)], scans)
+    return sink
+
+
+# Sink feeding blocks to one dataq_aggregate.AggregationPyramid per unit, keyed by IP
+def aggregate_sink(dataq, pyramids):
+    def sink(batch):
+        for block in batch:
+            scan_length = len(dataq.routes[block['IPAddress']]['slots'])
+            skip, scans = interleaved_to_scans(block['Values'], block['FirstSlot'], scan_length)
+            pyramids[block['IPAddress']].append(block['Timestamps'][skip::scan_length][:len(scans)], scans)
+    return sink